@@ -28,12 +28,43 @@ from clueslib.node import Node, NodeInfo, NodeList
 from cpyutils.evaluate import TypedClass, TypedList
 
 import subprocess
+import array
+import hashlib
+import time
+import threading
+import multiprocessing
+import multiprocessing.pool
 
 import htcondor
 import classad
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 _LOGGER = logging.getLogger("[PLUGIN-HTCondor]")
 
+# Attributes of the job and startd ads read by the plugin (the rest are not
+# requested to the daemons)
+JOB_ATTRIBUTES = ["RequestCpus", "ImageSize", "RemoteHost", "AllRemoteHosts",
+                  "MinHosts", "ClusterId", "ProcId", "JobStatus"]
+STARTD_ATTRIBUTES = ["Name", "Activity", "TotalSlots", "Memory"]
+# Attributes of the slot ads used to obtain the usage of the machines
+SLOT_ATTRIBUTES = ["Name", "Machine", "SlotType", "State", "Cpus", "Memory",
+                   "TotalSlotCpus", "TotalSlotMemory"]
+# Attributes that identify the resource request of the pending jobs, to
+# aggregate them (the autocluster or, if missing, the request itself). The
+# number of hosts is not taken into account by the autoclusters, so it is
+# always part of the group
+PENDING_SIGNATURE_ATTRIBUTES = ["RequestCpus", "RequestMemory", "Requirements", "MinHosts"]
+# Attributes requested in addition to JOB_ATTRIBUTES to aggregate the pending
+# jobs (MemoryUsage is needed to evaluate RequestMemory)
+PENDING_AGGREGATION_ATTRIBUTES = ["AutoClusterId", "RequestMemory", "MemoryUsage", "Requirements"]
+
+# The removed (3) and completed (4) jobs are filtered out by the schedd
+JOBS_CONSTRAINT = "JobStatus =!= 3 && JobStatus =!= 4"
+
 # Executes external commands
 
 
@@ -62,35 +93,632 @@ def infer_clues_job_state(state):
         return clueslib.request.Request.ATTENDED
 
 
-def get_worker_nodes_list_from_Startd():
-    return get_condor_daemons(htcondor.DaemonTypes.Startd)
+# Obtains the hosts where a job is running
+def get_job_hosts(job_scheduled_attributes):
+    try:
+        return job_scheduled_attributes["AllRemoteHosts"].split(",")
+    except:
+        try:
+            return [job_scheduled_attributes["RemoteHost"]]
+        except:
+            return []
+
+
+# Columnar table of the resources used by the jobs on each host: the host (as an
+# index in 'hosts'), cpus and memory of each job are kept in arrays, so the usage
+# of the hosts is aggregated with vectorized operations (using numpy, if it is
+# available, or the array module otherwise)
+class HostUsageTable(object):
+
+    def __init__(self, jobs_scheduled_attributes=()):
+        self.hosts = []
+        self._host_indexes = {}
+        self._host = array.array('l')
+        self._cpus = array.array('d')
+        self._memory = array.array('l')
+        for job_scheduled_attributes in jobs_scheduled_attributes:
+            self.add_job(job_scheduled_attributes)
+
+    def add_job(self, job_scheduled_attributes):
+        try:
+            cpus = float(job_scheduled_attributes["RequestCpus"])
+        except:
+            cpus = 0.0
+        try:
+            memory = int((job_scheduled_attributes["ImageSize"] + 1023) / 1024)
+        except:
+            memory = 0
+        for host in set(get_job_hosts(job_scheduled_attributes)):
+            host_index = self._host_indexes.get(host)
+            if host_index is None:
+                host_index = self._host_indexes[host] = len(self.hosts)
+                self.hosts.append(host)
+            self._host.append(host_index)
+            self._cpus.append(cpus)
+            self._memory.append(memory)
+
+    # Obtains a dictionary with the cpus and memory (in MB) used by the jobs on each host, indexed by host
+    def get_usage(self):
+        if numpy is not None:
+            hosts = numpy.array(self._host, dtype=numpy.int64)
+            cpus = numpy.bincount(hosts, weights=numpy.array(self._cpus, dtype=numpy.float64),
+                                  minlength=len(self.hosts))
+            memory = numpy.bincount(hosts, weights=numpy.array(self._memory, dtype=numpy.int64),
+                                    minlength=len(self.hosts))
+        else:
+            cpus = [0.0] * len(self.hosts)
+            memory = [0] * len(self.hosts)
+            for host, job_cpus, job_memory in zip(self._host, self._cpus, self._memory):
+                cpus[host] += job_cpus
+                memory[host] += job_memory
+        return dict((host, (float(cpus[index]), int(memory[index])))
+                    for index, host in enumerate(self.hosts))
+
+
+# Obtains the number of hosts requested by a job (1 by default)
+def get_min_hosts(job_scheduled_attributes):
+    try:
+        return int(job_scheduled_attributes["MinHosts"])
+    except:
+        return 1
+
+
+# Obtains the memory (in MB) requested by a job, evaluating the expression of
+# RequestMemory if needed (or None if it cannot be obtained)
+def get_request_memory(job_scheduled_attributes):
+    try:
+        return int(job_scheduled_attributes.eval("RequestMemory"))
+    except:
+        try:
+            return int(job_scheduled_attributes["RequestMemory"])
+        except:
+            return None
+
+
+# Obtains the JobInfo of a job from its ad (the id, number of nodes and memory
+# may be overridden, e.g. for aggregated jobs)
+def get_job_info(job_scheduled_attributes, job_id_override=None, numnodes_override=None, memory_override=None):
+    cpus_per_task = 0.0
+    try:
+        cpus_per_task = float(
+            job_scheduled_attributes["RequestCpus"])
+    except:
+        cpus_per_task = 0.0
+    memory = 0
+    try:
+        memory = (
+            job_scheduled_attributes["ImageSize"] + 1023) / 1024
+    except:
+        memory = 0
+    if memory_override is not None:
+        memory = memory_override
+    queue = '"default" in queues'
+    nodes = []
+    numnodes = 0
+    try:
+        nodes = job_scheduled_attributes[
+            "AllRemoteHosts"].split(",")
+        numnodes = len(nodes)
+    except:
+        try:
+            nodes = [
+                job_scheduled_attributes["RemoteHost"]]
+            numnodes = 1
+        except:
+            nodes = []
+            numnodes = job_scheduled_attributes["MinHosts"]
+    if numnodes_override is not None:
+        numnodes = numnodes_override
+    job_id = ""
+    try:
+        cluster_id = job_scheduled_attributes["ClusterId"]
+        proc_id = job_scheduled_attributes["ProcId"]
+        job_id = str(cluster_id) + "." + str(proc_id)
+    except:
+        job_id = ""
+    if job_id_override is not None:
+        job_id = job_id_override
+    state = ""
+    try:
+        job_st = job_scheduled_attributes["JobStatus"]
+        state = infer_clues_job_state(job_st)
+    except:
+        state = clueslib.request.Request.PENDING
+    resources = clueslib.request.ResourcesNeeded(
+        cpus_per_task, memory, [queue], numnodes)
+    j = clueslib.request.JobInfo(resources, job_id, nodes)
+    j.set_state(state)
+    return j
+
+
+# Obtains the id of the group of pending jobs with the same resource request
+# as a job: its autocluster (and number of hosts) or, if missing, a digest of
+# the request
+def get_pending_group_id(job_scheduled_attributes):
+    try:
+        group_id = "autocluster" + str(job_scheduled_attributes["AutoClusterId"])
+        min_hosts = get_min_hosts(job_scheduled_attributes)
+        if min_hosts != 1:
+            group_id += "x%d" % min_hosts
+        return group_id
+    except:
+        signature = []
+        for attribute in PENDING_SIGNATURE_ATTRIBUTES:
+            try:
+                signature.append(str(job_scheduled_attributes[attribute]))
+            except:
+                signature.append("")
+        return "request" + hashlib.md5("\n".join(signature)).hexdigest()[:12]
+
+
+# Generator of the JobInfo of the jobs of a (streamed) query, which also adds
+# the jobs to the HostUsageTable 'hosts_usage', so the ads are processed one by
+# one and none of them is kept in memory. If 'aggregate_pending' is set, the
+# idle jobs with the same resource request are reported as a single job (with
+# id "<scheduler>#<group id>") that requests a task per host of each job,
+# with the memory requested by the jobs
+def generate_job_infos(jobs_scheduled_attributes, hosts_usage, aggregate_pending=False, scheduler=""):
+    pending_groups = {}
+    for job_scheduled_attributes in jobs_scheduled_attributes:
+        hosts_usage.add_job(job_scheduled_attributes)
+        try:
+            job_st = job_scheduled_attributes["JobStatus"]
+        except:
+            job_st = None
+        if aggregate_pending and job_st == 1:
+            group_id = get_pending_group_id(job_scheduled_attributes)
+            if group_id in pending_groups:
+                pending_groups[group_id][1] += 1
+            else:
+                pending_groups[group_id] = [job_scheduled_attributes, 1]
+        else:
+            yield get_job_info(job_scheduled_attributes)
+
+    for group_id, (job_scheduled_attributes, count) in sorted(pending_groups.items()):
+        yield get_job_info(job_scheduled_attributes, "%s#%s" % (scheduler, group_id),
+                           count * get_min_hosts(job_scheduled_attributes),
+                           get_request_memory(job_scheduled_attributes))
+
+
+# In-memory model of the job queue of a schedd, kept up to date from its job
+# event log (read with htcondor.JobEventLog) and reconciled periodically with a
+# full query of the schedd. The events only tell which jobs changed, so the
+# submitted and executing jobs are marked as dirty and their ads are queried in
+# batches
+class JobQueueModel(object):
+
+    def __init__(self, event_log_path, reconcile_interval):
+        self._event_log_path = event_log_path
+        self._reconcile_interval = reconcile_interval
+        self._event_log = None
+        self._last_reconcile = None
+        # Ads of the jobs, indexed by (ClusterId, ProcId)
+        self._jobs = {}
+        self._dirty = set()
+
+    def needs_reconcile(self):
+        return self._last_reconcile is None or \
+            time.time() - self._last_reconcile > self._reconcile_interval
+
+    # Forces a full reconcile in the next update (e.g. after an error). The
+    # reader of the event log is kept, so the events are not read again
+    def invalidate(self):
+        self._last_reconcile = None
+
+    def _read_events(self):
+        if self._event_log is None:
+            self._event_log = htcondor.JobEventLog(self._event_log_path)
+        # stop_after=0 returns the events already written, without waiting
+        return self._event_log.events(stop_after=0)
+
+    def apply_event(self, event_type, key):
+        job = self._jobs.get(key)
+        if event_type == htcondor.JobEventType.SUBMIT:
+            self._jobs[key] = {"ClusterId": key[0], "ProcId": key[1], "JobStatus": 1, "MinHosts": 1}
+            self._dirty.add(key)
+        elif event_type in (htcondor.JobEventType.JOB_TERMINATED, htcondor.JobEventType.JOB_ABORTED):
+            self._jobs.pop(key, None)
+            self._dirty.discard(key)
+        elif job is None:
+            # The job is not in the model (e.g. it was submitted before the
+            # last reconcile and already left the queue)
+            pass
+        elif event_type == htcondor.JobEventType.EXECUTE:
+            job["JobStatus"] = 2
+            # The hosts of the job are obtained from the schedd
+            self._dirty.add(key)
+        elif event_type == htcondor.JobEventType.JOB_HELD:
+            job["JobStatus"] = 5
+        elif event_type in (htcondor.JobEventType.JOB_EVICTED, htcondor.JobEventType.JOB_RELEASED):
+            job["JobStatus"] = 1
+            self._dirty.add(key)
+
+    # Updates the model from the events written since the last update, querying
+    # the ads of the dirty jobs (or all the jobs, if a reconcile is needed)
+    # through 'query(constraint)'
+    def update(self, query, batch_size=100):
+        if self.needs_reconcile():
+            # The events previous to the query are already in the ads
+            for event in self._read_events():
+                pass
+            self._jobs = {}
+            self._dirty = set()
+            for job_scheduled_attributes in query(JOBS_CONSTRAINT):
+                key = (job_scheduled_attributes["ClusterId"], job_scheduled_attributes["ProcId"])
+                self._jobs[key] = job_scheduled_attributes
+            self._last_reconcile = time.time()
+            return
+
+        for event in self._read_events():
+            self.apply_event(event.type, (event.cluster, event.proc))
+        dirty = sorted(self._dirty)
+        self._dirty = set()
+        for start in range(0, len(dirty), batch_size):
+            batch = dirty[start:start + batch_size]
+            constraint = " || ".join(["(ClusterId == %d && ProcId == %d)" % key for key in batch])
+            for key in batch:
+                # The jobs that are not returned have left the queue
+                self._jobs.pop(key, None)
+            for job_scheduled_attributes in query("(%s) && (%s)" % (JOBS_CONSTRAINT, constraint)):
+                key = (job_scheduled_attributes["ClusterId"], job_scheduled_attributes["ProcId"])
+                self._jobs[key] = job_scheduled_attributes
 
+    def get_jobs(self):
+        return [self._jobs[key] for key in sorted(self._jobs)]
 
-def get_schedulers_list_from_Schedd():
-    return get_condor_daemons(htcondor.DaemonTypes.Schedd)
 
+# Caches the location ads of the daemons of each type during 'ttl' seconds
+class DaemonLocationCache(object):
 
-def get_condor_daemons(daemon_type):
-    collector = htcondor.Collector()
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._locations = {}
+        self._lock = threading.Lock()
+
+    def get(self, daemon_type, locate):
+        with self._lock:
+            cached = self._locations.get(daemon_type)
+            if cached is not None and time.time() - cached[1] <= self.ttl:
+                return cached[0]
+        daemons = locate()
+        with self._lock:
+            self._locations[daemon_type] = (daemons, time.time())
+        return daemons
+
+    def invalidate(self, daemon_type=None):
+        with self._lock:
+            if daemon_type is None:
+                self._locations.clear()
+            else:
+                self._locations.pop(daemon_type, None)
+
+
+# The collector handle of a plugin, shared by all its calls, and the location
+# of the daemons, cached during 'ttl' seconds
+class CondorCollector(object):
+
+    def __init__(self, ttl=60):
+        self._collector = None
+        self._locations = DaemonLocationCache(ttl)
+
+    def get(self):
+        if self._collector is None:
+            self._collector = htcondor.Collector()
+        return self._collector
+
+    # Forgets the handle (e.g. after an error), so it is created again in the next call
+    def reset(self):
+        self._collector = None
+
+    def locate(self, daemon_type):
+        return self._locations.get(daemon_type, lambda: self.get().locateAll(daemon_type))
+
+    # Forgets the location of the daemons (e.g. when a located daemon does not
+    # respond), so they are located again in the next call
+    def invalidate(self, daemon_type=None):
+        self._locations.invalidate(daemon_type)
+
+
+def get_worker_nodes_list_from_Startd(collector):
+    # The startd ads carry the activity of the nodes, so they are not cached
+    try:
+        worker_nodes = collector.get().query(
+            htcondor.AdTypes.Startd, "true", STARTD_ATTRIBUTES)
+    except:
+        collector.reset()
+        worker_nodes = []
+    return worker_nodes
+
+
+def get_slots_list_from_Startd(collector):
     try:
-        daemons = collector.locateAll(daemon_type)
+        slots = collector.get().query(
+            htcondor.AdTypes.Startd, "true", SLOT_ATTRIBUTES)
     except:
+        collector.reset()
+        slots = []
+    return slots
+
+
+# Obtains the NodeInfo of the machines from their slot ads, grouped by Machine:
+# the partitionable slot provides the total resources (TotalSlotCpus and
+# TotalSlotMemory) and the remaining ones (Cpus and Memory), while its dynamic
+# slots are the used ones. The static slots are used if they are claimed
+def get_machines_nodeinfolist(slots):
+    machines = {}
+    for slot in slots:
+        try:
+            machine = slot["Machine"]
+        except:
+            try:
+                machine = slot["Name"].split("@")[-1]
+            except:
+                continue
+        try:
+            slot_type = slot["SlotType"]
+        except:
+            slot_type = "Static"
+        try:
+            cpus = slot["Cpus"]
+        except:
+            cpus = 0
+        try:
+            memory = slot["Memory"]
+        except:
+            memory = 0
+        # [slots, slots_free, memory, memory_free, used]
+        usage = machines.setdefault(machine, [0, 0, 0, 0, False])
+        if slot_type == "Partitionable":
+            try:
+                usage[0] += slot["TotalSlotCpus"]
+                usage[2] += slot["TotalSlotMemory"]
+            except:
+                usage[0] += cpus
+                usage[2] += memory
+            usage[1] += cpus
+            usage[3] += memory
+        elif slot_type == "Dynamic":
+            usage[4] = True
+        else:
+            try:
+                claimed = slot["State"] == "Claimed"
+            except:
+                claimed = False
+            usage[0] += cpus
+            usage[2] += memory
+            if claimed:
+                usage[4] = True
+            else:
+                usage[1] += cpus
+                usage[3] += memory
+
+    nodeinfolist = {}
+    for name, (slots_count, slots_free, memory, memory_free, used) in machines.items():
+        keywords = {}
+        keywords['hostname'] = TypedClass.auto(name)
+        queues = ["default"]
+        keywords['queues'] = TypedList(
+            [TypedClass.auto(q) for q in queues])
+        nodeinfolist[name] = NodeInfo(
+            name, slots_count, slots_free, memory, memory_free, keywords)
+        if used:
+            nodeinfolist[name].state = NodeInfo.USED
+        else:
+            nodeinfolist[name].state = NodeInfo.IDLE
+    return nodeinfolist
+
+
+def get_schedulers_list_from_Schedd(collector):
+    return get_condor_daemons(collector, htcondor.DaemonTypes.Schedd)
+
+
+def get_daemon_name(daemon):
+    try:
+        return daemon["Name"]
+    except:
+        return str(daemon)
+
+
+def get_condor_daemons(collector, daemon_type):
+    try:
+        daemons = collector.locate(daemon_type)
+    except:
+        collector.reset()
         daemons = []
     return daemons
 
 
 class lrms(clueslib.platform.LRMS):
 
-    def __init__(self, HTCONDOR_SERVER=None):
+    def __init__(self, HTCONDOR_SERVER=None, HTCONDOR_SNAPSHOT_TTL=None,
+                 HTCONDOR_QUERY_THREADS=None, HTCONDOR_QUERY_DEADLINE=None,
+                 HTCONDOR_DAEMONS_TTL=None, HTCONDOR_AGGREGATE_PENDING=None,
+                 HTCONDOR_EVENT_LOG=None, HTCONDOR_RECONCILE_INTERVAL=None,
+                 HTCONDOR_NODES_FROM_STARTD_ADS=None):
         config_htcondor = cpyutils.config.Configuration(
-            "HTCONDOR", {"HTCONDOR_SERVER": "htcondoreserver"})
+            "HTCONDOR", {"HTCONDOR_SERVER": "htcondoreserver",
+                         "HTCONDOR_SNAPSHOT_TTL": 10,
+                         "HTCONDOR_QUERY_THREADS": 4,
+                         "HTCONDOR_QUERY_DEADLINE": 30,
+                         "HTCONDOR_DAEMONS_TTL": 60,
+                         "HTCONDOR_AGGREGATE_PENDING": False,
+                         "HTCONDOR_EVENT_LOG": "",
+                         "HTCONDOR_RECONCILE_INTERVAL": 300,
+                         "HTCONDOR_NODES_FROM_STARTD_ADS": False})
         self._server_ip = clueslib.helpers.val_default(
             HTCONDOR_SERVER, config_htcondor.HTCONDOR_SERVER)
+        self._snapshot_ttl = clueslib.helpers.val_default(
+            HTCONDOR_SNAPSHOT_TTL, config_htcondor.HTCONDOR_SNAPSHOT_TTL)
+        self._query_threads = clueslib.helpers.val_default(
+            HTCONDOR_QUERY_THREADS, config_htcondor.HTCONDOR_QUERY_THREADS)
+        self._query_deadline = clueslib.helpers.val_default(
+            HTCONDOR_QUERY_DEADLINE, config_htcondor.HTCONDOR_QUERY_DEADLINE)
+        self._collector = CondorCollector(clueslib.helpers.val_default(
+            HTCONDOR_DAEMONS_TTL, config_htcondor.HTCONDOR_DAEMONS_TTL))
+        self._aggregate_pending = clueslib.helpers.val_default(
+            HTCONDOR_AGGREGATE_PENDING, config_htcondor.HTCONDOR_AGGREGATE_PENDING)
+        self._job_attributes = JOB_ATTRIBUTES
+        if self._aggregate_pending:
+            self._job_attributes = JOB_ATTRIBUTES + PENDING_AGGREGATION_ATTRIBUTES
+        self._nodes_from_startd_ads = clueslib.helpers.val_default(
+            HTCONDOR_NODES_FROM_STARTD_ADS, config_htcondor.HTCONDOR_NODES_FROM_STARTD_ADS)
+        event_log = clueslib.helpers.val_default(
+            HTCONDOR_EVENT_LOG, config_htcondor.HTCONDOR_EVENT_LOG)
+        reconcile_interval = clueslib.helpers.val_default(
+            HTCONDOR_RECONCILE_INTERVAL, config_htcondor.HTCONDOR_RECONCILE_INTERVAL)
+        # If the job event log of the (local) schedd is set, the queue is
+        # tracked from its events instead of querying it every pass
+        self._queue_model = None
+        self._remote_schedulers = 0
+        if event_log:
+            self._queue_model = JobQueueModel(event_log, reconcile_interval)
+        self._snapshot_timestamp = None
+        self._scheduled_jobs = None
+        self._query_pool = None
+        # Schedd handles, last query submitted and last good result (result,
+        # timestamp) of each scheduler, indexed by scheduler name
+        self._schedds = {}
+        self._scheduler_queries = {}
+        self._last_results = {}
         clueslib.platform.LRMS.__init__(self, "HTCONDOR_%s" % self._server_ip)
 
+    # Obtains the JobInfo of the jobs of a scheduler and the cpus and memory
+    # used by them on each host, reusing its Schedd handle. The ads are streamed
+    # from the schedd and processed one by one
+    def _query_scheduler(self, name, scheduler):
+        jobs_scheduled = self._schedds.get(name)
+        if jobs_scheduled is None:
+            jobs_scheduled = self._schedds[name] = htcondor.Schedd(scheduler)
+        try:
+            hosts_usage = HostUsageTable()
+            jobinfolist = list(generate_job_infos(
+                jobs_scheduled.xquery(JOBS_CONSTRAINT, self._job_attributes), hosts_usage,
+                self._aggregate_pending, name))
+            return jobinfolist, hosts_usage.get_usage()
+        except:
+            # The handle is created again in the next pass
+            self._schedds.pop(name, None)
+            raise
+
+    # Queries all the schedulers concurrently. The schedulers that do not
+    # answer before the deadline (or fail) are reported with their last good
+    # result (which is only logged as stale). A scheduler is not queried again
+    # while its previous query has not finished, so a hung schedd holds a
+    # single worker and its Schedd handle is never used by two threads
+    def _query_schedulers(self, schedulers):
+        if self._query_pool is None:
+            self._query_pool = multiprocessing.pool.ThreadPool(self._query_threads)
+        queries = []
+        for scheduler in schedulers:
+            name = get_daemon_name(scheduler)
+            query = self._scheduler_queries.get(name)
+            if query is None or query.ready():
+                query = self._scheduler_queries[name] = self._query_pool.apply_async(
+                    self._query_scheduler, (name, scheduler))
+            else:
+                _LOGGER.warning("the previous query of the jobs of scheduler %s has not finished yet." % name)
+            queries.append((name, query))
+
+        deadline = time.time() + self._query_deadline
+        jobinfolist = []
+        hosts_usage = {}
+        for name, query in queries:
+            try:
+                result = query.get(max(0, deadline - time.time()))
+                self._last_results[name] = (result, time.time())
+            except multiprocessing.TimeoutError:
+                _LOGGER.warning("timeout querying the jobs of scheduler %s." % name)
+                self._collector.invalidate(htcondor.DaemonTypes.Schedd)
+                result = self._get_last_result(name)
+            except Exception as e:
+                _LOGGER.warning("could not query the jobs of scheduler %s: %s" % (name, str(e)))
+                self._collector.invalidate(htcondor.DaemonTypes.Schedd)
+                result = self._get_last_result(name)
+            jobinfolist.extend(result[0])
+            for host, (cpus, memory) in result[1].items():
+                used_cpus, used_memory = hosts_usage.get(host, (0, 0))
+                hosts_usage[host] = (used_cpus + cpus, used_memory + memory)
+        return jobinfolist, hosts_usage
+
+    def _get_last_result(self, name):
+        if name not in self._last_results:
+            return [], {}
+        result, timestamp = self._last_results[name]
+        _LOGGER.warning("using the jobs of scheduler %s obtained %d seconds ago." %
+                        (name, time.time() - timestamp))
+        return result
+
+    # Streams the ads of the jobs of the local schedd that fulfill 'constraint'
+    def _query_local_schedd(self, constraint):
+        schedd = self._schedds.get(None)
+        if schedd is None:
+            schedd = self._schedds[None] = htcondor.Schedd()
+        return schedd.xquery(constraint, self._job_attributes)
+
+    # Obtains the JobInfo of the jobs of the local schedd and the cpus and memory
+    # used by them on each host from the model of its queue (or None if the
+    # model cannot be updated and it has never been reconciled)
+    def _get_scheduled_jobs_from_events(self):
+        try:
+            self._queue_model.update(self._query_local_schedd)
+        except Exception as e:
+            _LOGGER.warning("could not update the jobs from the event log: %s" % str(e))
+            self._queue_model.invalidate()
+            self._schedds.pop(None, None)
+            if self._scheduled_jobs is None:
+                return None
+            return self._scheduled_jobs
+        hosts_usage = HostUsageTable()
+        jobinfolist = list(generate_job_infos(
+            self._queue_model.get_jobs(), hosts_usage, self._aggregate_pending, "local"))
+        return jobinfolist, hosts_usage.get_usage()
+
+    # The event log only covers the local schedd, so the jobs of the rest of the
+    # schedulers of the pool are not monitored (it is logged when their number
+    # changes)
+    def _warn_remote_schedulers(self):
+        remote_schedulers = len(get_schedulers_list_from_Schedd(self._collector)) - 1
+        if remote_schedulers > 0 and remote_schedulers != self._remote_schedulers:
+            _LOGGER.warning("the jobs are obtained from the event log of the local schedd, so the jobs of the "
+                            "other %d schedulers are ignored." % remote_schedulers)
+        self._remote_schedulers = remote_schedulers
+
+    # Obtains the JobInfo of the jobs of all the schedulers and the cpus and
+    # memory used by them on each host (or None if there are no schedulers).
+    # The schedulers are queried once per monitoring pass (i.e. while the
+    # snapshot is not expired), so the node and job monitoring share the query
+    def _get_scheduled_jobs(self):
+        now = time.time()
+        if self._snapshot_timestamp is None or now - self._snapshot_timestamp > self._snapshot_ttl:
+            scheduled_jobs = None
+            if self._queue_model is not None:
+                self._warn_remote_schedulers()
+                scheduled_jobs = self._get_scheduled_jobs_from_events()
+            else:
+                schedulers = get_schedulers_list_from_Schedd(self._collector)
+                if len(schedulers) > 0:
+                    scheduled_jobs = self._query_schedulers(schedulers)
+            self._scheduled_jobs = scheduled_jobs
+            self._snapshot_timestamp = now
+        return self._scheduled_jobs
+
+    # Obtains a dictionary with the cpus and memory used by the jobs on each
+    # host (from RemoteHost or AllRemoteHosts), indexed by host
+    def _get_hosts_usage(self):
+        scheduled_jobs = self._get_scheduled_jobs()
+        if scheduled_jobs is None:
+            return {}
+        return scheduled_jobs[1]
+
     def get_nodeinfolist(self):
+        # The usage of the machines may be obtained only from the collector,
+        # without querying the jobs of the schedulers
+        if self._nodes_from_startd_ads:
+            slots = get_slots_list_from_Startd(self._collector)
+            if len(slots) > 0:
+                return get_machines_nodeinfolist(slots)
         nodeinfolist = {}
-        worker_nodes = get_worker_nodes_list_from_Startd()
+        worker_nodes = get_worker_nodes_list_from_Startd(self._collector)
         if len(worker_nodes) > 0:
             for worker_node in worker_nodes:
                 activity = ""
@@ -143,39 +771,9 @@ class lrms(clueslib.platform.LRMS):
                         memory = 0
                     memory_free = memory
                     keywords['hostname'] = TypedClass.auto(name)
-                    schedulers = get_schedulers_list_from_Schedd()
-                    if len(schedulers) > 0:
-                        for scheduler in schedulers:
-                            jobs_scheduled = htcondor.Schedd(scheduler)
-                            jobs_scheduled_attributes = jobs_scheduled.query()
-
-                            if len(jobs_scheduled_attributes) > 0:
-                                for job_scheduled_attributes in jobs_scheduled_attributes:
-                                    nodes = []
-                                    try:
-                                        nodes = job_scheduled_attributes[
-                                            "AllRemoteHosts"].split(",")
-                                    except:
-                                        try:
-                                            nodes = [
-                                                job_scheduled_attributes["RemoteHost"]]
-                                        except:
-                                            nodes = []
-                                    if name in nodes:
-                                        cpus = 0
-                                        try:
-                                            cpus = job_scheduled_attributes[
-                                                "RequestCpus"]
-                                        except:
-                                            cpus = 0
-                                        slots_free -= cpus
-                                        mem = 0
-                                        try:
-                                            mem = (
-                                                job_scheduled_attributes["ImageSize"] + 1023) / 1024
-                                        except:
-                                            mem = 0
-                                        memory_free -= mem
+                    cpus, mem = self._get_hosts_usage().get(name, (0, 0))
+                    slots_free -= cpus
+                    memory_free -= mem
                     queues = ["default"]
                     if len(queues) > 0:
                         keywords['queues'] = TypedList(
@@ -218,63 +816,11 @@ class lrms(clueslib.platform.LRMS):
         return nodeinfolist
 
     def get_jobinfolist(self):
-        jobinfolist = []
-        schedulers = get_schedulers_list_from_Schedd()
-        if len(schedulers) > 0:
-            for scheduler in schedulers:
-                jobs_scheduled = htcondor.Schedd(scheduler)
-                jobs_scheduled_attributes = jobs_scheduled.query()
-                if len(jobs_scheduled_attributes) > 0:
-                    for job_scheduled_attributes in jobs_scheduled_attributes:
-                        cpus_per_task = 0.0
-                        try:
-                            cpus_per_task = float(
-                                job_scheduled_attributes["RequestCpus"])
-                        except:
-                            cpus_per_task = 0.0
-                        memory = 0
-                        try:
-                            memory = (
-                                job_scheduled_attributes["ImageSize"] + 1023) / 1024
-                        except:
-                            memory = 0
-                        queue = '"default" in queues'
-                        nodes = []
-                        numnodes = 0
-                        try:
-                            nodes = job_scheduled_attributes[
-                                "AllRemoteHosts"].split(",")
-                            numnodes = len(nodes)
-                        except:
-                            try:
-                                nodes = [
-                                    job_scheduled_attributes["RemoteHost"]]
-                                numnodes = 1
-                            except:
-                                nodes = []
-                                numnodes = job_scheduled_attributes["MinHosts"]
-                        job_id = ""
-                        try:
-                            cluster_id = job_scheduled_attributes["ClusterId"]
-                            proc_id = job_scheduled_attributes["ProcId"]
-                            job_id = str(cluster_id) + "." + str(proc_id)
-                        except:
-                            job_id = ""
-                        state = ""
-                        try:
-                            job_st = job_scheduled_attributes["JobStatus"]
-                            state = infer_clues_job_state(job_st)
-                        except:
-                            state = clueslib.request.Request.PENDING
-                        resources = clueslib.request.ResourcesNeeded(
-                            cpus_per_task, memory, [queue], numnodes)
-                        j = clueslib.request.JobInfo(resources, job_id, nodes)
-                        j.set_state(state)
-                        jobinfolist.append(j)
-        else:
+        scheduled_jobs = self._get_scheduled_jobs()
+        if scheduled_jobs is None:
             _LOGGER.warning("could not obtain information about jobs.")
             return None
-        return jobinfolist
+        return list(scheduled_jobs[0])
 
 
 if __name__ == '__main__':
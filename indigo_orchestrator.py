@@ -28,6 +28,8 @@ import json
 import logging
 import base64
 import requests
+import multiprocessing.pool
+from requests.packages.urllib3.util.retry import Retry
 
 import cpyutils.db
 import cpyutils.config
@@ -123,6 +125,49 @@ class powermanager(PowerManager):
         def recovered(self):
             self.timestamp_recovered = cpyutils.eventloop.now()
 
+    class ResourceSnapshot:
+        # Resources of the deployment obtained from the orchestrator, that are shared
+        # by all the operations until they expire or the deployment is modified
+
+        def __init__(self, ttl):
+            self.ttl = ttl
+            self.resources = None
+            self.timestamp = 0
+
+        def get(self):
+            if self.resources is None or cpyutils.eventloop.now() - self.timestamp >= self.ttl:
+                return None
+            return self.resources
+
+        def update(self, resources):
+            self.resources = resources
+            self.timestamp = cpyutils.eventloop.now()
+
+        def invalidate(self):
+            self.resources = None
+
+    class PowerOnOperation:
+        # Power on operation whose VM has been requested to the orchestrator, but
+        # it has not been assigned to the node yet
+
+        INITIAL_DELAY = 2
+        MAX_DELAY = 30
+
+        def __init__(self, node_name, previous_uuids):
+            self.node_name = node_name
+            # UUIDs of the VMs of the deployment before the modification
+            self.previous_uuids = previous_uuids
+            self.timestamp_started = cpyutils.eventloop.now()
+            self.delay = self.INITIAL_DELAY
+            self.next_check = self.timestamp_started + self.delay
+
+        def backoff(self):
+            self.delay = min(self.delay * 2, self.MAX_DELAY)
+            self.next_check = cpyutils.eventloop.now() + self.delay
+
+        def __str__(self):
+            return "Power On on %s" % self.node_name
+
     def __init__(self):
         #
         # NOTE: This fragment provides the support for global config files. It is a bit awful.
@@ -139,9 +184,18 @@ class powermanager(PowerManager):
                 "INDIGO_ORCHESTRATOR_DROP_FAILING_VMS": 600,
                 "INDIGO_ORCHESTRATOR_DB_CONNECTION_STRING": "sqlite:///var/lib/clues2/clues.db",
                 "INDIGO_ORCHESTRATOR_PAGE_SIZE": 20,
+                "INDIGO_ORCHESTRATOR_MAX_PAGE_SIZE": 100,
+                "INDIGO_ORCHESTRATOR_PAGE_THREADS": 4,
+                "INDIGO_ORCHESTRATOR_PAGE_RETRIES": 2,
+                "INDIGO_ORCHESTRATOR_RESOURCES_TTL": 10,
+                "INDIGO_ORCHESTRATOR_POWER_ON_TIMEOUT": 180,
                 "INDIGO_ORCHESTRATOR_AUTH_DATA": "",
                 "INDIGO_ORCHESTRATOR_CLIENT_ID": "",
-                "INDIGO_ORCHESTRATOR_CLIENT_SECRET": ""
+                "INDIGO_ORCHESTRATOR_CLIENT_SECRET": "",
+                "INDIGO_ORCHESTRATOR_POOL_SIZE": 10,
+                "INDIGO_ORCHESTRATOR_CONNECT_TIMEOUT": 10,
+                "INDIGO_ORCHESTRATOR_READ_TIMEOUT": 60,
+                "INDIGO_ORCHESTRATOR_RETRIES": 3
             }
         )
 
@@ -151,14 +205,29 @@ class powermanager(PowerManager):
         self._INDIGO_ORCHESTRATOR_FORGET_MISSING_VMS = config_indigo.INDIGO_ORCHESTRATOR_FORGET_MISSING_VMS
         self._INDIGO_ORCHESTRATOR_DROP_FAILING_VMS = config_indigo.INDIGO_ORCHESTRATOR_DROP_FAILING_VMS
         self._INDIGO_ORCHESTRATOR_PAGE_SIZE = config_indigo.INDIGO_ORCHESTRATOR_PAGE_SIZE
+        self._INDIGO_ORCHESTRATOR_POWER_ON_TIMEOUT = config_indigo.INDIGO_ORCHESTRATOR_POWER_ON_TIMEOUT
+        self._INDIGO_ORCHESTRATOR_MAX_PAGE_SIZE = config_indigo.INDIGO_ORCHESTRATOR_MAX_PAGE_SIZE
+        self._INDIGO_ORCHESTRATOR_PAGE_THREADS = config_indigo.INDIGO_ORCHESTRATOR_PAGE_THREADS
+        self._INDIGO_ORCHESTRATOR_PAGE_RETRIES = config_indigo.INDIGO_ORCHESTRATOR_PAGE_RETRIES
+        # The page size is adapted to the size of the deployment
+        self._page_size = self._INDIGO_ORCHESTRATOR_PAGE_SIZE
+        self._page_pool = None
+        self._resources_snapshot = self.ResourceSnapshot(config_indigo.INDIGO_ORCHESTRATOR_RESOURCES_TTL)
         self._auth_data = config_indigo.INDIGO_ORCHESTRATOR_AUTH_DATA
         self._client_id = config_indigo.INDIGO_ORCHESTRATOR_CLIENT_ID
         self._client_secret = config_indigo.INDIGO_ORCHESTRATOR_CLIENT_SECRET
         self._refresh_token = None
+        self._INDIGO_ORCHESTRATOR_POOL_SIZE = config_indigo.INDIGO_ORCHESTRATOR_POOL_SIZE
+        self._INDIGO_ORCHESTRATOR_RETRIES = config_indigo.INDIGO_ORCHESTRATOR_RETRIES
+        self._timeout = (config_indigo.INDIGO_ORCHESTRATOR_CONNECT_TIMEOUT,
+                         config_indigo.INDIGO_ORCHESTRATOR_READ_TIMEOUT)
+        self._session = None
 
         self._refresh_time_diff = 300
         self._inf_id = None
         self._master_nodes_ids = []
+        # Power on operations waiting for the new VMs to appear in the deployment
+        self._power_on_ops = []
         # Structure for the recovery of nodes
         self._db = cpyutils.db.DB.create_from_string(
             config_indigo.INDIGO_ORCHESTRATOR_DB_CONNECTION_STRING)
@@ -168,7 +237,7 @@ class powermanager(PowerManager):
 
         new_token = self._load_token()
         if new_token:
-            self._auth_data = new_token
+            self._set_auth_data(new_token)
 
         # Initially we get the refresh token and a new access token
         self._get_refresh_token()
@@ -208,12 +277,13 @@ class powermanager(PowerManager):
                 payload = ("client_id=%s&client_secret=%s&grant_type=urn%%3Aietf%%3Aparams%%3Aoauth%%3Agrant-type%%3A"
                            "token-exchange&subject_token=%s&scope=%s") % (self._client_id, self._client_secret,
                                                                           self._auth_data, token_scopes)
-                headers = {'content-type': 'application/x-www-form-urlencoded'}
-                resp = requests.request("POST", url, data=payload, headers=headers, verify=False)
+                # The bearer token of the session must not be sent to the token endpoint
+                headers = {'content-type': 'application/x-www-form-urlencoded', 'Authorization': None}
+                resp = self._request("POST", url, data=payload, headers=headers, verify=False)
                 if resp.status_code == 200:
                     info = resp.json()
                     self._refresh_token = info["refresh_token"]
-                    self._auth_data = info["access_token"]
+                    self._set_auth_data(info["access_token"])
                     self._save_token()
                     _LOGGER.debug("Refresh token successfully obtained")
                     return True
@@ -239,11 +309,12 @@ class powermanager(PowerManager):
                 payload = ("client_id=%s&client_secret=%s&grant_type=refresh_token&scope=%s"
                            "&refresh_token=%s") % (self._client_id, self._client_secret,
                                                    token_scopes, self._refresh_token)
-                headers = {'content-type': 'application/x-www-form-urlencoded'}
-                resp = requests.request("POST", url, data=payload, headers=headers, verify=False)
+                # The bearer token of the session must not be sent to the token endpoint
+                headers = {'content-type': 'application/x-www-form-urlencoded', 'Authorization': None}
+                resp = self._request("POST", url, data=payload, headers=headers, verify=False)
                 if resp.status_code == 200:
                     info = resp.json()
-                    self._auth_data = info["access_token"]
+                    self._set_auth_data(info["access_token"])
                     self._save_token()
                     _LOGGER.debug("Access token successfully refreshed.")
                     return True
@@ -289,6 +360,47 @@ class powermanager(PowerManager):
 
         return auth_header
 
+    def _get_session(self):
+        """
+        Get the HTTP session shared by all the requests of the plugin, that keeps
+        the connections alive and retries the failed ones
+        """
+        if self._session is None:
+            session = requests.Session()
+            # Only the GETs are retried (the PUTs and DELETEs are not idempotent for the
+            # orchestrator), and the last response is returned if the retries run out
+            retries = Retry(total=self._INDIGO_ORCHESTRATOR_RETRIES, backoff_factor=0.5,
+                            status_forcelist=[502, 503, 504], method_whitelist=frozenset(['GET']),
+                            raise_on_status=False)
+            adapter = requests.adapters.HTTPAdapter(pool_connections=self._INDIGO_ORCHESTRATOR_POOL_SIZE,
+                                                    pool_maxsize=self._INDIGO_ORCHESTRATOR_POOL_SIZE,
+                                                    max_retries=retries)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            auth = self._get_auth_header()
+            if auth:
+                session.headers.update(auth)
+            self._session = session
+        return self._session
+
+    def _set_auth_data(self, auth_data):
+        """
+        Set the access token and update the Authorization header of the HTTP session
+        """
+        self._auth_data = auth_data
+        session = self._get_session()
+        auth = self._get_auth_header()
+        if auth:
+            session.headers.update(auth)
+        else:
+            session.headers.pop('Authorization', None)
+
+    def _request(self, method, url, **kwargs):
+        """
+        Perform a HTTP request using the shared session and the configured (connect, read) timeouts
+        """
+        return self._get_session().request(method, url, timeout=self._timeout, **kwargs)
+
     def _get_inf_id(self):
         return self._INDIGO_ORCHESTRATOR_DEPLOY_ID
 
@@ -326,16 +438,47 @@ class powermanager(PowerManager):
 
     def _get_resources_page(self, page=0):
         inf_id = self._get_inf_id()
-        headers = {'Accept': 'application/json',
-                   'Content-Type': 'application/json', 'Connection': 'close'}
-        auth = self._get_auth_header()
-        if auth:
-            headers.update(auth)
+        headers = {'Accept': 'application/json', 'Content-Type': 'application/json'}
         url = "%s/%s" % (self._INDIGO_ORCHESTRATOR_URL, "deployments/%s/resources?size=%d&page=%d" %
-                         (inf_id, self._INDIGO_ORCHESTRATOR_PAGE_SIZE, page))
-        resp = requests.request("GET", url, headers=headers)
+                         (inf_id, self._page_size, page))
+        resp = self._request("GET", url, headers=headers)
         return resp.status_code, resp.text
 
+    def _get_resources_page_content(self, page):
+        """
+        Get the decoded contents of a page of resources, retrying it on its own
+        up to INDIGO_ORCHESTRATOR_PAGE_RETRIES times. Returns None if it fails
+        """
+        error = None
+        for retry in range(self._INDIGO_ORCHESTRATOR_PAGE_RETRIES + 1):
+            try:
+                status, output = self._get_resources_page(page)
+                if status == 200:
+                    return json.loads(output)
+                error = output
+            except Exception as ex:
+                error = ex
+            _LOGGER.debug("Error getting deployment info page %d (attempt %d): %s" % (page, retry + 1, str(error)))
+
+        _LOGGER.error("ERROR getting deployment info: %s, page %d" % (str(error), page))
+        return None
+
+    def _get_page_pool(self):
+        if self._page_pool is None:
+            self._page_pool = multiprocessing.pool.ThreadPool(self._INDIGO_ORCHESTRATOR_PAGE_THREADS)
+        return self._page_pool
+
+    def _adapt_page_size(self, page_info):
+        """
+        Set the page size for the next queries so that the whole deployment fits
+        in a single page, up to INDIGO_ORCHESTRATOR_MAX_PAGE_SIZE resources
+        """
+        if 'totalElements' in page_info:
+            size = max(self._INDIGO_ORCHESTRATOR_PAGE_SIZE,
+                       page_info['totalElements'] + self._INDIGO_ORCHESTRATOR_PAGE_SIZE)
+            self._page_size = min(size, max(self._INDIGO_ORCHESTRATOR_MAX_PAGE_SIZE,
+                                            self._INDIGO_ORCHESTRATOR_PAGE_SIZE))
+
     def _get_resources(self):
         try:
             status, output = self._get_resources_page()
@@ -346,20 +489,22 @@ class powermanager(PowerManager):
                               str(output))
             else:
                 res = json.loads(output)
-                if 'content' in res:
-                    resources.extend(res['content'])
-
-                if 'page' in res and res['page']['totalPages'] > 1:
-                    for page in range(1, res['page']['totalPages']):
-                        status, output = self._get_resources_page(page)
-
-                        if status != 200:
-                            _LOGGER.error(
-                                "ERROR getting deployment info: %s, page %d" % (str(output), page))
-                        else:
-                            res = json.loads(output)
-                            if 'content' in res:
-                                resources.extend(res['content'])
+                pages = [res]
+                if 'page' in res:
+                    if res['page']['totalPages'] > 1:
+                        # The rest of pages are obtained concurrently (and merged in order)
+                        pages.extend(self._get_page_pool().map(self._get_resources_page_content,
+                                                               range(1, res['page']['totalPages'])))
+                    self._adapt_page_size(res['page'])
+
+                # A partial list of resources would be taken as the whole deployment
+                if None in pages:
+                    _LOGGER.error("ERROR getting deployment info: some pages could not be obtained.")
+                    return []
+
+                for res in pages:
+                    if res and 'content' in res:
+                        resources.extend(res['content'])
 
                 return [resource for resource in resources if resource['toscaNodeType'] == "tosca.nodes.indigo.Compute" and 
                         not resource["toscaNodeName"].startswith("indigovr")]
@@ -369,9 +514,24 @@ class powermanager(PowerManager):
             _LOGGER.exception("ERROR getting deployment info.")
             return []
 
+    def _get_current_resources(self, refresh=False):
+        """
+        Get the resources of the deployment from the current snapshot, obtaining
+        them from the orchestrator if it has expired or if refresh is True
+        """
+        resources = None
+        if not refresh:
+            resources = self._resources_snapshot.get()
+        if resources is None:
+            resources = self._get_resources()
+            # Do not keep the errors in the snapshot
+            if resources:
+                self._resources_snapshot.update(resources)
+        return resources
+
     def _get_vms(self):
         now = cpyutils.eventloop.now()
-        resources = self._get_resources()
+        resources = self._get_current_resources()
 
         if not resources:
             _LOGGER.warning("No resources obtained from orchestrator.")
@@ -403,9 +563,13 @@ class powermanager(PowerManager):
                         node_name = self._get_nodename_from_uuid(vm.vm_id)
 
                         if not node_name:
-                            _LOGGER.error(
-                                "No node name obtained for VM ID: %s" % vm.vm_id)
-                            self._add_task(self.POWER_OFF, vm.vm_id)
+                            if self._power_on_ops:
+                                _LOGGER.debug("VM ID %s not assigned yet. It may belong to a pending power on "
+                                              "operation." % vm.vm_id)
+                            else:
+                                _LOGGER.error(
+                                    "No node name obtained for VM ID: %s" % vm.vm_id)
+                                self._add_task(self.POWER_OFF, vm.vm_id)
                         else:
                             # The VM is OK
                             if node_name not in self._mvs_seen:
@@ -526,6 +690,8 @@ class powermanager(PowerManager):
             monitoring_info = self._clues_daemon.get_monitoring_info()
             now = cpyutils.eventloop.now()
 
+            # Assign the new VMs to their nodes before checking the unknown ones
+            self._check_power_on_ops()
             vms = self._get_vms()
 
             recover = []
@@ -653,12 +819,9 @@ class powermanager(PowerManager):
 
     def _get_deployment_status(self):
         inf_id = self._get_inf_id()
-        headers = {'Accept': 'application/json', 'Connection': 'close'}
-        auth = self._get_auth_header()
-        if auth:
-            headers.update(auth)
+        headers = {'Accept': 'application/json'}
         url = "%s/%s" % (self._INDIGO_ORCHESTRATOR_URL, "deployments/%s" % inf_id)
-        resp = requests.request("GET", url, headers=headers)
+        resp = self._request("GET", url, headers=headers)
 
         if resp.status_code != 200:
             _LOGGER.error("ERROR getting deployment status: %s (%d)" %
@@ -674,37 +837,43 @@ class powermanager(PowerManager):
     def _modify_deployment(self, current_uuids, remove_nodes=[], add_nodes=[]):
         inf_id = self._get_inf_id()
 
-        headers = {'Accept': 'application/json', 'Connection': 'close', 'Content-Type': 'application/json'}
-        auth = self._get_auth_header()
-        if auth:
-            headers.update(auth)
+        headers = {'Accept': 'application/json', 'Content-Type': 'application/json'}
 
         template = self._get_template(len(current_uuids), remove_nodes, add_nodes)
         _LOGGER.debug("template: " + template)
         body = '{ "template": "%s" }' % template.replace('"', '\\"').replace('\n', '\\n')
 
         url = "%s/%s" % (self._INDIGO_ORCHESTRATOR_URL, "deployments/%s" % inf_id)
-        resp = requests.request("PUT", url, headers=headers, data=body)
+        resp = self._request("PUT", url, headers=headers, data=body)
+        if resp.status_code in [200, 201, 202, 204]:
+            # The resources of the deployment are going to change
+            self._resources_snapshot.invalidate()
         return resp.status_code, resp.text
 
     def power_on(self, nname):
         vms = self._mvs_seen
-        if len(vms) >= self._INDIGO_ORCHESTRATOR_MAX_INSTANCES:
+        if len(vms) + len(self._power_on_ops) >= self._INDIGO_ORCHESTRATOR_MAX_INSTANCES:
             _LOGGER.debug(
-                "There are %d VMs running, we are at the maximum number. Do not power on %s." % (len(vms), nname))
+                "There are %d VMs running, we are at the maximum number. Do not power on %s." % (
+                    len(vms) + len(self._power_on_ops), nname))
             return False, nname
 
         if nname in vms:
             _LOGGER.warning("Trying to launch an existing node %s. Ignoring it." % nname)
             return True, nname
 
+        if nname in [op.node_name for op in self._power_on_ops]:
+            _LOGGER.debug("Node %s is already being powered on. Ignoring it." % nname)
+            return True, nname
+
         self._add_task(self.POWER_ON, nname)
         return True, nname
 
     def _power_on(self, node_name):
         try:
-            # Get the list of resources before the modification
-            resources = self._get_resources()
+            # Get the current list of resources before the modification (not the one of the
+            # snapshot, that may miss the VMs of previous operations)
+            resources = self._get_current_resources(refresh=True)
             masters = self._get_master_node_id(resources)
             current_uuids = [resource['uuid'] for resource in resources if resource['uuid'] not in masters]
             resp_status, output = self._modify_deployment(current_uuids, add_nodes=[node_name])
@@ -714,44 +883,57 @@ class powermanager(PowerManager):
                 return False
             else:
                 _LOGGER.debug("Node %s successfully created" % node_name)
-                # res = json.loads(output)
-
-                # wait to assure the orchestrator process the operation
-                delay = 2
-                wait = 0
-                timeout = 180
-                new_uuids = []
-                while not new_uuids and wait < timeout:
-                    # Get the list of resources now to get the new vm added
-                    resources = self._get_resources()
-                    for resource in resources:
-                        if (resource['uuid'] not in self._get_master_node_id(resources) and
-                                resource['uuid'] not in current_uuids):
-                            new_uuids.append(resource['uuid'])
-                    if len(new_uuids) < 1:
-                        time.sleep(delay)
-                        wait += delay
-
-                if len(new_uuids) < 1:
-                    _LOGGER.warning("Trying to get the uuids of the new node and get no new uuids!!")
-                else:
-                    if len(new_uuids) != 1:
-                        _LOGGER.warning("Trying to get the uuids of the new node and get %d uuids!!."
-                                        " Assuming it is the first one." % len(new_uuids))
-
-                    _LOGGER.debug("Node: %s assigned to VM: %s." % (node_name, new_uuids[0]))
-                    self._add_mvs_seen(node_name, self.VM_Node(new_uuids[0]))
-                    return True
+                # The new VM will be assigned to the node in the next lifecycles,
+                # once the orchestrator has processed the operation
+                self._power_on_ops.append(self.PowerOnOperation(node_name, current_uuids))
+                return True
         except:
             _LOGGER.exception("Error launching node %s " % node_name)
             return False
 
+    def _check_power_on_ops(self):
+        """
+        Assign the new VMs of the deployment to the nodes of the pending power on
+        operations, and drop the operations that have exceeded the timeout. The VM
+        of an operation is the one that was not in the deployment before it, but
+        was before the later operations
+        """
+        now = cpyutils.eventloop.now()
+        ops = [op for op in self._power_on_ops if now >= op.next_check]
+        if not ops:
+            return
+
+        resources = self._get_current_resources(refresh=True)
+        masters = self._get_master_node_id(resources)
+        uuids = [resource['uuid'] for resource in resources
+                 if resource['uuid'] not in masters and not self._get_nodename_from_uuid(resource['uuid'])]
+        for op in ops:
+            later_ops = self._power_on_ops[self._power_on_ops.index(op) + 1:]
+            new_uuids = [uuid for uuid in uuids if uuid not in op.previous_uuids and
+                         all(uuid in later_op.previous_uuids for later_op in later_ops)]
+
+            if len(new_uuids) > 1:
+                # Do not guess: the node stays pending until the timeout
+                _LOGGER.warning("Trying to get the uuid of the new node %s and get %d uuids!!."
+                                " They cannot be told apart." % (op.node_name, len(new_uuids)))
+
+            if len(new_uuids) == 1:
+                _LOGGER.debug("Node: %s assigned to VM: %s." % (op.node_name, new_uuids[0]))
+                self._add_mvs_seen(op.node_name, self.VM_Node(new_uuids[0]))
+                self._power_on_ops.remove(op)
+            elif now - op.timestamp_started > self._INDIGO_ORCHESTRATOR_POWER_ON_TIMEOUT:
+                _LOGGER.warning("Trying to get the uuids of the new node and get no new uuids!!")
+                _LOGGER.error("Error processing task: %s. Timeout waiting for the new VM." % op)
+                self._power_on_ops.remove(op)
+            else:
+                op.backoff()
+
     def _power_off(self, node_list):
         try:
             vms = self._get_vms()
 
             # We have to check if the node has been deleted yet to avoid try to delete again
-            resources = self._get_resources()
+            resources = self._get_current_resources()
             masters = self._get_master_node_id(resources)
             current_uuids = [resource['uuid'] for resource in resources if resource['uuid'] not in masters]
             to_delete = []
@@ -784,13 +966,10 @@ class powermanager(PowerManager):
 
     def _get_template(self, count, remove_nodes, add_nodes):
         inf_id = self._get_inf_id()
-        headers = {'Accept': 'text/plain', 'Connection': 'close'}
-        auth = self._get_auth_header()
-        if auth:
-            headers.update(auth)
+        headers = {'Accept': 'text/plain'}
 
         url = "%s/%s" % (self._INDIGO_ORCHESTRATOR_URL, "deployments/%s/template" % inf_id)
-        resp = requests.request("GET", url, headers=headers)
+        resp = self._request("GET", url, headers=headers)
 
         if resp.status_code != 200:
             _LOGGER.error("ERROR getting deployment template: %s" %
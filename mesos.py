@@ -16,9 +16,19 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
 import socket
 import subprocess
 import json
+import time
+import shlex
+import urlparse
+import threading
+import StringIO
+import array
+import requests
+import multiprocessing
+import multiprocessing.pool
 import cpyutils.config
 import clueslib.helpers as Helpers
 
@@ -28,8 +38,30 @@ from clueslib.node import NodeInfo
 from clueslib.platform import LRMS
 from clueslib.request import Request, ResourcesNeeded, JobInfo
 
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import ujson as fast_json
+except ImportError:
+    try:
+        import simplejson as fast_json
+    except ImportError:
+        fast_json = json
+
 _LOGGER = Log("PLUGIN-MESOS")
 
+MARATHON_COMMAND = "/usr/bin/curl -L -X GET http://mesosserverpublic:8080/v2/apps?embed=tasks"
+# With the launch queue the tasks of the apps are not needed, so a lighter listing is used by default
+MARATHON_COUNTS_COMMAND = "/usr/bin/curl -L -X GET http://mesosserverpublic:8080/v2/apps?embed=apps.counts"
+
 
 def run_command(command):
     if command:
@@ -51,10 +83,14 @@ def run_command(command):
             raise Exception(message)
 
 
-def curl_command(command, server_ip, error_message, is_json=True):
+def curl_command(command, server_ip, error_message, is_json=True, timeout=None):
     result = None
     try:
-        result = run_command(command.split(" "))
+        args = shlex.split(command)
+        # run_command waits for the command without limit, so the maximum time of the transfer is bounded in curl
+        if timeout and args and os.path.basename(args[0]) == "curl" and "-m" not in args and "--max-time" not in args:
+            args = args[:1] + ["--max-time", str(timeout)] + args[1:]
+        result = run_command(args)
         if result:
             if is_json:
                 return json.loads(result)
@@ -67,6 +103,204 @@ def curl_command(command, server_ip, error_message, is_json=True):
         _LOGGER.error(message)
 
 
+def get_command_url(command):
+    ''' Obtains the URL queried by a command such as "/usr/bin/curl -L -X GET http://server:5050/master/slaves"
+    (a plain URL is also accepted)
+    '''
+    for arg in shlex.split(command):
+        if arg.startswith("http://") or arg.startswith("https://"):
+            return arg
+    return None
+
+
+def get_command_request(command):
+    ''' Obtains the URL and the options of the HTTP request (as keyword arguments of requests) equivalent to a
+    curl command such as '/usr/bin/curl -L -X GET -u user:pass -H "Accept: application/json" http://server:5050/'
+    (a plain URL is also accepted). The supported curl options are -L, -s, -S, -X GET, -u, -H, -k and --cacert.
+    It returns None if the command cannot be translated (e.g. it has any other option)
+    '''
+    args = shlex.split(command)
+    if args and not args[0].startswith("http://") and not args[0].startswith("https://"):
+        if os.path.basename(args[0]) != "curl":
+            return None
+        args = args[1:]
+
+    url = None
+    options = {}
+    index = 0
+    while index < len(args):
+        arg = args[index]
+        if arg.startswith("http://") or arg.startswith("https://"):
+            url = arg
+        elif arg in ["--location", "--silent", "--show-error"]:
+            pass
+        elif arg == "--insecure" or (len(arg) > 1 and arg[0] == "-" and not arg[1:].strip("LsSk")):
+            # Short flags may be combined (e.g. -sSLk)
+            if arg == "--insecure" or "k" in arg:
+                options['verify'] = False
+        elif arg in ["-X", "--request", "-u", "--user", "-H", "--header", "--cacert"] and index + 1 < len(args):
+            index += 1
+            value = args[index]
+            if arg in ["-X", "--request"]:
+                if value.upper() != "GET":
+                    return None
+            elif arg in ["-u", "--user"]:
+                user, _, password = value.partition(":")
+                options['auth'] = (user, password)
+            elif arg in ["-H", "--header"]:
+                name, _, header_value = value.partition(":")
+                options.setdefault('headers', {})[name.strip()] = header_value.strip()
+            elif options.get('verify') is not False:
+                options['verify'] = value
+        else:
+            return None
+        index += 1
+
+    if url is None:
+        return None
+    return url, options
+
+
+def create_http_session(pool_size):
+    ''' Creates a HTTP session that keeps alive up to 'pool_size' connections per server '''
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def http_command(session, command, server_ip, error_message, is_json=True, timeout=None, leader=None, parser=None):
+    ''' Equivalent to curl_command, but performs the query in-process using the HTTP session 'session'
+    (the responses are gzip-compressed if the server supports it). The queries to the Mesos master are sent
+    to the leading master located by 'leader', if it is provided. If a 'parser' is provided, the response is
+    streamed to it (as a file-like object) instead of being read at once
+    '''
+    response = None
+    try:
+        request = get_command_request(command)
+        if not request:
+            raise Exception("UNSUPPORTED_COMMAND=" + str(get_command_url(command)))
+        url, options = request
+        if parser:
+            options['stream'] = True
+        if leader is not None:
+            response = leader.get(session, url, timeout, **options)
+        else:
+            response = session.get(url, timeout=timeout, **options)
+        if response.status_code != 200:
+            raise Exception("STATUS_CODE=" + str(response.status_code))
+        if parser:
+            response.raw.decode_content = True
+            return parser(response.raw)
+        if is_json:
+            return response.json()
+        else:
+            return response.text
+    except Exception as exception:
+        message = str(exception) + ';ERROR=' + error_message.rstrip('\n') + ';SERVER_IP=' + server_ip.rstrip('\n')
+        if response is not None and response.text:
+            message += ';COMMAND_OUTPUT=' + response.text.rstrip('\n') + ''
+        _LOGGER.error(message)
+
+
+def get_server_url(command, path):
+    ''' Obtains the URL of the path 'path' in the server queried by a command '''
+    url = urlparse.urlparse(get_command_url(command))
+    return "%s://%s%s" % (url.scheme, url.netloc, path)
+
+
+def read_recordio(stream):
+    ''' Generator of the JSON records of a RecordIO stream, where each record is preceded by its length
+    in bytes and a newline character, read from the file-like object 'stream'
+    '''
+    while True:
+        length = ""
+        char = stream.read(1)
+        while char and char != "\n":
+            length += char
+            char = stream.read(1)
+        if not char:
+            return
+        record = ""
+        while len(record) < int(length):
+            data = stream.read(int(length) - len(record))
+            if not data:
+                return
+            record += data
+        yield json.loads(record)
+
+
+def read_server_sent_events(lines):
+    ''' Generator of the (event type, JSON data) of the server-sent events of a stream, given its lines '''
+    event_type = None
+    data = []
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if not line:
+            if data:
+                yield event_type, json.loads("\n".join(data))
+            event_type = None
+            data = []
+        elif line.startswith("event:"):
+            event_type = line[6:].strip()
+        elif line.startswith("data:"):
+            data.append(line[5:].strip())
+
+
+def get_v1_resources(resources):
+    ''' Obtains a dictionary like {'cpus': 1.0, 'mem': 512.0} from a list of resources of the Mesos v1 API '''
+    result = {'cpus': 0.0, 'mem': 0.0}
+    for resource in resources:
+        if resource['name'] in result and 'scalar' in resource:
+            result[resource['name']] += resource['scalar']['value']
+    return result
+
+
+def project_mesos_state(mesos_state):
+    ''' Obtains the fields of the frameworks used by CLUES from the state of the Mesos server, like
+    {'frameworks': [{'name': ..., 'id': ..., 'resources': {'cpus': ..., 'mem': ...},
+    'tasks': [{'state': ..., 'slave_id': ...}]}]}
+    '''
+    frameworks = []
+    for framework in mesos_state.get('frameworks', []):
+        resources = framework.get('resources', {})
+        frameworks.append({'name': framework.get('name'), 'id': framework.get('id'),
+                           'resources': {'cpus': resources.get('cpus', 0), 'mem': resources.get('mem', 0)},
+                           'tasks': [{'state': task.get('state'), 'slave_id': task.get('slave_id')}
+                                     for task in framework.get('tasks', [])]})
+    return {'frameworks': frameworks}
+
+
+def parse_mesos_state(stream):
+    ''' Obtains the projection of the state of the Mesos server (see project_mesos_state) from the file-like
+    object 'stream'. If ijson is available, the document is parsed incrementally and only the projected fields
+    are kept in memory
+    '''
+    if ijson is None:
+        return project_mesos_state(fast_json.load(stream))
+
+    frameworks = []
+    framework = None
+    task = None
+    for prefix, event, value in ijson.parse(stream):
+        if not prefix.startswith("frameworks.item"):
+            continue
+        if prefix == "frameworks.item" and event == "start_map":
+            framework = {'name': None, 'id': None, 'resources': {'cpus': 0, 'mem': 0}, 'tasks': []}
+            frameworks.append(framework)
+        elif prefix == "frameworks.item.tasks.item" and event == "start_map":
+            task = {'state': None, 'slave_id': None}
+            framework['tasks'].append(task)
+        elif prefix in ("frameworks.item.name", "frameworks.item.id"):
+            framework[prefix[16:]] = value
+        elif prefix in ("frameworks.item.resources.cpus", "frameworks.item.resources.mem"):
+            framework['resources'][prefix[26:]] = float(value)
+        elif prefix in ("frameworks.item.tasks.item.state", "frameworks.item.tasks.item.slave_id"):
+            task[prefix[27:]] = value
+    return {'frameworks': frameworks}
+
+
 def infer_mesos_job_state(job_state):
     ''' Determines the equivalent node_state between Mesos tasks and Clues2 possible job states
     MESOS job states: TASK_RUNNING, TASK_PENDING, TASK_KILLED, TASK_FINISHED
@@ -85,6 +319,19 @@ def infer_chronos_job_state(job_state):
     return Request.PENDING if job_state == 'queued' else Request.ATTENDED
 
 
+def parse_chronos_jobs_state(lines):
+    ''' Obtains a dictionary with the CLUES2 job state of each Chronos job, indexed by job name, from the lines of
+    the Chronos graph CSV (any iterable of lines, such as a file-like object). The jobs are described by lines
+    like "node,jobName,lastRunStatus,currentState" and the dependencies by lines like "link,parentJob,childJob"
+    '''
+    jobs_state = {}
+    for line in lines:
+        properties = line.split(",")
+        if len(properties) > 3 and properties[0] == "node" and properties[1] not in jobs_state:
+            jobs_state[properties[1]] = infer_chronos_job_state(properties[3].rstrip('\r\n'))
+    return jobs_state
+
+
 def infer_marathon_job_state(jobs, jobs_running):
     ''' Determines the equivalent state between Marathon jobs and Clues2 possible job states'''
     return Request.ATTENDED if jobs and jobs_running > 0 else Request.PENDING
@@ -111,6 +358,14 @@ def calculate_memory_bytes(memory):
     return memory * 1048576
 
 
+def get_slave_used_resources(mesos_slave):
+    ''' Obtains the cpu and mem used in a Mesos slave from the "used_resources" field of /master/slaves
+    (the "offered_resources" are not in use, so they are considered free, as Mesos keeps offering the idle ones)
+    '''
+    used_resources = mesos_slave.get('used_resources', {})
+    return float(used_resources.get('cpus', 0)), calculate_memory_bytes(used_resources.get('mem', 0))
+
+
 def open_file(file_path):
     try:
         file_read = open(file_path, 'r')
@@ -121,90 +376,712 @@ def open_file(file_path):
     return file_read
 
 
+class MesosSnapshot(object):
+    ''' Stores the documents obtained from Mesos, Marathon and Chronos (and the indexes derived from them)
+    during a monitoring pass, so each endpoint is queried only once while the snapshot is not expired
+    '''
+
+    def __init__(self, ttl):
+        self._ttl = ttl
+        self._timestamp = time.time()
+        self._documents = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def is_expired(self):
+        return time.time() - self._timestamp > self._ttl
+
+    def get(self, key, obtain):
+        '''Returns the document stored with the name 'key', calling 'obtain' the first time it is requested
+        (concurrent requests of the same document wait for the first one instead of obtaining it again)
+        '''
+        with self._lock:
+            key_lock = self._locks.setdefault(key, threading.Lock())
+        with key_lock:
+            if key not in self._documents:
+                self._documents[key] = obtain()
+        return self._documents[key]
+
+
+class HostnameResolver(object):
+    ''' Resolves hostnames in background, using a pool of threads, and caches the ips obtained during 'ttl' seconds
+    (and the failed resolutions during 'negative_ttl' seconds). The expired entries are refreshed in background
+    while their previous value is still returned. As the ips of the vnodes are recycled when they are re-created,
+    if several names share the same ip only the most recently resolved one keeps it (the rest are refreshed)
+    '''
+
+    def __init__(self, ttl, negative_ttl, threads):
+        self._ttl = ttl
+        self._negative_ttl = negative_ttl
+        self._threads = threads
+        self._pool = None
+        # name -> (ip, expiration, order of the resolution)
+        self._cache = {}
+        self._resolutions = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def _resolve(self, name):
+        try:
+            ip = socket.gethostbyname(name)
+            expiration = time.time() + self._ttl
+        except:
+            _LOGGER.warning("Error resolving node ip %s" % name)
+            ip = None
+            expiration = time.time() + self._negative_ttl
+        with self._lock:
+            self._resolutions += 1
+            self._cache[name] = (ip, expiration, self._resolutions)
+            del self._pending[name]
+        return ip
+
+    def resolve(self, names, timeout):
+        '''Returns a dictionary with the ip of the names that can be resolved, indexed by name. It waits at most
+        'timeout' seconds for the names that have never been resolved
+        '''
+        now = time.time()
+        waiting = []
+        with self._lock:
+            for name in names:
+                cached = self._cache.get(name)
+                if (cached is None or cached[1] < now) and name not in self._pending:
+                    if self._pool is None:
+                        self._pool = multiprocessing.pool.ThreadPool(self._threads)
+                    self._pending[name] = self._pool.apply_async(self._resolve, (name,))
+                if cached is None:
+                    waiting.append(self._pending[name])
+
+        deadline = now + timeout
+        for result in waiting:
+            try:
+                result.get(max(0, deadline - time.time()))
+            except multiprocessing.TimeoutError:
+                _LOGGER.warning("Timeout resolving the ips of the nodes. They are resolved in background")
+                break
+
+        owners = {}
+        with self._lock:
+            for name in names:
+                cached = self._cache.get(name)
+                if cached and cached[0]:
+                    owner = owners.get(cached[0])
+                    if owner is None or self._cache[owner][2] < cached[2]:
+                        owners[cached[0]] = name
+            for name in names:
+                cached = self._cache.get(name)
+                if cached and cached[0] and owners[cached[0]] != name:
+                    _LOGGER.warning("The ip %s of node %s is now used by node %s. It is resolved again" %
+                                    (cached[0], name, owners[cached[0]]))
+                    self._cache[name] = (cached[0], 0, cached[2])
+        return dict((name, ip) for ip, name in owners.items())
+
+    def wait(self, timeout):
+        '''Waits at most 'timeout' seconds for the resolutions in progress'''
+        with self._lock:
+            pending = list(self._pending.values())
+        for result in pending:
+            result.wait(timeout)
+
+
+class TaskTable(object):
+    ''' Columnar table of the tasks of a monitoring pass: the slave (as an index in 'slaves'), cpus, mem and state
+    of each task are kept in arrays, so the usage of the slaves is aggregated with vectorized operations
+    (using numpy, if it is available, or the array module otherwise)
+    '''
+    STATES = ["TASK_RUNNING", "TASK_STAGING"]
+    OTHER_STATE = len(STATES)
+
+    def __init__(self, tasks):
+        self.slaves = []
+        slave_indexes = {}
+        slave_column = array.array('l')
+        cpus_column = array.array('d')
+        mem_column = array.array('d')
+        state_column = array.array('l')
+        for task in tasks:
+            slave_index = slave_indexes.get(task['slave_id'])
+            if slave_index is None:
+                slave_index = slave_indexes[task['slave_id']] = len(self.slaves)
+                self.slaves.append(task['slave_id'])
+            slave_column.append(slave_index)
+            resources = task.get('resources', {})
+            cpus_column.append(float(resources.get('cpus', 0)))
+            mem_column.append(float(resources.get('mem', 0)))
+            state = task['state']
+            state_column.append(self.STATES.index(state) if state in self.STATES else self.OTHER_STATE)
+
+        if numpy is not None:
+            self._slave = numpy.array(slave_column, dtype=numpy.int64)
+            self._cpus = numpy.array(cpus_column, dtype=numpy.float64)
+            self._mem = numpy.array(mem_column, dtype=numpy.float64)
+            self._state = numpy.array(state_column, dtype=numpy.int64)
+        else:
+            self._slave, self._cpus, self._mem, self._state = slave_column, cpus_column, mem_column, state_column
+
+    def _group_by_slave(self, states):
+        '''Obtains the number of tasks, cpus and mem of the tasks in the states 'states' of each slave, as
+        sequences indexed by the index of the slave
+        '''
+        codes = [self.STATES.index(state) for state in states]
+        if numpy is not None:
+            mask = numpy.isin(self._state, codes)
+            slaves = self._slave[mask]
+            return (numpy.bincount(slaves, minlength=len(self.slaves)),
+                    numpy.bincount(slaves, weights=self._cpus[mask], minlength=len(self.slaves)),
+                    numpy.bincount(slaves, weights=self._mem[mask], minlength=len(self.slaves)))
+
+        count = [0] * len(self.slaves)
+        cpus = [0.0] * len(self.slaves)
+        mem = [0.0] * len(self.slaves)
+        for slave, task_cpus, task_mem, state in zip(self._slave, self._cpus, self._mem, self._state):
+            if state in codes:
+                count[slave] += 1
+                cpus[slave] += task_cpus
+                mem[slave] += task_mem
+        return count, cpus, mem
+
+    def get_used_slaves(self, states):
+        '''Obtains the ids of the slaves with tasks in the states 'states' '''
+        count = self._group_by_slave(states)[0]
+        return [slave for index, slave in enumerate(self.slaves) if count[index]]
+
+    def get_usage(self, states):
+        '''Obtains a dictionary with the cpus and mem (in MB) used by the tasks in the states 'states' of each slave,
+        indexed by slave id
+        '''
+        count, cpus, mem = self._group_by_slave(states)
+        return dict((slave, (float(cpus[index]), float(mem[index])))
+                    for index, slave in enumerate(self.slaves) if count[index])
+
+
+class MesosLeader(object):
+    ''' Locates the leading Mesos master through the /master/redirect endpoint of the candidate masters
+    (or of the master in the URL, if no candidate is configured) and caches its location, so the queries are
+    sent straight to the leader instead of being redirected. The leader is located again only when it cannot be
+    reached or it answers with a redirection (i.e. it is no longer the leader)
+    '''
+
+    def __init__(self, masters):
+        self._masters = masters
+        self._leader = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def is_master_url(url):
+        path = urlparse.urlparse(url).path
+        return path.startswith("/master/") or path.startswith("/api/v1")
+
+    def _discover(self, session, url, timeout, **options):
+        candidates = self._masters or [url.netloc]
+        for candidate in candidates:
+            try:
+                response = session.get("%s://%s/master/redirect" % (url.scheme, candidate), timeout=timeout,
+                                       allow_redirects=False, **options)
+                location = urlparse.urlparse(response.headers.get("Location", ""))
+                if response.status_code == 307 and location.netloc:
+                    _LOGGER.debug("Leading Mesos master located at %s" % location.netloc)
+                    return location.netloc
+            except requests.exceptions.RequestException:
+                _LOGGER.warning("Could not reach the Mesos master %s to locate the leader" % candidate)
+        _LOGGER.warning("Could not locate the leading Mesos master")
+        return None
+
+    def locate(self, session, url, timeout, **options):
+        '''Returns the location (host:port) of the leading master, discovering it if it is not cached'''
+        with self._lock:
+            if self._leader is None:
+                self._leader = self._discover(session, url, timeout, **options)
+            return self._leader
+
+    def invalidate(self, leader):
+        with self._lock:
+            if self._leader == leader:
+                self._leader = None
+
+    def get(self, session, url, timeout, **options):
+        '''Queries the URL 'url' in the leading master (the URLs that do not belong to the master are queried
+        as they are), locating the leader again and retrying once if it has changed
+        '''
+        if not self.is_master_url(url):
+            return session.get(url, timeout=timeout, **options)
+        url = urlparse.urlparse(url)
+        # The leader is located with the same credentials and certificates
+        locate_options = dict((key, value) for key, value in options.items() if key != 'stream')
+        for attempt in range(2):
+            leader = self.locate(session, url, timeout, **locate_options)
+            if leader is None:
+                # The redirections are followed as usual
+                return session.get(url.geturl(), timeout=timeout, **options)
+            try:
+                response = session.get(url._replace(netloc=leader).geturl(), timeout=timeout, allow_redirects=False,
+                                       **options)
+            except requests.exceptions.ConnectionError:
+                self.invalidate(leader)
+                if attempt:
+                    raise
+                continue
+            if response.status_code != 307:
+                return response
+            self.invalidate(leader)
+        return response
+
+
+class EventStream(object):
+    ''' Base class of the streams of events: a thread keeps the stream subscribed, subscribing again after
+    'reconnect_delay' seconds each time that it is closed or fails. The stream is requested with the HTTP session
+    'session' (or requests itself, if not provided) and the options 'options' (as keyword arguments of requests)
+    '''
+
+    def __init__(self, url, timeout, reconnect_delay, session=None, options=None):
+        self._url = url
+        self._session = session if session is not None else requests
+        self._options = options if options is not None else {}
+        self._timeout = timeout
+        self._reconnect_delay = reconnect_delay
+        self._synchronized = False
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=self.__class__.__name__)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def is_synchronized(self):
+        return self._synchronized
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self._subscribe()
+                _LOGGER.warning("%s closed by the server" % self.__class__.__name__)
+            except Exception as exception:
+                _LOGGER.warning("%s disconnected: %s" % (self.__class__.__name__, str(exception)))
+            self._synchronized = False
+            self._stopped.wait(self._reconnect_delay)
+
+    def _get_request_options(self, headers):
+        '''Returns the options of the request of the stream, adding the headers 'headers' to the ones of the options'''
+        options = dict(self._options)
+        options['headers'] = dict(self._options.get('headers', {}), **headers)
+        return options
+
+    def _subscribe(self):
+        '''Subscribes to the stream and processes its events until it is closed'''
+        raise NotImplementedError()
+
+
+class MesosEventStream(EventStream):
+    ''' Keeps an in-memory model of the tasks, agents and frameworks of a Mesos master, subscribed to the event
+    stream of its v1 operator API. The documents of the model have the same format as the ones obtained from
+    /master/tasks.json, /master/slaves and /master/state.json. Each time that the stream is (re)connected, the
+    model is fully resynchronized from the state included in the SUBSCRIBED event
+    '''
+
+    TERMINAL_STATES = ["TASK_FINISHED", "TASK_FAILED", "TASK_KILLED", "TASK_LOST", "TASK_ERROR", "TASK_DROPPED",
+                       "TASK_GONE", "TASK_GONE_BY_OPERATOR"]
+
+    def __init__(self, url, timeout, reconnect_delay, session=None, options=None):
+        EventStream.__init__(self, url, timeout, reconnect_delay, session, options)
+        self._tasks = {}
+        self._agents = {}
+        self._frameworks = {}
+
+    def _subscribe(self):
+        # The read timeout detects a dead connection, as Mesos sends HEARTBEAT events periodically
+        options = self._get_request_options({'Content-Type': 'application/json', 'Accept': 'application/json'})
+        response = self._session.post(self._url, data=json.dumps({'type': 'SUBSCRIBE'}), stream=True,
+                                      timeout=self._timeout, **options)
+        try:
+            if response.status_code != 200:
+                raise Exception("STATUS_CODE=" + str(response.status_code))
+            for event in read_recordio(response.raw):
+                if self._stopped.is_set():
+                    break
+                self.apply_event(event)
+        finally:
+            response.close()
+
+    def apply_event(self, event):
+        '''Updates the model with an event of the v1 operator API'''
+        with self._lock:
+            if event['type'] == 'SUBSCRIBED':
+                state = event['subscribed']['get_state']
+                self._tasks = {}
+                self._agents = {}
+                self._frameworks = {}
+                for task in state.get('get_tasks', {}).get('tasks', []):
+                    self._add_task(task)
+                for agent in state.get('get_agents', {}).get('agents', []):
+                    self._add_agent(agent)
+                for framework in state.get('get_frameworks', {}).get('frameworks', []):
+                    self._add_framework(framework)
+                self._synchronized = True
+            elif event['type'] == 'TASK_ADDED':
+                self._add_task(event['task_added']['task'])
+            elif event['type'] == 'TASK_UPDATED':
+                status = event['task_updated']['status']
+                task_id = status['task_id']['value']
+                if event['task_updated']['state'] in self.TERMINAL_STATES:
+                    self._tasks.pop(task_id, None)
+                elif task_id in self._tasks:
+                    self._tasks[task_id] = dict(self._tasks[task_id], state=event['task_updated']['state'])
+            elif event['type'] == 'AGENT_ADDED':
+                self._add_agent(event['agent_added']['agent'])
+            elif event['type'] == 'AGENT_REMOVED':
+                self._agents.pop(event['agent_removed']['agent_id']['value'], None)
+            elif event['type'] in ['FRAMEWORK_ADDED', 'FRAMEWORK_UPDATED']:
+                self._add_framework(event[event['type'].lower()]['framework'])
+            elif event['type'] == 'FRAMEWORK_REMOVED':
+                self._frameworks.pop(event['framework_removed']['framework_info']['id']['value'], None)
+
+    def _add_task(self, task):
+        if task['state'] not in self.TERMINAL_STATES:
+            self._tasks[task['task_id']['value']] = {
+                'id': task['task_id']['value'],
+                'name': task['name'],
+                'framework_id': task['framework_id']['value'],
+                'slave_id': task['agent_id']['value'],
+                'state': task['state'],
+                'resources': get_v1_resources(task.get('resources', []))
+            }
+
+    def _add_agent(self, agent):
+        agent_info = agent['agent_info']
+        self._agents[agent_info['id']['value']] = {
+            'id': agent_info['id']['value'],
+            'hostname': agent_info['hostname'],
+            'active': agent.get('active', True),
+            'resources': get_v1_resources(agent.get('total_resources', agent_info.get('resources', [])))
+        }
+
+    def _add_framework(self, framework):
+        framework_info = framework['framework_info']
+        self._frameworks[framework_info['id']['value']] = {
+            'id': framework_info['id']['value'],
+            'name': framework_info['name']
+        }
+
+    def get_tasks(self):
+        '''Obtains the tasks of the model in the format of /master/tasks.json'''
+        with self._lock:
+            return {'tasks': list(self._tasks.values())}
+
+    def get_slaves(self):
+        '''Obtains the agents of the model in the format of /master/slaves (the used resources of each agent are
+        obtained from its running tasks, as the events do not include the changes in the allocated resources)
+        '''
+        with self._lock:
+            agents = {}
+            for agent_id, agent in self._agents.items():
+                agents[agent_id] = dict(agent, used_resources={'cpus': 0.0, 'mem': 0.0})
+            for task in self._tasks.values():
+                agent = agents.get(task['slave_id'])
+                if agent and task['state'] == "TASK_RUNNING":
+                    agent['used_resources']['cpus'] += task['resources']['cpus']
+                    agent['used_resources']['mem'] += task['resources']['mem']
+            return {'slaves': list(agents.values())}
+
+    def get_state(self):
+        '''Obtains the frameworks of the model, with their tasks and used resources, in the format of
+        /master/state.json
+        '''
+        with self._lock:
+            frameworks = {}
+            for framework_id, framework in self._frameworks.items():
+                frameworks[framework_id] = dict(framework, resources={'cpus': 0.0, 'mem': 0.0}, tasks=[])
+            for task in self._tasks.values():
+                framework = frameworks.get(task['framework_id'])
+                if framework:
+                    framework['tasks'].append(task)
+                    if task['state'] == "TASK_RUNNING":
+                        framework['resources']['cpus'] += task['resources']['cpus']
+                        framework['resources']['mem'] += task['resources']['mem']
+            return {'frameworks': list(frameworks.values())}
+
+
+class MarathonEventStream(EventStream):
+    ''' Keeps an in-memory model of the apps of Marathon (their definition and the hosts of their tasks), updated
+    with the server-sent events of /v2/events. As events can be missed, the model is only considered synchronized
+    if it has been reconciled with the full list of apps during the last 'reconcile_interval' seconds
+    '''
+
+    RUNNING_STATES = ["TASK_STAGING", "TASK_STARTING", "TASK_RUNNING"]
+
+    def __init__(self, url, timeout, reconnect_delay, reconcile_interval, session=None, options=None):
+        EventStream.__init__(self, url, timeout, reconnect_delay, session, options)
+        self._reconcile_interval = reconcile_interval
+        self._reconciled = None
+        self._apps = {}
+
+    def is_synchronized(self):
+        return (self._synchronized and self._reconciled is not None and
+                time.time() - self._reconciled < self._reconcile_interval)
+
+    def _subscribe(self):
+        options = self._get_request_options({'Accept': 'text/event-stream'})
+        response = self._session.get(self._url, stream=True, timeout=self._timeout, **options)
+        try:
+            if response.status_code != 200:
+                raise Exception("STATUS_CODE=" + str(response.status_code))
+            # The events missed while disconnected are only recovered reconciling the model again
+            self._reconciled = None
+            self._synchronized = True
+            for event_type, event in read_server_sent_events(iter(response.raw.readline, "")):
+                if self._stopped.is_set():
+                    break
+                self.apply_event(event_type, event)
+        finally:
+            response.close()
+
+    def reconcile(self, marathon_apps):
+        '''Replaces the model with the apps obtained from /v2/apps?embed=apps.tasks'''
+        with self._lock:
+            self._apps = {}
+            for app in marathon_apps['apps']:
+                self._add_app(app)
+                for task in app.get('tasks') or []:
+                    state = task.get('state', "TASK_RUNNING" if task.get('startedAt') else "TASK_STAGING")
+                    self._apps[app['id']]['tasks'][task['id']] = {'id': task['id'], 'host': task['host'],
+                                                                  'state': state}
+            self._reconciled = time.time()
+
+    def apply_event(self, event_type, event):
+        '''Updates the model with an event of the Marathon event bus'''
+        with self._lock:
+            if event_type == 'api_post_event':
+                self._add_app(event['appDefinition'])
+            elif event_type == 'deployment_info':
+                for app in event['plan']['target']['apps']:
+                    self._add_app(app)
+            elif event_type == 'app_terminated_event':
+                self._apps.pop(event['appId'], None)
+            elif event_type == 'status_update_event':
+                app = self._apps.get(event['appId'])
+                if app:
+                    if event['taskStatus'] in self.RUNNING_STATES:
+                        app['tasks'][event['taskId']] = {'id': event['taskId'], 'host': event['host'],
+                                                         'state': event['taskStatus']}
+                    else:
+                        app['tasks'].pop(event['taskId'], None)
+
+    def _add_app(self, app):
+        tasks = self._apps[app['id']]['tasks'] if app['id'] in self._apps else {}
+        self._apps[app['id']] = {'id': app['id'], 'cpus': app['cpus'], 'mem': app['mem'],
+                                 'instances': app['instances'], 'tasks': tasks}
+
+    def get_apps(self):
+        '''Obtains the apps of the model in the format of /v2/apps?embed=apps.tasks'''
+        with self._lock:
+            apps = []
+            for app in self._apps.values():
+                tasks = list(app['tasks'].values())
+                apps.append(dict(app, tasks=[{'id': task['id'], 'host': task['host']} for task in tasks],
+                                 tasksRunning=len([task for task in tasks if task['state'] == "TASK_RUNNING"]),
+                                 tasksStaged=len([task for task in tasks if task['state'] != "TASK_RUNNING"])))
+            return {'apps': apps}
+
+
 class lrms(LRMS):
 
+    def _get_snapshot(self):
+        '''Returns the snapshot of the current monitoring pass, creating a new one if the previous has expired'''
+        # The job lists are obtained concurrently, and they must share the same snapshot
+        with self._snapshot_lock:
+            if self._snapshot is None or self._snapshot.is_expired():
+                self._snapshot = MesosSnapshot(self._snapshot_ttl)
+            return self._snapshot
+
+    def _use_curl(self, command):
+        '''Determines if the command 'command' has to be executed with curl: when the HTTP backend is "curl" or the
+        command has options that the native backend cannot translate
+        '''
+        if self._http_backend == "curl":
+            return True
+        if command not in self._curl_commands:
+            self._curl_commands[command] = get_command_request(command) is None
+            if self._curl_commands[command]:
+                _LOGGER.warning("The command to query %s has options not supported by the native HTTP backend. "
+                                "It is executed with curl" % get_command_url(command))
+        return self._curl_commands[command]
+
+    def _get_session(self):
+        '''Returns the HTTP session shared by the queries and the event streams, creating it the first time'''
+        if self._session is None:
+            self._session = create_http_session(self._http_pool_size)
+        return self._session
+
+    def _query(self, command, error_message, is_json=True, parser=None):
+        '''Queries the URL of the command 'command' using the configured HTTP backend ("native" or "curl").
+        If a 'parser' is provided, it obtains the result from a file-like object with the response
+        '''
+        if self._use_curl(command):
+            result = curl_command(command, self._server_ip, error_message, is_json and not parser, self._http_timeout)
+            if result and parser:
+                try:
+                    return parser(StringIO.StringIO(result))
+                except Exception as exception:
+                    _LOGGER.error(str(exception) + ';ERROR=' + error_message + ';SERVER_IP=' + self._server_ip)
+                    return None
+            return result
+        return http_command(self._get_session(), command, self._server_ip, error_message, is_json,
+                            self._http_timeout, self._leader, parser)
+
+    def _get_event_stream(self):
+        '''Returns the Mesos event stream, starting it the first time, if the state source is "events"'''
+        if self._state_source == "events" and self._event_stream is None:
+            # The stream is requested with the credentials and certificates of the command to obtain the state
+            request = get_command_request(self._state)
+            self._event_stream = MesosEventStream(get_server_url(self._state, "/api/v1"), self._events_timeout,
+                                                  self._events_reconnect_delay, self._get_session(),
+                                                  request[1] if request else None)
+            self._event_stream.start()
+        return self._event_stream
+
+    def _query_mesos(self, command, error_message, obtain_from_events, parser=None):
+        '''Obtains a Mesos document from the model of the event stream, if it is synchronized, or querying the
+        URL of the command 'command' otherwise
+        '''
+        event_stream = self._get_event_stream()
+        if event_stream and event_stream.is_synchronized():
+            return obtain_from_events(event_stream)
+        return self._query(command, error_message, parser=parser)
+
     def _obtain_mesos_jobs(self):
         '''Obtains the list of jobs in Mesos'''
-        return curl_command(self._jobs, self._server_ip, "Could not obtain information about MESOS jobs")
+        return self._get_snapshot().get('tasks', lambda: self._query_mesos(
+            self._jobs, "Could not obtain information about MESOS jobs", MesosEventStream.get_tasks))
 
     def _obtain_mesos_nodes(self):
         '''Obtains the list of nodes in Mesos'''
-        return curl_command(self._nodes, self._server_ip, "Could not obtain information about MESOS nodes")
+        return self._get_snapshot().get('slaves', lambda: self._query_mesos(
+            self._nodes, "Could not obtain information about MESOS nodes", MesosEventStream.get_slaves))
 
     def _obtain_chronos_jobs(self):
         '''Obtains the list of jobs in Chronos'''
-        return curl_command(self._chronos, self._server_ip, "Could not obtain information about Chronos jobs")
+        return self._get_snapshot().get('chronos', lambda: self._query(
+            self._chronos, "Could not obtain information about Chronos jobs"))
 
     def _obtain_chronos_jobs_state(self):
-        '''Obtains the list of states for the jobs in Chronos'''
-        return curl_command(self._chronos_state, self._server_ip,
-                            "Could not obtain information about the state of the Chronos jobs", False)
+        '''Obtains a dictionary with the states of the jobs in Chronos, indexed by job name'''
+        def parse_jobs_state():
+            # The CSV is parsed line by line while it is downloaded
+            jobs_state = self._query(self._chronos_state,
+                                     "Could not obtain information about the state of the Chronos jobs", False,
+                                     parser=lambda stream: parse_chronos_jobs_state(stream))
+            return jobs_state or {}
+
+        return self._get_snapshot().get('chronos_state', parse_jobs_state)
+
+    def _get_marathon_event_stream(self):
+        '''Returns the Marathon event stream, starting it the first time, if the Marathon source is "events"'''
+        if self._marathon_source == "events" and self._marathon_event_stream is None:
+            # The stream is requested with the credentials and certificates of the command to obtain the apps
+            request = get_command_request(self._marathon)
+            self._marathon_event_stream = MarathonEventStream(
+                get_server_url(self._marathon, "/v2/events"), self._events_timeout, self._events_reconnect_delay,
+                self._marathon_reconcile_interval, self._get_session(), request[1] if request else None)
+            self._marathon_event_stream.start()
+        return self._marathon_event_stream
 
     def _obtain_marathon_jobs(self):
-        '''Obtains the list of jobs in Marathon'''
-        return curl_command(self._marathon, self._server_ip, "Could not obtain information about Marathon jobs")
+        '''Obtains the list of jobs in Marathon, from the model of the event stream if it is synchronized. Otherwise
+        it is queried, and the model (if any) is reconciled with the result
+        '''
+        def obtain_marathon_jobs():
+            event_stream = self._get_marathon_event_stream()
+            if event_stream and event_stream.is_synchronized():
+                return event_stream.get_apps()
+            marathon_jobs = self._query(self._marathon, "Could not obtain information about Marathon jobs")
+            if event_stream and marathon_jobs:
+                event_stream.reconcile(marathon_jobs)
+            return marathon_jobs
+
+        return self._get_snapshot().get('marathon', obtain_marathon_jobs)
+
+    def _obtain_marathon_launch_queue(self):
+        '''Obtains the number of instances of each app that Marathon is waiting to launch, indexed by app id
+        (or None if the launch queue cannot be obtained)
+        '''
+        def index_launch_queue():
+            marathon_queue = self._query(self._marathon_queue,
+                                         "Could not obtain information about the Marathon launch queue")
+            if marathon_queue is None:
+                return None
+            launch_queue = {}
+            for queued in marathon_queue['queue']:
+                if 'app' in queued:
+                    launch_queue[queued['app']['id']] = queued['count']
+            return launch_queue
+
+        return self._get_snapshot().get('marathon_queue', index_launch_queue)
 
     def _obtain_mesos_state(self):
-        '''Obtains the state of the Mesos server'''
-        return curl_command(self._state, self._server_ip, "Could not obtain information about MESOS state")
+        '''Obtains the state of the frameworks of the Mesos server (only the fields used by CLUES)'''
+        return self._get_snapshot().get('state', lambda: self._query_mesos(
+            self._state, "Could not obtain information about MESOS state", MesosEventStream.get_state,
+            parse_mesos_state))
+
+    def _obtain_mesos_slaves_hostnames(self):
+        '''Obtains a dictionary with the hostname of each Mesos slave indexed by its id'''
+        def index_hostnames():
+            hostnames = {}
+            mesos_nodes = self._obtain_mesos_nodes()
+            if mesos_nodes:
+                for mesos_node in mesos_nodes['slaves']:
+                    hostnames[mesos_node['id']] = mesos_node['hostname']
+            return hostnames
+
+        return self._get_snapshot().get('slaves_hostnames', index_hostnames)
+
+    def _obtain_mesos_task_table(self):
+        '''Obtains the columnar table of the Mesos tasks (see TaskTable)'''
+        def build_task_table():
+            mesos_jobs = self._obtain_mesos_jobs()
+            return TaskTable(mesos_jobs['tasks'] if mesos_jobs else [])
+
+        return self._get_snapshot().get('task_table', build_task_table)
 
     def _obtain_mesos_used_nodes(self):
         '''Identifies the nodes that are in "USED" state (jobs in state "TASK_RUNNING")'''
-        mesos_jobs = self._obtain_mesos_jobs()
-        used_nodes = []
+        return self._obtain_mesos_task_table().get_used_slaves(["TASK_RUNNING", "TASK_STAGING"])
 
-        if mesos_jobs:
-            for mesos_job in mesos_jobs['tasks']:
-                state = mesos_job['state']
-                if state == "TASK_RUNNING" or state == "TASK_STAGING":
-                    if mesos_job['slave_id'] not in used_nodes:
-                        used_nodes.append(mesos_job['slave_id'])
+    def _obtain_cpu_mem_used_in_mesos_nodes(self):
+        '''Obtains a dictionary with the cpu and mem used by the running tasks of each slave, indexed by slave id'''
+        def index_usage():
+            usage = self._obtain_mesos_task_table().get_usage(["TASK_RUNNING"])
+            return dict((slave_id, (cpus, calculate_memory_bytes(mem))) for slave_id, (cpus, mem) in usage.items())
 
-        return used_nodes
+        return self._get_snapshot().get('slaves_usage', index_usage)
 
     def _obtain_cpu_mem_used_in_mesos_node(self, slave_id):
         ''' Obtains the mem and cpu used by the mesos_job that is in execution in the node with id 'slave_id' '''
-        used_cpu = 0
-        used_mem = 0
-        mesos_jobs = self._obtain_mesos_jobs()
-
-        if mesos_jobs:
-            for mesos_job in mesos_jobs['tasks']:
-                if mesos_job['slave_id'] == slave_id and mesos_job['state'] == "TASK_RUNNING":
-                    used_cpu += float(mesos_job['resources']['cpus'])
-                    used_mem += calculate_memory_bytes(mesos_job['resources']['mem'])
-
-        return used_cpu, used_mem
+        return self._obtain_cpu_mem_used_in_mesos_nodes().get(slave_id, (0, 0))
 
     def _obtain_chronos_jobs_nodes(self, job_id):
         '''Method to obtain the slaves' hostnames that are executing chronos jobs'''
-        mesos_jobs = self._obtain_mesos_jobs()
-        chronos_nodes_hostname = []
+        def index_task_nodes():
+            task_nodes = {}
+            mesos_jobs = self._obtain_mesos_jobs()
+            if mesos_jobs:
+                hostnames = self._obtain_mesos_slaves_hostnames()
+                for mesos_job in mesos_jobs['tasks']:
+                    if mesos_job['slave_id'] in hostnames:
+                        task_nodes.setdefault(mesos_job['name'], []).append(hostnames[mesos_job['slave_id']])
+            return task_nodes
 
+        # When the chronos_job is running, the name received in mesos is "ChronosTask:<chronosJobName>"
         chronos_job_name = "ChronosTask:" + job_id
-        if mesos_jobs:
-            for mesos_job in mesos_jobs['tasks']:
-                if chronos_job_name == mesos_job['name']:
-                    mesos_nodes = self._obtain_mesos_nodes()
-                    if mesos_nodes:
-                        for mesos_node in mesos_nodes['slaves']:
-                            if mesos_node['id'] == mesos_job['slave_id']:
-                                chronos_nodes_hostname.append(mesos_node['hostname'])
-
-        return chronos_nodes_hostname
+        return list(self._get_snapshot().get('tasks_nodes', index_task_nodes).get(chronos_job_name, []))
 
     def _obtain_chronos_job_state(self, job_id):
-        '''Given a job id, calls Chronos to know the state of that job'''
-        chronos_jobs = self._obtain_chronos_jobs_state()
-        if chronos_jobs:
-            parsed_chronos_jobs = chronos_jobs.split("\n")
-            for chronos_job in parsed_chronos_jobs:
-                if chronos_job != '':
-                    properties = chronos_job.split(",")
-                    # properties[1] --> Job name
-                    if job_id == properties[1]:
-                        # properties[3] --> Job state
-                        return infer_chronos_job_state(properties[3])
+        '''Given a job id, obtains the state of that job in Chronos'''
+        return self._obtain_chronos_jobs_state().get(job_id)
 
     def _update_job_info_list(self, jobinfolist, cpus_per_task, memory, numnodes, job_id, nodes, state):
         # Use the fake queue
@@ -222,15 +1099,12 @@ class lrms(LRMS):
         if chronos_jobs:
             for chronos_job in chronos_jobs:
                 job_id = chronos_job['name']
-                # When the chronos_job is running, the name received in mesos is "ChronosTask:<chronosJobName>"
                 nodes = self._obtain_chronos_jobs_nodes(job_id)
                 numnodes = 1
                 memory = calculate_memory_bytes(chronos_job['mem'])
                 if memory <= 0:
                     memory = 536870912
                 cpus_per_task = float(chronos_job['cpus'])
-                # Ask chronos the current chronos_job_state of the chronos_job <name>
-                # We obtain something like "type,jobName,lastRunStatus,currentState" for each chronos_job
                 chronos_job_state = self._obtain_chronos_job_state(job_id)
                 jobinfolist = self._update_job_info_list(jobinfolist,
                                                          cpus_per_task, memory, numnodes,
@@ -241,6 +1115,9 @@ class lrms(LRMS):
         ''' Method in charge of monitoring the chronos_job queue of Marathon '''
         jobinfolist = []
         marathon_jobs = self._obtain_marathon_jobs()
+        launch_queue = None
+        if self._marathon_use_queue:
+            launch_queue = self._obtain_marathon_launch_queue()
 
         if marathon_jobs:
             if marathon_jobs['apps']:
@@ -252,13 +1129,32 @@ class lrms(LRMS):
                     cpus_per_task = float(job_attributes['cpus'])
                     if cpus_per_task <= 0:
                         cpus_per_task = 1.0
-                    tasks = job_attributes['tasks']
+                    # The tasks are not included if the apps are obtained with lightweight embeds (e.g. apps.counts)
+                    tasks = job_attributes.get('tasks')
                     nodes = []
                     if tasks:
                         for task in tasks:
                             nodes.append(task['host'])
                     numnodes = job_attributes['instances']
-                    marathon_job_state = infer_marathon_job_state(tasks, job_attributes['tasksRunning'])
+                    if launch_queue is not None:
+                        # The instances that Marathon is waiting to launch are the unmet demand of the app
+                        pending_instances = launch_queue.get(job_id, 0)
+                        if pending_instances > 0:
+                            marathon_job_state = Request.PENDING
+                            numnodes = pending_instances
+                        else:
+                            marathon_job_state = Request.ATTENDED
+                    elif tasks is None:
+                        # Without the tasks (and the launch queue) the unmet demand is inferred from the counts
+                        pending_instances = (numnodes - job_attributes.get('tasksRunning', 0) -
+                                             job_attributes.get('tasksStaged', 0))
+                        if pending_instances > 0:
+                            marathon_job_state = Request.PENDING
+                            numnodes = pending_instances
+                        else:
+                            marathon_job_state = Request.ATTENDED
+                    else:
+                        marathon_job_state = infer_marathon_job_state(tasks, job_attributes['tasksRunning'])
                     jobinfolist = self._update_job_info_list(jobinfolist,
                                                              cpus_per_task, memory, numnodes,
                                                              job_id, nodes, marathon_job_state)
@@ -266,7 +1162,13 @@ class lrms(LRMS):
 
     def __init__(self, MESOS_SERVER=None, MESOS_NODES_COMMAND=None, MESOS_STATE_COMMAND=None, MESOS_JOBS_COMMAND=None,
                  MESOS_MARATHON_COMMAND=None, MESOS_CHRONOS_COMMAND=None, MESOS_CHRONOS_STATE_COMMAND=None,
-                 MESOS_NODE_MEMORY=None, MESOS_NODE_SLOTS=None):
+                 MESOS_NODE_MEMORY=None, MESOS_NODE_SLOTS=None, MESOS_SNAPSHOT_TTL=None, MESOS_HTTP_BACKEND=None,
+                 MESOS_HTTP_TIMEOUT=None, MESOS_HTTP_POOL_SIZE=None, MESOS_FETCH_THREADS=None,
+                 MESOS_FETCH_DEADLINE=None, MESOS_DNS_TTL=None, MESOS_DNS_NEGATIVE_TTL=None, MESOS_DNS_THREADS=None,
+                 MESOS_DNS_TIMEOUT=None, MESOS_USAGE_FROM_SLAVES=None, MESOS_STATE_SOURCE=None,
+                 MESOS_EVENTS_TIMEOUT=None, MESOS_EVENTS_RECONNECT_DELAY=None, MESOS_MARATHON_SOURCE=None,
+                 MESOS_MARATHON_RECONCILE_INTERVAL=None, MESOS_MARATHON_USE_QUEUE=None,
+                 MESOS_MARATHON_QUEUE_COMMAND=None, MESOS_MASTERS=None):
 
         config_mesos = cpyutils.config.Configuration(
             "MESOS",
@@ -279,14 +1181,33 @@ class lrms(LRMS):
                 "/usr/bin/curl -L -X GET http://mesosserverpublic:5050/master/state.json",
                 "MESOS_JOBS_COMMAND":
                 "/usr/bin/curl -L -X GET http://mesosserverpublic:5050/master/tasks.json",
-                "MESOS_MARATHON_COMMAND":
-                "/usr/bin/curl -L -X GET http://mesosserverpublic:8080/v2/apps?embed=tasks",
+                "MESOS_MARATHON_COMMAND": MARATHON_COMMAND,
                 "MESOS_CHRONOS_COMMAND":
                 "/usr/bin/curl -L -X GET http://mesosserverpublic:4400/scheduler/jobs",
                 "MESOS_CHRONOS_STATE_COMMAND":
                 "/usr/bin/curl -L -X GET http://mesosserverpublic:4400/scheduler/graph/csv",
                 "MESOS_NODE_MEMORY": 1572864000,
                 "MESOS_NODE_SLOTS": 1,
+                "MESOS_SNAPSHOT_TTL": 10,
+                "MESOS_HTTP_BACKEND": "native",
+                "MESOS_HTTP_TIMEOUT": 30,
+                "MESOS_HTTP_POOL_SIZE": 10,
+                "MESOS_FETCH_THREADS": 4,
+                "MESOS_FETCH_DEADLINE": 60,
+                "MESOS_DNS_TTL": 30,
+                "MESOS_DNS_NEGATIVE_TTL": 60,
+                "MESOS_DNS_THREADS": 4,
+                "MESOS_DNS_TIMEOUT": 5,
+                "MESOS_USAGE_FROM_SLAVES": False,
+                "MESOS_STATE_SOURCE": "poll",
+                "MESOS_EVENTS_TIMEOUT": 60,
+                "MESOS_EVENTS_RECONNECT_DELAY": 10,
+                "MESOS_MARATHON_SOURCE": "poll",
+                "MESOS_MARATHON_RECONCILE_INTERVAL": 300,
+                "MESOS_MARATHON_USE_QUEUE": False,
+                "MESOS_MARATHON_QUEUE_COMMAND":
+                "/usr/bin/curl -L -X GET http://mesosserverpublic:8080/v2/queue",
+                "MESOS_MASTERS": "",
             }
         )
 
@@ -299,6 +1220,41 @@ class lrms(LRMS):
         self._chronos_state = Helpers.val_default(MESOS_CHRONOS_STATE_COMMAND, config_mesos.MESOS_CHRONOS_STATE_COMMAND)
         self._node_memory = Helpers.val_default(MESOS_NODE_MEMORY, config_mesos.MESOS_NODE_MEMORY)
         self._node_slots = Helpers.val_default(MESOS_NODE_SLOTS, config_mesos.MESOS_NODE_SLOTS)
+        self._snapshot_ttl = Helpers.val_default(MESOS_SNAPSHOT_TTL, config_mesos.MESOS_SNAPSHOT_TTL)
+        self._snapshot = None
+        self._snapshot_lock = threading.Lock()
+        self._http_backend = Helpers.val_default(MESOS_HTTP_BACKEND, config_mesos.MESOS_HTTP_BACKEND)
+        self._http_timeout = Helpers.val_default(MESOS_HTTP_TIMEOUT, config_mesos.MESOS_HTTP_TIMEOUT)
+        self._http_pool_size = Helpers.val_default(MESOS_HTTP_POOL_SIZE, config_mesos.MESOS_HTTP_POOL_SIZE)
+        self._session = None
+        self._curl_commands = {}
+        masters = Helpers.val_default(MESOS_MASTERS, config_mesos.MESOS_MASTERS)
+        self._leader = MesosLeader([master.strip() for master in masters.split(",") if master.strip()])
+        self._fetch_threads = Helpers.val_default(MESOS_FETCH_THREADS, config_mesos.MESOS_FETCH_THREADS)
+        self._fetch_deadline = Helpers.val_default(MESOS_FETCH_DEADLINE, config_mesos.MESOS_FETCH_DEADLINE)
+        self._fetch_pool = None
+        self._fetches = {}
+        self._dns_timeout = Helpers.val_default(MESOS_DNS_TIMEOUT, config_mesos.MESOS_DNS_TIMEOUT)
+        dns_ttl = Helpers.val_default(MESOS_DNS_TTL, config_mesos.MESOS_DNS_TTL)
+        dns_negative_ttl = Helpers.val_default(MESOS_DNS_NEGATIVE_TTL, config_mesos.MESOS_DNS_NEGATIVE_TTL)
+        dns_threads = Helpers.val_default(MESOS_DNS_THREADS, config_mesos.MESOS_DNS_THREADS)
+        self._resolver = HostnameResolver(dns_ttl, dns_negative_ttl, dns_threads)
+        self._usage_from_slaves = Helpers.val_default(MESOS_USAGE_FROM_SLAVES, config_mesos.MESOS_USAGE_FROM_SLAVES)
+        self._state_source = Helpers.val_default(MESOS_STATE_SOURCE, config_mesos.MESOS_STATE_SOURCE)
+        self._events_timeout = Helpers.val_default(MESOS_EVENTS_TIMEOUT, config_mesos.MESOS_EVENTS_TIMEOUT)
+        self._events_reconnect_delay = Helpers.val_default(MESOS_EVENTS_RECONNECT_DELAY,
+                                                           config_mesos.MESOS_EVENTS_RECONNECT_DELAY)
+        self._event_stream = None
+        self._marathon_source = Helpers.val_default(MESOS_MARATHON_SOURCE, config_mesos.MESOS_MARATHON_SOURCE)
+        self._marathon_reconcile_interval = Helpers.val_default(MESOS_MARATHON_RECONCILE_INTERVAL,
+                                                                config_mesos.MESOS_MARATHON_RECONCILE_INTERVAL)
+        self._marathon_event_stream = None
+        self._marathon_use_queue = Helpers.val_default(MESOS_MARATHON_USE_QUEUE, config_mesos.MESOS_MARATHON_USE_QUEUE)
+        self._marathon_queue = Helpers.val_default(MESOS_MARATHON_QUEUE_COMMAND,
+                                                   config_mesos.MESOS_MARATHON_QUEUE_COMMAND)
+        # The event stream reconciles its model (with the tasks) from the listing, so it keeps the full one
+        if self._marathon_use_queue and self._marathon_source != "events" and self._marathon == MARATHON_COMMAND:
+            self._marathon = MARATHON_COUNTS_COMMAND
         LRMS.__init__(self, "MESOS_%s" % self._server_ip)
 
     def get_nodeinfolist(self):
@@ -327,41 +1283,48 @@ class lrms(LRMS):
 
         mesos_slaves = self._obtain_mesos_nodes()
         if mesos_slaves:
-            used_nodes = self._obtain_mesos_used_nodes()
+            if self._usage_from_slaves:
+                used_nodes = [mesos_slave['id'] for mesos_slave in mesos_slaves['slaves']
+                              if get_slave_used_resources(mesos_slave) != (0, 0)]
+            else:
+                used_nodes = self._obtain_mesos_used_nodes()
+            # Index the vnodes by ip and by name, to match them with the hostname of the Mesos slaves (the resolver
+            # assigns each ip to a single vnode, and an exact match of the name prevails over the ips)
+            vnodes = {}
+            for name, ip in self._resolver.resolve(list(nodeinfolist), self._dns_timeout).items():
+                vnodes[ip] = name
+            for name in nodeinfolist:
+                vnodes[name] = name
+
             for mesos_slave in mesos_slaves['slaves']:
-                name = mesos_slave['hostname']
-                if nodeinfolist:
-                    for node in nodeinfolist:
-                        nodeinfolist_node_ip = None
-                        try:
-                            nodeinfolist_node_ip = socket.gethostbyname(nodeinfolist[node].name)
-                        except:
-                            _LOGGER.warning("Error resolving node ip %s" % nodeinfolist[node].name)
-                        if name == nodeinfolist[node].name or name == nodeinfolist_node_ip:
-                            name = nodeinfolist[node].name
-                            state = infer_clues_node_state(mesos_slave["id"], mesos_slave["active"], used_nodes)
-                            slots_count = float(mesos_slave['resources']['cpus'])
-                            memory_total = calculate_memory_bytes(mesos_slave['resources']['mem'])
-
-                            used_cpu, used_mem = self._obtain_cpu_mem_used_in_mesos_node(mesos_slave["id"])
-                            slots_free = slots_count - used_cpu
-                            memory_free = memory_total - used_mem
-
-                            # Create a fake queue
-                            keywords = {}
-                            keywords['hostname'] = TypedClass.auto(name)
-                            queues = ["default"]
-                            if queues:
-                                keywords['queues'] = TypedList([TypedClass.auto(q) for q in queues])
-
-                            nodeinfolist[name] = NodeInfo(
-                                name, slots_count, slots_free, memory_total, memory_free, keywords)
-                            nodeinfolist[name].state = state
+                name = vnodes.get(mesos_slave['hostname'])
+                if name:
+                    state = infer_clues_node_state(mesos_slave["id"], mesos_slave["active"], used_nodes)
+                    slots_count = float(mesos_slave['resources']['cpus'])
+                    memory_total = calculate_memory_bytes(mesos_slave['resources']['mem'])
+
+                    if self._usage_from_slaves:
+                        used_cpu, used_mem = get_slave_used_resources(mesos_slave)
+                    else:
+                        used_cpu, used_mem = self._obtain_cpu_mem_used_in_mesos_node(mesos_slave["id"])
+                    slots_free = slots_count - used_cpu
+                    memory_free = memory_total - used_mem
+
+                    # Create a fake queue
+                    keywords = {}
+                    keywords['hostname'] = TypedClass.auto(name)
+                    queues = ["default"]
+                    if queues:
+                        keywords['queues'] = TypedList([TypedClass.auto(q) for q in queues])
+
+                    nodeinfolist[name] = NodeInfo(
+                        name, slots_count, slots_free, memory_total, memory_free, keywords)
+                    nodeinfolist[name].state = state
 
         return nodeinfolist
 
-    def get_jobinfolist(self):
-        '''Method in charge of monitoring the job queue of Mesos plus Marathon
+    def _get_mesos_jobinfolist(self):
+        '''Method in charge of monitoring the job queue of Mesos
         The Mesos info about jobs has to be obtained from frameworks and not from tasks,
         because if there are not available resources to execute new tasks, Mesos
         do not create them but frameworks are created
@@ -388,29 +1351,59 @@ class lrms(LRMS):
 
                         tasks = framework['tasks']
                         if tasks:
+                            hostnames = self._obtain_mesos_slaves_hostnames()
                             for task in tasks:
                                 mesos_job_state = infer_mesos_job_state(task['state'])
                                 node_id = task['slave_id']
-
-                                mesos_nodes = self._obtain_mesos_nodes()
-                                if mesos_nodes:
-                                    for mesos_node in mesos_nodes['slaves']:
-                                        if node_id == mesos_node['id']:
-                                            nodes.append(mesos_node['hostname'])
+                                if node_id in hostnames:
+                                    nodes.append(hostnames[node_id])
 
                         jobinfolist = self._update_job_info_list(jobinfolist,
                                                                  cpus_per_task, memory, numnodes,
                                                                  job_id, nodes, mesos_job_state)
+        return jobinfolist
+
+    def _get_fetch_pool(self):
+        if self._fetch_pool is None:
+            self._fetch_pool = multiprocessing.pool.ThreadPool(self._fetch_threads)
+        return self._fetch_pool
 
-        # Obtain Marathon jobs and add to the jobinfolist of Mesos
-        marathon_jobinfolist = self._get_marathon_jobinfolist()
-        if marathon_jobinfolist:
-            jobinfolist = list(set(jobinfolist + marathon_jobinfolist))
+    def _fetch(self, name, function):
+        '''Obtains 'function' in the fetch pool, unless the previous fetch 'name' has not finished yet (then it
+        returns that fetch, so the fetches of a slow server do not pile up in the pool pass after pass)
+        '''
+        fetch = self._fetches.get(name)
+        if fetch is None or fetch.ready():
+            fetch = self._fetches[name] = self._get_fetch_pool().apply_async(function)
+        else:
+            _LOGGER.warning("The previous fetch of the %s has not finished yet" % name)
+        return fetch
 
-        # Obtain chronos jobs and add them to jobinfolist
-        chronos_jobinfolist = self._get_chronos_jobinfolist()
-        if chronos_jobinfolist:
-            jobinfolist = list(set(jobinfolist + chronos_jobinfolist))
+    def get_jobinfolist(self):
+        '''Method in charge of monitoring the job queue of Mesos plus Marathon and Chronos
+        The three job lists are obtained in parallel. If any of them is not obtained before the deadline
+        MESOS_FETCH_DEADLINE, its jobs are not included in this monitoring pass, but the rest are returned
+        '''
+        deadline = time.time() + self._fetch_deadline
+        # The state of the Chronos jobs is obtained in parallel to the list of Chronos jobs (the Chronos job list
+        # waits for it in the snapshot)
+        self._fetch("state of the Chronos jobs", self._obtain_chronos_jobs_state)
+        results = [("Mesos", self._fetch("Mesos jobs", self._get_mesos_jobinfolist)),
+                   ("Marathon", self._fetch("Marathon jobs", self._get_marathon_jobinfolist)),
+                   ("Chronos", self._fetch("Chronos jobs", self._get_chronos_jobinfolist))]
+
+        jobinfolist = []
+        for framework, result in results:
+            try:
+                framework_jobinfolist = result.get(max(0, deadline - time.time()))
+            except multiprocessing.TimeoutError:
+                _LOGGER.warning("Timeout obtaining the %s jobs. They are ignored in this monitoring pass" % framework)
+                continue
+            except Exception as exception:
+                _LOGGER.error("Error obtaining the %s jobs: %s" % (framework, str(exception)))
+                continue
+            if framework_jobinfolist:
+                jobinfolist = list(set(jobinfolist + framework_jobinfolist))
 
         return jobinfolist
 
@@ -1,5 +1,9 @@
 import unittest
 import os
+import time
+import shutil
+import tempfile
+import threading
 import mock
 import condor
 from clueslib.node import NodeInfo
@@ -15,6 +19,13 @@ def open_file(file_name):
     return open(abs_file_path, 'r')
 
 
+def read_file_as_string(file_name):
+    tmpfile = open_file(file_name)
+    content = tmpfile.read()
+    tmpfile.close()
+    return content
+
+
 def get_jobs_scheduled_attributes(maxrange):
     list_jobs_scheduled_attr = []
     # gather scheduled jobs from respective file job$n.txt
@@ -95,27 +106,81 @@ class TestCondorPlugin(unittest.TestCase):
         lrms = condor.lrms('test_ip')
         assert lrms._server_ip == 'test_ip'
 
-    @mock.patch('htcondor.Schedd.query')
+    def test_get_job_hosts(self):
+        assert condor.get_job_hosts({"AllRemoteHosts": "wn1,wn2", "RemoteHost": "wn1"}) == ["wn1", "wn2"]
+        assert condor.get_job_hosts({"RemoteHost": "wn1"}) == ["wn1"]
+        assert condor.get_job_hosts({}) == []
+
+    def test_host_usage_table(self):
+        jobs = [{"RemoteHost": "wn1", "RequestCpus": 1, "ImageSize": 2048},
+                {"AllRemoteHosts": "wn1,wn2", "RequestCpus": 2, "ImageSize": 1},
+                {"RequestCpus": 4, "ImageSize": 1}]
+        usage = {"wn1": (3.0, 3), "wn2": (2.0, 1)}
+        assert condor.HostUsageTable(jobs).get_usage() == usage
+        with mock.patch('condor.numpy', None):
+            assert condor.HostUsageTable(jobs).get_usage() == usage
+        assert condor.HostUsageTable([]).get_usage() == {}
+
+    @mock.patch('htcondor.Schedd.xquery')
     @mock.patch('htcondor.Collector.locateAll')
-    def test_get_jobinfolist(self, locateAll, query):
+    def test_get_jobinfolist(self, locateAll, xquery):
         print '   Now testing with --> test_get_jobinfolist'
         test_numjobs = 2
         locateAll.return_value = get_schedulers('test-files/schedulers.txt')
-        query.return_value = get_jobs_scheduled_attributes(test_numjobs)
+        xquery.return_value = get_jobs_scheduled_attributes(test_numjobs)
         job_info_list = condor.lrms(MagicMock(condor.lrms)).get_jobinfolist()
         lenj = len(job_info_list)
         assert lenj == test_numjobs
+        xquery.assert_called_once_with(
+            'JobStatus =!= 3 && JobStatus =!= 4',
+            ["RequestCpus", "ImageSize", "RemoteHost", "AllRemoteHosts",
+             "MinHosts", "ClusterId", "ProcId", "JobStatus"])
+
+    @mock.patch('htcondor.Collector.locateAll')
+    def test_get_condor_daemons_cached(self, locateAll):
+        locateAll.return_value = get_schedulers('test-files/schedulers.txt')
+        collector = condor.lrms(MagicMock(condor.lrms))._collector
+        assert condor.get_schedulers_list_from_Schedd(collector) == locateAll.return_value
+        assert condor.get_schedulers_list_from_Schedd(collector) == locateAll.return_value
+        assert locateAll.call_count == 1
+
+        collector.invalidate(htcondor.DaemonTypes.Schedd)
+        condor.get_schedulers_list_from_Schedd(collector)
+        assert locateAll.call_count == 2
 
-    @mock.patch('htcondor.Schedd.query')
+        # Each plugin has its own cache
+        collector = condor.lrms(MagicMock(condor.lrms), HTCONDOR_DAEMONS_TTL=-1)._collector
+        condor.get_schedulers_list_from_Schedd(collector)
+        condor.get_schedulers_list_from_Schedd(collector)
+        assert locateAll.call_count == 4
+
+    @mock.patch('htcondor.Collector.locateAll')
+    def test_get_condor_daemons_error(self, locateAll):
+        locateAll.side_effect = Exception("collector down")
+        collector = condor.CondorCollector()
+        assert condor.get_schedulers_list_from_Schedd(collector) == []
+        locateAll.side_effect = None
+        locateAll.return_value = get_schedulers('test-files/schedulers.txt')
+        # The failures are not cached
+        assert condor.get_schedulers_list_from_Schedd(collector) == locateAll.return_value
+
+    @mock.patch('htcondor.Collector.query')
+    def test_get_worker_nodes_list_from_Startd(self, query):
+        query.return_value = get_worker_nodes('test-files/workernodes.txt')
+        assert condor.get_worker_nodes_list_from_Startd(condor.CondorCollector()) == query.return_value
+        query.assert_called_once_with(
+            htcondor.AdTypes.Startd, "true", ["Name", "Activity", "TotalSlots", "Memory"])
+
+    @mock.patch('htcondor.Schedd.xquery')
     @mock.patch('condor.get_schedulers_list_from_Schedd')
     @mock.patch('condor.get_worker_nodes_list_from_Startd')
-    def test_get_nodeinfolist(self, get_worker_nodes_list, get_schedulers_list, query):
+    def test_get_nodeinfolist(self, get_worker_nodes_list, get_schedulers_list, xquery):
         print '   Now testing with --> test_get_nodeinfolist'
         get_worker_nodes_list.return_value = get_worker_nodes(
             'test-files/workernodes.txt')
         get_schedulers_list.return_value = get_schedulers(
             'test-files/schedulers.txt')
-        query.return_value = get_jobs_scheduled_attributes(2)
+        xquery.return_value = get_jobs_scheduled_attributes(2)
 
         node_info_list = condor.lrms(MagicMock(condor.lrms)).get_nodeinfolist()
         if node_info_list:
@@ -124,6 +189,261 @@ class TestCondorPlugin(unittest.TestCase):
         else:
             print 'No node_info_list'
 
+    @mock.patch('htcondor.Schedd.xquery')
+    @mock.patch('condor.get_schedulers_list_from_Schedd')
+    @mock.patch('condor.get_worker_nodes_list_from_Startd')
+    def test_jobs_queried_once_per_pass(self, get_worker_nodes_list, get_schedulers_list, xquery):
+        get_worker_nodes_list.return_value = get_worker_nodes(
+            'test-files/workernodes.txt')
+        get_schedulers_list.return_value = get_schedulers(
+            'test-files/schedulers.txt')
+        xquery.return_value = get_jobs_scheduled_attributes(2)
+
+        lrms = condor.lrms(MagicMock(condor.lrms))
+        lrms.get_nodeinfolist()
+        assert len(lrms.get_jobinfolist()) == 2
+        assert xquery.call_count == 1
+
+        lrms = condor.lrms(MagicMock(condor.lrms), HTCONDOR_SNAPSHOT_TTL=-1)
+        lrms.get_nodeinfolist()
+        lrms.get_jobinfolist()
+        assert xquery.call_count == 3
+
+    @mock.patch('htcondor.Schedd.xquery')
+    @mock.patch('condor.get_schedulers_list_from_Schedd')
+    @mock.patch('condor.get_worker_nodes_list_from_Startd')
+    def test_get_nodeinfolist_used_resources(self, get_worker_nodes_list, get_schedulers_list, xquery):
+        get_worker_nodes_list.return_value = get_worker_nodes(
+            'test-files/workernodes.txt')
+        get_schedulers_list.return_value = get_schedulers(
+            'test-files/schedulers.txt')
+        job = classad.ClassAd({"RemoteHost": "wn1.condor.vagrant", "RequestCpus": 1, "ImageSize": 102400})
+        xquery.return_value = [job]
+
+        node_info_list = condor.lrms(MagicMock(condor.lrms)).get_nodeinfolist()
+        node = node_info_list['wn1.condor.vagrant']
+        assert node.slots_free == 0
+        assert node.memory_free == 357
+
+    @mock.patch('htcondor.Schedd')
+    def test_query_schedulers_deadline(self, Schedd):
+        release = threading.Event()
+        answers = {"sched1": [[{"ClusterId": 1, "ProcId": 0, "JobStatus": 2, "RemoteHost": "wn1",
+                                "RequestCpus": 1, "ImageSize": 1024}]],
+                   "sched2": [[{"ClusterId": 2, "ProcId": 0, "JobStatus": 2, "RemoteHost": "wn1",
+                                "RequestCpus": 2, "ImageSize": 1024}], None]}
+
+        def query_scheduler(name):
+            answer = answers[name].pop(0)
+            if answer is None:
+                release.wait(5)
+                return []
+            return iter(answer)
+
+        schedds = {}
+        for name in answers:
+            schedds[name] = MagicMock()
+            schedds[name].xquery.side_effect = lambda constraint, attributes, name=name: query_scheduler(name)
+        Schedd.side_effect = lambda scheduler: schedds[scheduler["Name"]]
+        schedulers = [{"Name": "sched1"}, {"Name": "sched2"}]
+
+        lrms = condor.lrms(MagicMock(condor.lrms), HTCONDOR_QUERY_DEADLINE=0.5)
+        jobinfolist, hosts_usage = lrms._query_schedulers(schedulers)
+        assert [job.job_id for job in jobinfolist] == ["1.0", "2.0"]
+        assert hosts_usage == {"wn1": (3.0, 2)}
+
+        answers["sched1"].append([{"ClusterId": 3, "ProcId": 0, "JobStatus": 1, "MinHosts": 1}])
+        start = time.time()
+        # sched2 does not answer in time, so its last good result is used
+        jobinfolist, hosts_usage = lrms._query_schedulers(schedulers)
+        assert [job.job_id for job in jobinfolist] == ["3.0", "2.0"]
+        assert hosts_usage == {"wn1": (2.0, 1)}
+        assert time.time() - start < 2
+
+        answers["sched1"].append([])
+        # sched2 is not queried again while its previous query is running
+        jobinfolist, hosts_usage = lrms._query_schedulers(schedulers)
+        assert [job.job_id for job in jobinfolist] == ["2.0"]
+        assert schedds["sched2"].xquery.call_count == 2
+        # The Schedd handles are reused
+        assert Schedd.call_count == 2
+        release.set()
+
+    def test_generate_job_infos(self):
+        hosts_usage = condor.HostUsageTable()
+        jobs = iter(get_jobs_scheduled_attributes(3))
+        job_infos = condor.generate_job_infos(jobs, hosts_usage)
+        # The ads are converted one by one
+        assert next(job_infos).job_id == "2.0"
+        assert [job.job_id for job in job_infos] == ["2.1", "2.2"]
+        assert hosts_usage.get_usage() == {}
+
+    def test_generate_job_infos_aggregate_pending(self):
+        jobs = get_jobs_scheduled_attributes(3)
+        jobs.append({"ClusterId": 3, "ProcId": 0, "JobStatus": 1, "MinHosts": 1, "RequestCpus": 2,
+                     "RequestMemory": 1024, "Requirements": "true", "ImageSize": 1})
+        jobs.append({"ClusterId": 3, "ProcId": 1, "JobStatus": 1, "MinHosts": 1, "RequestCpus": 2,
+                     "RequestMemory": 1024, "Requirements": "true", "ImageSize": 1})
+        jobs.append({"ClusterId": 4, "ProcId": 0, "JobStatus": 2, "RemoteHost": "wn1", "RequestCpus": 1,
+                     "ImageSize": 1})
+        jobs.append({"ClusterId": 5, "ProcId": 0, "JobStatus": 1, "MinHosts": 2, "RequestCpus": 2,
+                     "RequestMemory": 1024, "Requirements": "true", "ImageSize": 1})
+        for job in jobs[:3]:
+            job["JobStatus"] = 1
+
+        job_infos = list(condor.generate_job_infos(iter(jobs), condor.HostUsageTable(), True, "sched1"))
+        # The running job is reported as is, and each group of idle jobs as a single job
+        assert len(job_infos) == 4
+        assert job_infos[0].job_id == "4.0"
+        assert job_infos[1].job_id == "sched1#autocluster1"
+        assert job_infos[1].resources.taskcount == 3
+        assert job_infos[1].state == Request.PENDING
+        assert [job.resources.taskcount for job in job_infos[2:]] == [2, 2]
+        assert job_infos[2].job_id.startswith("sched1#request")
+        assert job_infos[3].job_id.startswith("sched1#request")
+        assert job_infos[2].job_id != job_infos[3].job_id
+        assert job_infos[2].resources.resources.slots == 2
+        # The memory is the requested one, not the image size of the first job
+        assert job_infos[2].resources.resources.memory == 1024
+
+    def test_generate_job_infos_aggregate_pending_hosts(self):
+        jobs = [{"ClusterId": 1, "ProcId": proc_id, "JobStatus": 1, "AutoClusterId": 7, "MinHosts": 3,
+                 "RequestCpus": 1, "RequestMemory": 512, "ImageSize": 1} for proc_id in range(2)]
+        jobs.append({"ClusterId": 2, "ProcId": 0, "JobStatus": 1, "AutoClusterId": 7, "MinHosts": 1,
+                     "RequestCpus": 1, "RequestMemory": 512, "ImageSize": 1})
+
+        job_infos = list(condor.generate_job_infos(iter(jobs), condor.HostUsageTable(), True, "sched1"))
+        # A task per host of each job, in a group per number of hosts
+        assert [(job.job_id, job.resources.taskcount) for job in job_infos] == [
+            ("sched1#autocluster7", 1), ("sched1#autocluster7x3", 6)]
+
+    @mock.patch('htcondor.Schedd.xquery')
+    @mock.patch('htcondor.Collector.locateAll')
+    def test_get_jobinfolist_aggregate_pending(self, locateAll, xquery):
+        locateAll.return_value = get_schedulers('test-files/schedulers.txt')
+        jobs = get_jobs_scheduled_attributes(3)
+        for job in jobs:
+            job["JobStatus"] = 1
+        xquery.return_value = jobs
+        job_info_list = condor.lrms(MagicMock(condor.lrms), HTCONDOR_AGGREGATE_PENDING=True).get_jobinfolist()
+        assert len(job_info_list) == 1
+        assert job_info_list[0].resources.taskcount == 3
+        assert "AutoClusterId" in xquery.call_args[0][1]
+        assert len(set(xquery.call_args[0][1])) == len(xquery.call_args[0][1])
+
+    def test_job_queue_model_apply_event(self):
+        model = condor.JobQueueModel("unused.log", 300)
+        model.apply_event(htcondor.JobEventType.SUBMIT, (1, 0))
+        model.apply_event(htcondor.JobEventType.SUBMIT, (1, 1))
+        model.apply_event(htcondor.JobEventType.SUBMIT, (1, 2))
+        model.apply_event(htcondor.JobEventType.EXECUTE, (1, 0))
+        model.apply_event(htcondor.JobEventType.JOB_HELD, (1, 1))
+        model.apply_event(htcondor.JobEventType.JOB_ABORTED, (1, 2))
+        model.apply_event(htcondor.JobEventType.EXECUTE, (5, 0))
+        assert [(job["ClusterId"], job["ProcId"], job["JobStatus"]) for job in model.get_jobs()] == \
+            [(1, 0, 2), (1, 1, 5)]
+        model.apply_event(htcondor.JobEventType.JOB_RELEASED, (1, 1))
+        model.apply_event(htcondor.JobEventType.JOB_TERMINATED, (1, 0))
+        assert [(job["ClusterId"], job["ProcId"], job["JobStatus"]) for job in model.get_jobs()] == [(1, 1, 1)]
+
+    @unittest.skipIf(not hasattr(htcondor, "JobEventLog"), "the bindings have no JobEventLog")
+    def test_job_queue_model_event_log(self):
+        events = read_file_as_string('test-files/condor-events.log')
+        first_event_end = events.index("...\n") + 4
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            event_log = os.path.join(tmp_dir, "events.log")
+            with open(event_log, "w") as f:
+                f.write(events[:first_event_end])
+            queries = []
+
+            def query(constraint):
+                queries.append(constraint)
+                if len(queries) == 1:
+                    return [{"ClusterId": 1, "ProcId": 0, "JobStatus": 1, "MinHosts": 1}]
+                return [{"ClusterId": 2, "ProcId": 0, "JobStatus": 2, "RemoteHost": "wn1"},
+                        {"ClusterId": 2, "ProcId": 1, "JobStatus": 5, "MinHosts": 1}]
+
+            model = condor.JobQueueModel(event_log, 300)
+            model.update(query)
+            assert queries == ['JobStatus =!= 3 && JobStatus =!= 4']
+            assert [job["ClusterId"] for job in model.get_jobs()] == [1]
+
+            with open(event_log, "a") as f:
+                f.write(events[first_event_end:])
+            model.update(query)
+            # Only the submitted and executed jobs that are still in the queue are queried
+            assert queries[1] == '(JobStatus =!= 3 && JobStatus =!= 4) && ' \
+                '((ClusterId == 2 && ProcId == 0) || (ClusterId == 2 && ProcId == 1))'
+            assert [(job["ClusterId"], job["ProcId"], job["JobStatus"]) for job in model.get_jobs()] == \
+                [(2, 0, 2), (2, 1, 5)]
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    @mock.patch('condor._LOGGER')
+    @mock.patch('condor.get_schedulers_list_from_Schedd')
+    @mock.patch('condor.JobQueueModel.update')
+    def test_get_jobinfolist_event_log(self, update, get_schedulers_list, _LOGGER):
+        get_schedulers_list.return_value = [{"Name": "local"}, {"Name": "remote"}]
+
+        def update_model(query):
+            lrms._queue_model._jobs = {(2, 0): {"ClusterId": 2, "ProcId": 0, "JobStatus": 2, "RemoteHost": "wn1",
+                                                "RequestCpus": 1, "ImageSize": 1}}
+        update.side_effect = update_model
+        lrms = condor.lrms(MagicMock(condor.lrms), HTCONDOR_EVENT_LOG="/var/log/condor/events.log")
+        job_info_list = lrms.get_jobinfolist()
+        assert [job.job_id for job in job_info_list] == ["2.0"]
+        assert lrms._get_hosts_usage() == {"wn1": (1.0, 1)}
+
+        update.side_effect = Exception("schedd down")
+        lrms._snapshot_timestamp = None
+        # The last jobs are kept, and the model is reconciled in the next pass
+        assert [job.job_id for job in lrms.get_jobinfolist()] == ["2.0"]
+        assert lrms._queue_model.needs_reconcile()
+        # The remote schedulers are ignored, which is only logged once
+        assert len([warning for warning in _LOGGER.warning.call_args_list if "1 schedulers" in warning[0][0]]) == 1
+
+    def test_job_queue_model_invalidate(self):
+        model = condor.JobQueueModel("unused.log", 300)
+        model._last_reconcile = time.time()
+        event_log = model._event_log = MagicMock()
+        model.invalidate()
+        assert model.needs_reconcile()
+        # The events are not read again from the start of the log
+        assert model._event_log is event_log
+
+    def test_get_machines_nodeinfolist(self):
+        slots = [{"Name": "slot1@wn1", "Machine": "wn1", "SlotType": "Partitionable", "State": "Unclaimed",
+                  "Cpus": 2, "Memory": 1024, "TotalSlotCpus": 4, "TotalSlotMemory": 4096},
+                 {"Name": "slot1_1@wn1", "Machine": "wn1", "SlotType": "Dynamic", "State": "Claimed",
+                  "Cpus": 2, "Memory": 3072},
+                 {"Name": "slot1@wn2", "Machine": "wn2", "SlotType": "Partitionable", "State": "Unclaimed",
+                  "Cpus": 4, "Memory": 4096, "TotalSlotCpus": 4, "TotalSlotMemory": 4096},
+                 {"Name": "slot1@wn3", "Machine": "wn3", "SlotType": "Static", "State": "Claimed",
+                  "Cpus": 1, "Memory": 512},
+                 {"Name": "slot2@wn3", "Machine": "wn3", "SlotType": "Static", "State": "Unclaimed",
+                  "Cpus": 1, "Memory": 512}]
+        node_info_list = condor.get_machines_nodeinfolist(slots)
+        assert sorted(node_info_list) == ["wn1", "wn2", "wn3"]
+        wn1 = node_info_list["wn1"]
+        assert (wn1.slots_count, wn1.slots_free, wn1.memory_total, wn1.memory_free) == (4, 2, 4096, 1024)
+        assert wn1.state == NodeInfo.USED
+        assert node_info_list["wn2"].state == NodeInfo.IDLE
+        wn3 = node_info_list["wn3"]
+        assert (wn3.slots_count, wn3.slots_free, wn3.memory_total, wn3.memory_free) == (2, 1, 1024, 512)
+        assert wn3.state == NodeInfo.USED
+
+    @mock.patch('htcondor.Schedd.xquery')
+    @mock.patch('condor.get_slots_list_from_Startd')
+    def test_get_nodeinfolist_from_startd_ads(self, get_slots_list, xquery):
+        get_slots_list.return_value = [
+            {"Name": "slot1@wn1", "Machine": "wn1", "SlotType": "Partitionable", "State": "Unclaimed",
+             "Cpus": 2, "Memory": 1024, "TotalSlotCpus": 2, "TotalSlotMemory": 1024}]
+        lrms = condor.lrms(MagicMock(condor.lrms), HTCONDOR_NODES_FROM_STARTD_ADS=True)
+        node_info_list = lrms.get_nodeinfolist()
+        assert list(node_info_list) == ["wn1"]
+        assert not xquery.called
+
 
 if __name__ == '__main__':
     unittest.main()
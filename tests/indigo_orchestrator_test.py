@@ -80,6 +80,7 @@ class TestMesosPlugin(unittest.TestCase):
     def test_powermanager_power_on(self):
         mock_pm = MagicMock(powermanager)
         mock_pm._mvs_seen = ["test1", "test2", "test3"]
+        mock_pm._power_on_ops = []
         mock_pm._INDIGO_ORCHESTRATOR_MAX_INSTANCES = 5
 
         self.assertEquals(
@@ -88,6 +89,7 @@ class TestMesosPlugin(unittest.TestCase):
     def test_powermanager_power_on_max_vm(self):
         mock_pm = MagicMock(powermanager)
         mock_pm._mvs_seen = ["test1", "test2", "test3"]
+        mock_pm._power_on_ops = []
         mock_pm._INDIGO_ORCHESTRATOR_MAX_INSTANCES = 1
 
         self.assertEquals(
@@ -96,6 +98,7 @@ class TestMesosPlugin(unittest.TestCase):
     def test_powermanager_power_on_vm_exists(self):
         mock_pm = MagicMock(powermanager)
         mock_pm._mvs_seen = ["test1", "test2", "test3"]
+        mock_pm._power_on_ops = []
         mock_pm._INDIGO_ORCHESTRATOR_MAX_INSTANCES = 5
 
         self.assertEquals(
@@ -364,8 +367,20 @@ class TestMesosPlugin(unittest.TestCase):
         get_resources.return_value = read_file_as_json(
             "test-files/get-resources-output.json")
         modify_deployment.return_value = 200, 'test'
-        powermanager()._power_on('vnode1')
+        pm = powermanager()
+        self.assertEquals(pm._power_on('vnode1'), True)
         self.assertIn("Node vnode1 successfully created", self.log.getvalue())
+        self.assertEquals([op.node_name for op in pm._power_on_ops], ['vnode1'])
+
+        # the operation is still pending, with a longer delay until the next check
+        now.return_value = 10.0
+        pm._check_power_on_ops()
+        self.assertEquals(len(pm._power_on_ops), 1)
+        self.assertEquals(pm._power_on_ops[0].next_check, 14.0)
+
+        now.return_value = 200.0
+        pm._check_power_on_ops()
+        self.assertEquals(pm._power_on_ops, [])
         self.assertIn(
             "Trying to get the uuids of the new node and get no new uuids", self.log.getvalue())
 
@@ -398,8 +413,131 @@ class TestMesosPlugin(unittest.TestCase):
         power_off.return_value = True
         get_resources.side_effect = self.get_resources
         modify_deployment.return_value = 200, 'test'
-        self.assertEquals(powermanager()._power_on('vnode1'), True)
+        pm = powermanager()
+        self.assertEquals(pm._power_on('vnode1'), True)
         self.assertIn("Node vnode1 successfully created", self.log.getvalue())
+        # the power on does not wait for the new VM
+        self.assertEquals(add_mvs_seen.call_count, 0)
+        self.assertEquals(get_resources.call_count, 1)
+
+        # it is assigned to the node in the next lifecycle
+        now.return_value = 5.0
+        pm._check_power_on_ops()
+        self.assertEquals(pm._power_on_ops, [])
+        self.assertEquals(add_mvs_seen.call_args_list[0][0][0], 'vnode1')
+        self.assertEquals(add_mvs_seen.call_args_list[0][0][1].vm_id, 'ee6a8510-974c-411c-b8ff-71bb133148eb')
+        self.assertIn("Node: vnode1 assigned to VM: ee6a8510-974c-411c-b8ff-71bb133148eb", self.log.getvalue())
+
+    @patch('cpyutils.eventloop.now')
+    def test_check_power_on_ops(self, now):
+        now.return_value = 1.0
+        mock_pm = MagicMock(powermanager)
+        mock_pm._INDIGO_ORCHESTRATOR_POWER_ON_TIMEOUT = 180
+        mock_pm._get_master_node_id.return_value = ['master']
+        assigned = {}
+        mock_pm._add_mvs_seen.side_effect = lambda name, vm: assigned.update({vm.vm_id: name})
+        mock_pm._get_nodename_from_uuid.side_effect = assigned.get
+        op1 = powermanager.PowerOnOperation('vnode1', ['old'])
+        op2 = powermanager.PowerOnOperation('vnode2', ['old', 'new1'])
+        op3 = powermanager.PowerOnOperation('vnode3', ['old', 'new1', 'new2'])
+        mock_pm._power_on_ops = [op1, op2, op3]
+        # all the new VMs have the same creation time
+        mock_pm._get_current_resources.return_value = [
+            {'uuid': 'master', 'creationTime': '2017-03-22T14:33+0000'},
+            {'uuid': 'new2', 'creationTime': '2017-03-22T15:29+0000'},
+            {'uuid': 'old', 'creationTime': '2017-03-22T15:00+0000'},
+            {'uuid': 'new1', 'creationTime': '2017-03-22T15:29+0000'}]
+
+        # not checked until the delay has passed
+        powermanager._check_power_on_ops(mock_pm)
+        self.assertEquals(mock_pm._get_current_resources.call_count, 0)
+
+        # each VM is assigned to the operation that did not have it before
+        now.return_value = 3.0
+        powermanager._check_power_on_ops(mock_pm)
+        self.assertEquals(sorted((args[0][0], args[0][1].vm_id) for args in mock_pm._add_mvs_seen.call_args_list),
+                          [('vnode1', 'new1'), ('vnode2', 'new2')])
+        self.assertEquals(mock_pm._power_on_ops, [op3])
+        self.assertEquals(op3.next_check, 7.0)
+
+        now.return_value = 200.0
+        powermanager._check_power_on_ops(mock_pm)
+        self.assertEquals(mock_pm._power_on_ops, [])
+        self.assertEquals(mock_pm._add_mvs_seen.call_count, 2)
+        self.assertIn("Error processing task: Power On on vnode3", self.log.getvalue())
+
+    @patch('cpyutils.eventloop.now')
+    def test_check_power_on_ops_ambiguous(self, now):
+        now.return_value = 3.0
+        mock_pm = MagicMock(powermanager)
+        mock_pm._INDIGO_ORCHESTRATOR_POWER_ON_TIMEOUT = 180
+        mock_pm._get_master_node_id.return_value = []
+        mock_pm._get_nodename_from_uuid.return_value = None
+        # the previous operation was requested before its VM was listed
+        op1 = powermanager.PowerOnOperation('vnode1', ['old'])
+        op2 = powermanager.PowerOnOperation('vnode2', ['old'])
+        mock_pm._power_on_ops = [op1, op2]
+        mock_pm._get_current_resources.return_value = [
+            {'uuid': 'old', 'creationTime': '2017-03-22T15:00+0000'},
+            {'uuid': 'new1', 'creationTime': '2017-03-22T15:29+0000'},
+            {'uuid': 'new2', 'creationTime': '2017-03-22T15:29+0000'}]
+
+        powermanager._check_power_on_ops(mock_pm)
+        # the VMs cannot be told apart, so none of them is assigned
+        self.assertEquals(mock_pm._add_mvs_seen.call_count, 0)
+        self.assertEquals(mock_pm._power_on_ops, [op1, op2])
+        self.assertIn("Trying to get the uuid of the new node vnode2 and get 2 uuids!!", self.log.getvalue())
+
+    @patch('cpyutils.eventloop.now')
+    def test_resources_snapshot(self, now):
+        now.return_value = 1.0
+        snapshot = powermanager.ResourceSnapshot(10)
+        self.assertEquals(snapshot.get(), None)
+
+        snapshot.update(['res1'])
+        self.assertEquals(snapshot.get(), ['res1'])
+        now.return_value = 11.0
+        self.assertEquals(snapshot.get(), None)
+
+        snapshot.update(['res2'])
+        self.assertEquals(snapshot.get(), ['res2'])
+        snapshot.invalidate()
+        self.assertEquals(snapshot.get(), None)
+
+    @patch('cpyutils.eventloop.now')
+    def test_get_current_resources(self, now):
+        now.return_value = 1.0
+        mock_pm = MagicMock(powermanager)
+        mock_pm._resources_snapshot = powermanager.ResourceSnapshot(10)
+        mock_pm._get_resources.side_effect = [['res1'], ['res2'], []]
+
+        self.assertEquals(powermanager._get_current_resources(mock_pm), ['res1'])
+        self.assertEquals(powermanager._get_current_resources(mock_pm), ['res1'])
+        self.assertEquals(mock_pm._get_resources.call_count, 1)
+        self.assertEquals(powermanager._get_current_resources(mock_pm, refresh=True), ['res2'])
+        # errors are not stored in the snapshot
+        self.assertEquals(powermanager._get_current_resources(mock_pm, refresh=True), [])
+        self.assertEquals(powermanager._get_current_resources(mock_pm), ['res2'])
+        self.assertEquals(mock_pm._get_resources.call_count, 3)
+
+    @patch('cpyutils.eventloop.now')
+    def test_power_on_stale_snapshot(self, now):
+        now.return_value = 1.0
+        mock_pm = MagicMock(powermanager)
+        mock_pm.PowerOnOperation = powermanager.PowerOnOperation
+        mock_pm._power_on_ops = []
+        mock_pm._resources_snapshot = powermanager.ResourceSnapshot(10)
+        mock_pm._get_current_resources.side_effect = (
+            lambda refresh=False: powermanager._get_current_resources(mock_pm, refresh))
+        mock_pm._get_master_node_id.return_value = ['master']
+        mock_pm._modify_deployment.return_value = 200, 'test'
+        # the VM of the node vnode1 appears after the snapshot was taken
+        mock_pm._resources_snapshot.update([{'uuid': 'master'}, {'uuid': 'old'}])
+        mock_pm._get_resources.return_value = [{'uuid': 'master'}, {'uuid': 'old'}, {'uuid': 'new1'}]
+
+        self.assertEquals(powermanager._power_on(mock_pm, 'vnode2'), True)
+        self.assertEquals(mock_pm._get_resources.call_count, 1)
+        self.assertEquals(mock_pm._power_on_ops[0].previous_uuids, ['old', 'new1'])
 
     def test_get_resources_error(self):
         mock_pm = MagicMock(powermanager)
@@ -408,6 +546,48 @@ class TestMesosPlugin(unittest.TestCase):
         self.assertIn(
             "ERROR getting deployment info: test", self.log.getvalue())
 
+    def test_get_resources_pages(self):
+        mock_pm = MagicMock(powermanager)
+        mock_pm._INDIGO_ORCHESTRATOR_PAGE_SIZE = 3
+        mock_pm._INDIGO_ORCHESTRATOR_MAX_PAGE_SIZE = 100
+        mock_pm._INDIGO_ORCHESTRATOR_PAGE_RETRIES = 2
+        mock_pm._page_size = 3
+        mock_pm._get_page_pool.return_value.map.side_effect = map
+        mock_pm._get_resources_page_content.side_effect = (
+            lambda page: powermanager._get_resources_page_content(mock_pm, page))
+        mock_pm._adapt_page_size.side_effect = lambda info: powermanager._adapt_page_size(mock_pm, info)
+        # the second page fails once, and it is retried on its own
+        responses = [self.get_resources_page(0), (500, 'error'), self.get_resources_page(1)]
+        mock_pm._get_resources_page.side_effect = lambda page=0: responses.pop(0)
+
+        resources = powermanager._get_resources(mock_pm)
+
+        self.assertEquals([res['uuid'] for res in resources],
+                          ['dd4382b0-44ab-4292-8b21-2025ae654c0c', 'ee6a8510-974c-411c-b8ff-71bb133148eb'])
+        self.assertEquals(mock_pm._get_resources_page.call_args_list, [call(), call(1), call(1)])
+        self.assertIn("Error getting deployment info page 1 (attempt 1): error", self.log.getvalue())
+        # 5 resources in the deployment
+        self.assertEquals(mock_pm._page_size, 8)
+
+    def test_get_resources_missing_page(self):
+        mock_pm = MagicMock(powermanager)
+        mock_pm._get_page_pool.return_value.map.side_effect = map
+        # the second page cannot be obtained after its retries
+        mock_pm._get_resources_page.return_value = self.get_resources_page(0)
+        mock_pm._get_resources_page_content.return_value = None
+
+        self.assertEquals(powermanager._get_resources(mock_pm), [])
+        self.assertIn("ERROR getting deployment info: some pages could not be obtained.", self.log.getvalue())
+
+    def test_get_resources_page_error(self):
+        mock_pm = MagicMock(powermanager)
+        mock_pm._INDIGO_ORCHESTRATOR_PAGE_RETRIES = 1
+        mock_pm._get_resources_page.return_value = 500, 'error'
+
+        self.assertEquals(powermanager._get_resources_page_content(mock_pm, 2), None)
+        self.assertEquals(mock_pm._get_resources_page.call_args_list, [call(2), call(2)])
+        self.assertIn("ERROR getting deployment info: error, page 2", self.log.getvalue())
+
     def test_create_db(self):
         mock_pm = MagicMock(powermanager)
         mock_pm._db = MagicMock()
@@ -429,9 +609,9 @@ class TestMesosPlugin(unittest.TestCase):
         self.assertIn(
             "Error creating INDIGO orchestrator plugin DB", self.log.getvalue())
 
-    @patch('requests.request')
-    def test_get_deployment_status_error(self, requests):
+    def test_get_deployment_status_error(self):
         mock_pm = MagicMock(powermanager)
+        requests = mock_pm._request
         mock_pm._get_inf_id.return_value = 'ORCH_ID'
         mock_pm._get_auth_header.return_value = None
         mock_pm._INDIGO_ORCHESTRATOR_URL = "https://localhost/orchestrator"
@@ -439,12 +619,12 @@ class TestMesosPlugin(unittest.TestCase):
 
         self.assertEquals(requests.call_args_list,
                           [call('GET', 'https://localhost/orchestrator/deployments/ORCH_ID',
-                                headers={'Connection': 'close', 'Accept': 'application/json'})])
+                                headers={'Accept': 'application/json'})])
         self.assertIn("ERROR getting deployment status:", self.log.getvalue())
 
-    @patch('requests.request')
-    def test_get_deployment_status(self, requests):
+    def test_get_deployment_status(self):
         mock_pm = MagicMock(powermanager)
+        requests = mock_pm._request
         mock_pm._get_inf_id.return_value = 'ORCH_ID'
         mock_pm._get_auth_header.return_value = None
         mock_pm._INDIGO_ORCHESTRATOR_URL = "https://localhost/orchestrator"
@@ -458,7 +638,7 @@ class TestMesosPlugin(unittest.TestCase):
             powermanager._get_deployment_status(mock_pm), "test_stat")
         self.assertEquals(requests.call_args_list,
                           [call('GET', 'https://localhost/orchestrator/deployments/ORCH_ID',
-                                headers={'Connection': 'close', 'Accept': 'application/json'})])
+                                headers={'Accept': 'application/json'})])
         self.assertIn("Deployment in status: test_stat", self.log.getvalue())
 
     def test_delete_mvs_seen(self):
@@ -503,9 +683,9 @@ class TestMesosPlugin(unittest.TestCase):
         self.assertIn(
             "Error trying to save INDIGO orchestrator plugin data", self.log.getvalue())
 
-    @patch('requests.request')
-    def test_modify_deployment(self, requests):
+    def test_modify_deployment(self):
         mock_pm = MagicMock(powermanager)
+        requests = mock_pm._request
         mock_pm._get_inf_id.return_value = 'TEST_ID'
 
         mock_response = MagicMock()
@@ -516,14 +696,16 @@ class TestMesosPlugin(unittest.TestCase):
         mock_pm._get_auth_header.return_value = None
         mock_pm._INDIGO_ORCHESTRATOR_URL = "https://localhost/orchestrator"
         mock_pm._get_template.return_value = 'test_template\n"test_parser"'
+        mock_pm._resources_snapshot = MagicMock()
 
         self.assertEquals(powermanager._modify_deployment(
             mock_pm, ['1', '2']), (200, '{"status" : "test_stat"}'))
+        self.assertEquals(mock_pm._resources_snapshot.invalidate.call_count, 1)
         self.assertIn('test_template\n"test_parser"', self.log.getvalue())
         self.assertEquals(requests.call_args_list,
                           [call('PUT', 'https://localhost/orchestrator/deployments/TEST_ID',
                                 data='{ "template": "test_template\\n\\"test_parser\\"" }',
-                                headers={'Connection': 'close', 'Content-Type': 'application/json',
+                                headers={'Content-Type': 'application/json',
                                          'Accept': 'application/json'})])
 
     def test_find_wn_nodetemplate_name(self):
@@ -538,9 +720,9 @@ class TestMesosPlugin(unittest.TestCase):
         self.assertIn(
             'Error trying to get the WN template', self.log.getvalue())
 
-    @patch('requests.request')
-    def test_get_template_no_node_changes(self, requests):
+    def test_get_template_no_node_changes(self):
         mock_pm = MagicMock(powermanager)
+        requests = mock_pm._request
         mock_pm._get_inf_id.return_value = 'TEST_ID'
         mock_pm._get_auth_header.return_value = None
 
@@ -555,11 +737,11 @@ class TestMesosPlugin(unittest.TestCase):
                           read_file_as_string('test-files/template_result_no_node_changes'))
         self.assertEquals(requests.call_args_list,
                           [call('GET', 'https://localhost/orchestrator/deployments/TEST_ID/template',
-                                headers={'Connection': 'close', 'Accept': 'text/plain'})])
+                                headers={'Accept': 'text/plain'})])
 
-    @patch('requests.request')
-    def test_get_template_error(self, requests):
+    def test_get_template_error(self):
         mock_pm = MagicMock(powermanager)
+        requests = mock_pm._request
         mock_pm._get_inf_id.return_value = 'TEST_ID'
         mock_pm._get_auth_header.return_value = None
 
@@ -575,9 +757,9 @@ class TestMesosPlugin(unittest.TestCase):
         self.assertIn(
             'ERROR getting deployment template: test', self.log.getvalue())
 
-    @patch('requests.request')
-    def test_get_template_add_one_node(self, requests):
+    def test_get_template_add_one_node(self):
         mock_pm = MagicMock(powermanager)
+        requests = mock_pm._request
         mock_pm._get_inf_id.return_value = 'TEST_ID'
         mock_pm._get_auth_header.return_value = None
 
@@ -593,11 +775,11 @@ class TestMesosPlugin(unittest.TestCase):
                           read_file_as_string('test-files/template_result_add_one_node'))
         self.assertEquals(requests.call_args_list,
                           [call('GET', 'https://localhost/orchestrator/deployments/TEST_ID/template',
-                                headers={'Connection': 'close', 'Accept': 'text/plain'})])
+                                headers={'Accept': 'text/plain'})])
 
-    @patch('requests.request')
-    def test_get_template_add_several_nodes(self, requests):
+    def test_get_template_add_several_nodes(self):
         mock_pm = MagicMock(powermanager)
+        requests = mock_pm._request
         mock_pm._get_inf_id.return_value = 'TEST_ID'
         mock_pm._get_auth_header.return_value = None
 
@@ -616,11 +798,11 @@ class TestMesosPlugin(unittest.TestCase):
 
         self.assertEquals(requests.call_args_list,
                           [call('GET', 'https://localhost/orchestrator/deployments/TEST_ID/template',
-                                headers={'Connection': 'close', 'Accept': 'text/plain'})])
+                                headers={'Accept': 'text/plain'})])
 
-    @patch('requests.request')
-    def test_get_template_remove_nodes(self, requests):
+    def test_get_template_remove_nodes(self):
         mock_pm = MagicMock(powermanager)
+        requests = mock_pm._request
         mock_pm._get_inf_id.return_value = 'TEST_ID'
         mock_pm._get_auth_header.return_value = None
 
@@ -637,11 +819,11 @@ class TestMesosPlugin(unittest.TestCase):
                           read_file_as_string('test-files/template_result_remove_nodes'))
         self.assertEquals(requests.call_args_list,
                           [call('GET', 'https://localhost/orchestrator/deployments/TEST_ID/template',
-                                headers={'Connection': 'close', 'Accept': 'text/plain'})])
+                                headers={'Accept': 'text/plain'})])
 
-    @patch('requests.request')
-    def test_get_refresh_token(self, requests):
+    def test_get_refresh_token(self):
         mock_pm = MagicMock(powermanager)
+        requests = mock_pm._request
         access_token = ("eyJraWQiOiJyc2ExIiwiYWxnIjoiUlMyNTYifQ.eyJzdWIiOiJkYzVkNWFiNy02ZGI5LTQwNzktOTg1Yy04MGF"
                         "jMDUwMTcwNjYiLCJpc3MiOiJodHRwczpcL1wvaWFtLXRlc3QuaW5kaWdvLWRhdGFjbG91ZC5ldVwvIiwiZXhwI"
                         "joxNDY1NDcxMzU0LCJpYXQiOjE0NjU0Njc3NTUsImp0aSI6IjA3YjlkYmE4LTc3NWMtNGI5OS1iN2QzLTk4Njg"
@@ -666,11 +848,12 @@ class TestMesosPlugin(unittest.TestCase):
                                 data=('client_id=cid&client_secret=csec&grant_type=urn%3Aietf%3Aparams%3Aoauth%3A'
                                       'grant-type%3Atoken-exchange&subject_token=' + access_token + '&scope'
                                       '=openid profile offline_access'),
-                                headers={'content-type': 'application/x-www-form-urlencoded'}, verify=False)])
+                                headers={'content-type': 'application/x-www-form-urlencoded', 'Authorization': None},
+                                verify=False)])
 
-    @patch('requests.request')
-    def test_refresh_access_token(self, requests):
+    def test_refresh_access_token(self):
         mock_pm = MagicMock(powermanager)
+        requests = mock_pm._request
         access_token = ("eyJraWQiOiJyc2ExIiwiYWxnIjoiUlMyNTYifQ.eyJzdWIiOiJkYzVkNWFiNy02ZGI5LTQwNzktOTg1Yy04MGF"
                         "jMDUwMTcwNjYiLCJpc3MiOiJodHRwczpcL1wvaWFtLXRlc3QuaW5kaWdvLWRhdGFjbG91ZC5ldVwvIiwiZXhwI"
                         "joxNDY1NDcxMzU0LCJpYXQiOjE0NjU0Njc3NTUsImp0aSI6IjA3YjlkYmE4LTc3NWMtNGI5OS1iN2QzLTk4Njg"
@@ -694,7 +877,39 @@ class TestMesosPlugin(unittest.TestCase):
                           [call('POST', u'https://iam-test.indigo-datacloud.eu//token',
                                 data=('client_id=cid&client_secret=csec&grant_type=refresh_token&'
                                       'scope=openid profile offline_access&refresh_token=refresh_token'),
-                                headers={'content-type': 'application/x-www-form-urlencoded'}, verify=False)])
+                                headers={'content-type': 'application/x-www-form-urlencoded', 'Authorization': None},
+                                verify=False)])
+
+    def test_session(self):
+        mock_pm = MagicMock(powermanager)
+        mock_pm._session = None
+        mock_pm._auth_data = "token1"
+        mock_pm._INDIGO_ORCHESTRATOR_POOL_SIZE = 5
+        mock_pm._INDIGO_ORCHESTRATOR_RETRIES = 2
+        mock_pm._get_auth_header.side_effect = lambda: powermanager._get_auth_header(mock_pm)
+
+        session = powermanager._get_session(mock_pm)
+        self.assertIs(mock_pm._session, session)
+        self.assertEquals(session.headers['Authorization'], 'Bearer token1')
+        adapter = session.get_adapter("https://localhost/orchestrator")
+        self.assertEquals(adapter._pool_maxsize, 5)
+        self.assertEquals(adapter.max_retries.total, 2)
+        self.assertEquals(adapter.max_retries.method_whitelist, frozenset(['GET']))
+        self.assertFalse(adapter.max_retries.raise_on_status)
+
+        # the token is updated in place in the shared session
+        mock_pm._get_session.return_value = session
+        powermanager._set_auth_data(mock_pm, "token2")
+        self.assertEquals(session.headers['Authorization'], 'Bearer token2')
+        powermanager._set_auth_data(mock_pm, "")
+        self.assertNotIn('Authorization', session.headers)
+
+        mock_pm._get_session.return_value = MagicMock()
+        mock_pm._timeout = (10, 60)
+        powermanager._request(mock_pm, "GET", "https://localhost/orchestrator", headers={'Accept': 'text/plain'})
+        self.assertEquals(mock_pm._get_session.return_value.request.call_args_list,
+                          [call("GET", "https://localhost/orchestrator", timeout=(10, 60),
+                                headers={'Accept': 'text/plain'})])
 
     def test_is_access_token_to_expire(self):
         mock_pm = MagicMock(powermanager)
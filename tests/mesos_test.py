@@ -3,9 +3,12 @@ import mesos
 import os
 import mock
 import json
+import time
+import threading
+import BaseHTTPServer
 from clueslib.node import NodeInfo
 from clueslib.request import Request
-from mock import MagicMock
+from mock import MagicMock, call
 
 
 def read_file(file_name):
@@ -24,6 +27,43 @@ def read_file_as_json(file_name):
     return json.loads(read_file_as_string(file_name))
 
 
+def parse_file(file_name):
+    # Mocks http_command, passing the file to its parser (the 8th argument)
+    return lambda *args: args[7](read_file(file_name))
+
+
+def get_tasks_for_table():
+    tasks = []
+    for slave_id, state, cpus, mem in [('S0', 'TASK_RUNNING', 1, 512), ('S1', 'TASK_STAGING', 1, 128),
+                                       ('S0', 'TASK_RUNNING', 0.5, 256), ('S2', 'TASK_FINISHED', 2, 1024),
+                                       ('S1', 'TASK_RUNNING', 0.5, 256)]:
+        tasks.append({'slave_id': slave_id, 'state': state, 'resources': {'cpus': cpus, 'mem': mem}})
+    return tasks
+
+
+class FakeMesosMaster(BaseHTTPServer.BaseHTTPRequestHandler):
+    ''' Mesos master that replays a recorded event stream of the v1 operator API to each subscriber '''
+    subscriptions = 0
+
+    def do_POST(self):
+        FakeMesosMaster.subscriptions += 1
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(read_file_as_string("test-files/mesos-operator-events.recordio"))
+
+    def log_message(self, format, *args):
+        pass
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.05)
+    return condition()
+
+
 class TestMesosPlugin(unittest.TestCase):
 
     def test_run_command(self):
@@ -53,26 +93,198 @@ class TestMesosPlugin(unittest.TestCase):
     def test_curl_command_error(self):
         mesos.curl_command("echo test", "test-ip", "Error")
 
+    @mock.patch('mesos.run_command')
+    def test_curl_command_timeout(self, mock_run_command):
+        mock_run_command.return_value = "{}"
+        mesos.curl_command("/usr/bin/curl -L http://mesosserverpublic:5050/master/tasks.json", "test-ip", "error",
+                           timeout=5)
+        assert mock_run_command.call_args[0][0] == ['/usr/bin/curl', '--max-time', '5', '-L',
+                                                    'http://mesosserverpublic:5050/master/tasks.json']
+        mesos.curl_command("/usr/bin/curl -m 10 http://mesosserverpublic:5050/master/tasks.json", "test-ip", "error",
+                           timeout=5)
+        assert mock_run_command.call_args[0][0] == ['/usr/bin/curl', '-m', '10',
+                                                    'http://mesosserverpublic:5050/master/tasks.json']
+
+    def test_get_command_url(self):
+        assert mesos.get_command_url(
+            '/usr/bin/curl -L -X GET http://mesosserverpublic:5050/master/slaves') == \
+            'http://mesosserverpublic:5050/master/slaves'
+        assert mesos.get_command_url('https://mesosserverpublic:5050/master/slaves') == \
+            'https://mesosserverpublic:5050/master/slaves'
+        assert mesos.get_command_url('/usr/bin/curl -L -X GET') is None
+
+    def test_http_command(self):
+        session = MagicMock()
+        session.get.return_value.status_code = 200
+        session.get.return_value.json.return_value = read_file_as_json("test-files/mesos-master-tasks.json")
+        assert mesos.http_command(session, '/usr/bin/curl -L -X GET http://mesosserverpublic:5050/master/tasks.json',
+                                  "test-ip", "error", timeout=5) == \
+            read_file_as_json("test-files/mesos-master-tasks.json")
+        session.get.assert_called_once_with('http://mesosserverpublic:5050/master/tasks.json', timeout=5)
+
+    def test_get_command_request(self):
+        assert mesos.get_command_request('/usr/bin/curl -L -X GET http://mesosserverpublic:5050/master/slaves') == \
+            ('http://mesosserverpublic:5050/master/slaves', {})
+        assert mesos.get_command_request(
+            'curl -sSL -u user:pass -H "Authorization: token=abc" --cacert /etc/ca.pem '
+            'https://mesosserverpublic:5050/master/slaves') == \
+            ('https://mesosserverpublic:5050/master/slaves',
+             {'auth': ('user', 'pass'), 'headers': {'Authorization': 'token=abc'}, 'verify': '/etc/ca.pem'})
+        assert mesos.get_command_request('/usr/bin/curl -k https://mesosserverpublic:5050/master/slaves') == \
+            ('https://mesosserverpublic:5050/master/slaves', {'verify': False})
+        # Options that cannot be translated
+        assert mesos.get_command_request('/usr/bin/curl --cert client.pem https://mesosserverpublic:5050/') is None
+        assert mesos.get_command_request('/usr/bin/curl -X POST https://mesosserverpublic:5050/') is None
+        assert mesos.get_command_request('/usr/local/bin/query http://mesosserverpublic:5050/') is None
+
+    def test_http_command_options(self):
+        session = MagicMock()
+        session.get.return_value.status_code = 200
+        mesos.http_command(session, '/usr/bin/curl -L -u user:pass -k https://mesosserverpublic:8080/v2/apps',
+                           "test-ip", "error", timeout=5)
+        session.get.assert_called_once_with('https://mesosserverpublic:8080/v2/apps', timeout=5,
+                                            auth=('user', 'pass'), verify=False)
+
+    @mock.patch('mesos.http_command')
     @mock.patch('mesos.curl_command')
-    def test_obtain_mesos_jobs(self, mock_curl_command):
+    def test_query_unsupported_command(self, mock_curl_command, mock_http_command):
+        command = '/usr/bin/curl -L --cert client.pem https://mesosserverpublic:5050/master/tasks.json'
         mock_curl_command.return_value = read_file_as_json("test-files/mesos-master-tasks.json")
-        mesos.lrms(MagicMock(mesos.lrms))._obtain_mesos_jobs()
+        lrms = mesos.lrms(MagicMock(mesos.lrms), MESOS_JOBS_COMMAND=command)
+        assert lrms._obtain_mesos_jobs() == read_file_as_json("test-files/mesos-master-tasks.json")
+        assert mock_curl_command.call_args[0][0] == command
+        assert not mock_http_command.called
+
+    def test_http_command_error(self):
+        session = MagicMock()
+        session.get.return_value.status_code = 500
+        session.get.return_value.text = "error"
+        assert mesos.http_command(session, 'http://mesosserverpublic:5050/master/tasks.json', "test-ip",
+                                  "error") is None
+
+    def test_mesos_leader(self):
+        redirect = MagicMock(status_code=307, headers={'Location': '//10.0.0.2:5050'})
+        ok = MagicMock(status_code=200)
+        session = MagicMock()
+        session.get.side_effect = [redirect, ok, ok]
+        leader = mesos.MesosLeader([])
+        assert leader.get(session, 'http://mesosserverpublic:5050/master/tasks.json', 5) == ok
+        assert leader.get(session, 'http://mesosserverpublic:5050/master/slaves', 5) == ok
+        # The leader is located only once
+        assert session.get.call_args_list == [
+            call('http://mesosserverpublic:5050/master/redirect', timeout=5, allow_redirects=False),
+            call('http://10.0.0.2:5050/master/tasks.json', timeout=5, allow_redirects=False),
+            call('http://10.0.0.2:5050/master/slaves', timeout=5, allow_redirects=False)]
+
+    def test_mesos_leader_changed(self):
+        session = MagicMock()
+        session.get.side_effect = [
+            mesos.requests.exceptions.ConnectionError(),
+            MagicMock(status_code=307, headers={'Location': '//10.0.0.2:5050'}),
+            MagicMock(status_code=307, headers={'Location': '//10.0.0.3:5050'}),
+            MagicMock(status_code=307, headers={'Location': '//10.0.0.3:5050'}),
+            MagicMock(status_code=200)]
+        leader = mesos.MesosLeader(['10.0.0.1:5050', '10.0.0.2:5050'])
+        assert leader.get(session, 'http://mesosserverpublic:5050/master/slaves', 5).status_code == 200
+        # The first candidate is down and the leader changes after being located, so it is located again
+        assert [args[0][0] for args in session.get.call_args_list] == [
+            'http://10.0.0.1:5050/master/redirect', 'http://10.0.0.2:5050/master/redirect',
+            'http://10.0.0.2:5050/master/slaves', 'http://10.0.0.1:5050/master/redirect',
+            'http://10.0.0.3:5050/master/slaves']
+
+    def test_mesos_leader_other_servers(self):
+        session = MagicMock()
+        mesos.MesosLeader([]).get(session, 'http://mesosserverpublic:8080/v2/apps', 5)
+        session.get.assert_called_once_with('http://mesosserverpublic:8080/v2/apps', timeout=5)
+
+    @mock.patch('mesos.http_command')
+    @mock.patch('mesos.curl_command')
+    def test_obtain_mesos_jobs_curl_backend(self, mock_curl_command, mock_http_command):
+        mock_curl_command.return_value = read_file_as_json("test-files/mesos-master-tasks.json")
+        mesos.lrms(MagicMock(mesos.lrms), MESOS_HTTP_BACKEND="curl")._obtain_mesos_jobs()
         command = mock_curl_command.call_args[0][0]
         assert command == '/usr/bin/curl -L -X GET http://mesosserverpublic:5050/master/tasks.json'
+        assert not mock_http_command.called
 
-    @mock.patch('mesos.curl_command')
-    def test_obtain_mesos_nodes(self, mock_curl_command):
-        mock_curl_command.return_value = read_file_as_json("test-files/mesos-master-slaves.json")
+    @mock.patch('mesos.http_command')
+    def test_obtain_mesos_jobs(self, mock_http_command):
+        mock_http_command.return_value = read_file_as_json("test-files/mesos-master-tasks.json")
+        mesos.lrms(MagicMock(mesos.lrms))._obtain_mesos_jobs()
+        command = mock_http_command.call_args[0][1]
+        assert command == '/usr/bin/curl -L -X GET http://mesosserverpublic:5050/master/tasks.json'
+
+    @mock.patch('mesos.http_command')
+    def test_obtain_mesos_nodes(self, mock_http_command):
+        mock_http_command.return_value = read_file_as_json("test-files/mesos-master-slaves.json")
         mesos.lrms(MagicMock(mesos.lrms))._obtain_mesos_nodes()
-        command = mock_curl_command.call_args[0][0]
+        command = mock_http_command.call_args[0][1]
         assert command == '/usr/bin/curl -L -X GET http://mesosserverpublic:5050/master/slaves'
 
-    @mock.patch('mesos.curl_command')
-    def test_obtain_mesos_state(self, mock_curl_command):
-        mock_curl_command.return_value = read_file_as_json("test-files/mesos-state.json")
+    @mock.patch('mesos.http_command')
+    def test_obtain_mesos_state(self, mock_http_command):
+        mock_http_command.return_value = read_file_as_json("test-files/mesos-state.json")
         mesos.lrms(MagicMock(mesos.lrms))._obtain_mesos_state()
-        command = mock_curl_command.call_args[0][0]
+        command = mock_http_command.call_args[0][1]
         assert command == '/usr/bin/curl -L -X GET http://mesosserverpublic:5050/master/state.json'
+        assert mock_http_command.call_args[0][7] == mesos.parse_mesos_state
+
+    @mock.patch('mesos.curl_command')
+    def test_obtain_mesos_state_curl_backend(self, mock_curl_command):
+        mock_curl_command.return_value = read_file_as_string("test-files/mesos-state.json")
+        mesos_state = mesos.lrms(MagicMock(mesos.lrms), MESOS_HTTP_BACKEND="curl")._obtain_mesos_state()
+        assert mesos_state == mesos.project_mesos_state(read_file_as_json("test-files/mesos-state.json"))
+
+    def test_project_mesos_state(self):
+        mesos_state = mesos.project_mesos_state(read_file_as_json("test-files/mesos-state.json"))
+        assert [framework['name'] for framework in mesos_state['frameworks']] == ['', 'chronos-2.3.4']
+        assert mesos_state['frameworks'][0]['tasks'] == [
+            {'state': 'TASK_RUNNING', 'slave_id': '20150925-075030-1063856798-5050-3482-S0'}]
+        assert set(mesos_state['frameworks'][0]) == set(['name', 'id', 'resources', 'tasks'])
+
+    @mock.patch('mesos.ijson', None)
+    def test_parse_mesos_state(self):
+        assert mesos.parse_mesos_state(read_file("test-files/mesos-state.json")) == \
+            mesos.project_mesos_state(read_file_as_json("test-files/mesos-state.json"))
+
+    @unittest.skipIf(mesos.ijson is None, "ijson is not installed")
+    def test_parse_mesos_state_streaming(self):
+        assert mesos.parse_mesos_state(read_file("test-files/mesos-state.json")) == \
+            mesos.project_mesos_state(read_file_as_json("test-files/mesos-state.json"))
+
+    @mock.patch('mesos.http_command')
+    def test_obtain_mesos_jobs_snapshot(self, mock_http_command):
+        mock_http_command.return_value = read_file_as_json("test-files/mesos-master-tasks.json")
+        lrms = mesos.lrms(MagicMock(mesos.lrms))
+        lrms._obtain_mesos_jobs()
+        lrms._obtain_cpu_mem_used_in_mesos_node("20150925-075030-1063856798-5050-3482-S0")
+        lrms._obtain_mesos_used_nodes()
+        assert mock_http_command.call_count == 1
+
+    @mock.patch('mesos.http_command')
+    def test_obtain_mesos_jobs_snapshot_expired(self, mock_http_command):
+        mock_http_command.return_value = read_file_as_json("test-files/mesos-master-tasks.json")
+        lrms = mesos.lrms(MagicMock(mesos.lrms), MESOS_SNAPSHOT_TTL=-1)
+        lrms._obtain_mesos_jobs()
+        lrms._obtain_mesos_jobs()
+        assert mock_http_command.call_count == 2
+
+    @mock.patch('mesos.MesosSnapshot')
+    def test_get_snapshot_concurrent(self, mock_snapshot):
+        def create_snapshot(ttl):
+            time.sleep(0.1)
+            return MagicMock(is_expired=MagicMock(return_value=False))
+
+        mock_snapshot.side_effect = create_snapshot
+        lrms = mesos.lrms(MagicMock(mesos.lrms))
+        snapshots = []
+        threads = [threading.Thread(target=lambda: snapshots.append(lrms._get_snapshot())) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # The job lists obtained concurrently share a single snapshot
+        assert mock_snapshot.call_count == 1
+        assert snapshots[0] is snapshots[1] is snapshots[2]
 
     @mock.patch('mesos.lrms._obtain_mesos_jobs')
     def test_obtain_used_nodes(self, mock_obtain_mesos_jobs):
@@ -88,6 +300,24 @@ class TestMesosPlugin(unittest.TestCase):
         assert mesos.lrms(MagicMock(mesos.lrms))._obtain_cpu_mem_used_in_mesos_node(
             "20150925-075030-1063856798-5050-3482-S0") == (1.0, 536870912)
 
+    def test_task_table(self):
+        task_table = mesos.TaskTable(get_tasks_for_table())
+        assert task_table.get_usage(["TASK_RUNNING"]) == {'S0': (1.5, 768.0), 'S1': (0.5, 256.0)}
+        assert task_table.get_usage(["TASK_STAGING"]) == {'S1': (1.0, 128.0)}
+        assert task_table.get_used_slaves(["TASK_RUNNING", "TASK_STAGING"]) == ['S0', 'S1']
+        assert task_table.get_used_slaves(["TASK_STAGING"]) == ['S1']
+
+    @mock.patch('mesos.numpy', None)
+    def test_task_table_without_numpy(self):
+        task_table = mesos.TaskTable(get_tasks_for_table())
+        assert task_table.get_usage(["TASK_RUNNING"]) == {'S0': (1.5, 768.0), 'S1': (0.5, 256.0)}
+        assert task_table.get_used_slaves(["TASK_STAGING"]) == ['S1']
+
+    def test_task_table_empty(self):
+        task_table = mesos.TaskTable([])
+        assert task_table.get_usage(["TASK_RUNNING"]) == {}
+        assert task_table.get_used_slaves(["TASK_RUNNING"]) == []
+
     def test_infer_clues_node_state_idle(self):
         assert mesos.infer_clues_node_state('1', 'active=false', ['3', '5', 'active=true']) == NodeInfo.IDLE
 
@@ -126,21 +356,36 @@ class TestMesosPlugin(unittest.TestCase):
         assert mesos.lrms(MagicMock(mesos.lrms))._obtain_chronos_jobs_nodes(
             'dockerjob') == [u'10.0.0.84', u'10.0.0.84', u'10.0.0.84']
 
-    @mock.patch('mesos.curl_command')
-    def test_obtain_chronos_jobs(self, mock_curl_command):
-        mock_curl_command.return_value = "test_output"
+    @mock.patch('mesos.http_command')
+    def test_obtain_chronos_jobs(self, mock_http_command):
+        mock_http_command.return_value = "test_output"
         assert mesos.lrms(MagicMock(mesos.lrms))._obtain_chronos_jobs() == "test_output"
 
-    @mock.patch('mesos.curl_command')
-    def test_obtain_chronos_job_state_attended(self, mock_curl_command):
-        mock_curl_command.return_value = read_file_as_string("test-files/chronos-state.json")
+    @mock.patch('mesos.http_command')
+    def test_obtain_chronos_job_state_attended(self, mock_http_command):
+        mock_http_command.side_effect = parse_file("test-files/chronos-state.json")
         assert mesos.lrms(MagicMock(mesos.lrms))._obtain_chronos_job_state('Infinite') == Request.ATTENDED
 
-    @mock.patch('mesos.curl_command')
-    def test_obtain_chronos_job_state_pending(self, mock_curl_command):
-        mock_curl_command.return_value = read_file_as_string("test-files/chronos-state.json")
+    @mock.patch('mesos.http_command')
+    def test_obtain_chronos_job_state_pending(self, mock_http_command):
+        mock_http_command.side_effect = parse_file("test-files/chronos-state.json")
         assert mesos.lrms(MagicMock(mesos.lrms))._obtain_chronos_job_state('SAMPLE_JOB1') == Request.PENDING
 
+    def test_parse_chronos_jobs_state(self):
+        jobs_state = mesos.parse_chronos_jobs_state(read_file("test-files/chronos-state.json"))
+        assert jobs_state == {'test2': Request.ATTENDED, 'Infinite2': Request.ATTENDED,
+                              'SAMPLE_JOB1': Request.PENDING, 'hostings_earnings_summary': Request.ATTENDED,
+                              'Infinite': Request.ATTENDED, 'test': Request.ATTENDED}
+
+    @mock.patch('mesos.http_command')
+    def test_obtain_chronos_job_state_snapshot(self, mock_http_command):
+        mock_http_command.side_effect = parse_file("test-files/chronos-state.json")
+        lrms = mesos.lrms(MagicMock(mesos.lrms))
+        assert lrms._obtain_chronos_job_state('SAMPLE_JOB1') == Request.PENDING
+        assert lrms._obtain_chronos_job_state('Infinite') == Request.ATTENDED
+        assert lrms._obtain_chronos_job_state('unknown') is None
+        assert mock_http_command.call_count == 1
+
     @mock.patch('mesos.lrms._obtain_chronos_job_state')
     @mock.patch('mesos.lrms._obtain_mesos_nodes')
     @mock.patch('mesos.lrms._obtain_mesos_jobs')
@@ -192,9 +437,9 @@ class TestMesosPlugin(unittest.TestCase):
         assert job_created.resources.resources.memory == 536870912
         assert job_created.resources.resources.requests == ['"default" in queues']
 
-    @mock.patch('mesos.curl_command')
-    def test_obtain_marathon_jobs(self, curl_command):
-        curl_command.return_value = "test_output"
+    @mock.patch('mesos.http_command')
+    def test_obtain_marathon_jobs(self, http_command):
+        http_command.return_value = "test_output"
         assert mesos.lrms(MagicMock(mesos.lrms))._obtain_marathon_jobs() == "test_output"
 
     @mock.patch('mesos.lrms._obtain_marathon_jobs')
@@ -238,6 +483,7 @@ class TestMesosPlugin(unittest.TestCase):
         assert lrms._marathon == '/usr/bin/curl -L -X GET http://mesosserverpublic:8080/v2/apps?embed=tasks'
         assert lrms._chronos == '/usr/bin/curl -L -X GET http://mesosserverpublic:4400/scheduler/jobs'
         assert lrms._chronos_state == '/usr/bin/curl -L -X GET http://mesosserverpublic:4400/scheduler/graph/csv'
+        assert lrms._http_backend == 'native'
         assert lrms.get_id() == 'MESOS_mesosserverpublic'
 
     def test_init_lrms(self):
@@ -266,6 +512,61 @@ class TestMesosPlugin(unittest.TestCase):
             result = '[NODE "vnode2"] state: off, 1/1 (free slots), 1572864000/1572864000 (mem)'
             assert str(nodeinfolist['vnode2']) == result
 
+    @mock.patch('mesos.lrms._obtain_mesos_jobs')
+    @mock.patch('mesos.lrms._obtain_mesos_nodes')
+    @mock.patch('mesos.open_file')
+    def test_get_nodeinfolist_usage_from_slaves(self, open_file, _obtain_mesos_nodes, _obtain_mesos_jobs):
+        open_file.return_value = read_file("test-files/mesos_vnodes.info")
+        _obtain_mesos_nodes.return_value = read_file_as_json("test-files/mesos-master-slaves.json")
+
+        nodeinfolist = mesos.lrms(MagicMock(mesos.lrms), MESOS_USAGE_FROM_SLAVES=True).get_nodeinfolist()
+        result = '[NODE "10.0.0.84"] state: used, 0/1 (free slots), 116391936/653262848 (mem)'
+        assert str(nodeinfolist['10.0.0.84']) == result
+        result = '[NODE "vnode2"] state: off, 1/1 (free slots), 1572864000/1572864000 (mem)'
+        assert str(nodeinfolist['vnode2']) == result
+        assert not _obtain_mesos_jobs.called
+
+    def test_get_slave_used_resources(self):
+        mesos_slave = read_file_as_json("test-files/mesos-master-slaves.json")['slaves'][0]
+        assert mesos.get_slave_used_resources(mesos_slave) == (1.0, 536870912)
+        del mesos_slave['used_resources']
+        assert mesos.get_slave_used_resources(mesos_slave) == (0, 0)
+
+    @mock.patch('socket.gethostbyname')
+    def test_hostname_resolver(self, gethostbyname):
+        gethostbyname.side_effect = lambda name: {'vnode1': '10.0.0.1'}[name]
+        resolver = mesos.HostnameResolver(300, 60, 2)
+        assert resolver.resolve(['vnode1', 'vnode2'], 5) == {'vnode1': '10.0.0.1'}
+        assert resolver.resolve(['vnode1', 'vnode2'], 5) == {'vnode1': '10.0.0.1'}
+        # Both the resolved and the failed names are cached
+        assert gethostbyname.call_count == 2
+
+    @mock.patch('socket.gethostbyname')
+    def test_hostname_resolver_expired(self, gethostbyname):
+        gethostbyname.return_value = '10.0.0.1'
+        resolver = mesos.HostnameResolver(-1, -1, 2)
+        assert resolver.resolve(['vnode1'], 5) == {'vnode1': '10.0.0.1'}
+        gethostbyname.return_value = '10.0.0.2'
+        # The expired entry is refreshed in background, meanwhile the previous ip is returned
+        assert resolver.resolve(['vnode1'], 5) == {'vnode1': '10.0.0.1'}
+        resolver.wait(5)
+        assert resolver.resolve(['vnode1'], 5) == {'vnode1': '10.0.0.2'}
+
+    @mock.patch('socket.gethostbyname')
+    def test_hostname_resolver_recycled_ip(self, gethostbyname):
+        gethostbyname.side_effect = lambda name: {'vnode1': '10.0.0.1'}[name]
+        resolver = mesos.HostnameResolver(300, 60, 2)
+        assert resolver.resolve(['vnode1'], 5) == {'vnode1': '10.0.0.1'}
+        # vnode1 is destroyed and its ip is assigned to the new vnode2, while the old entry is still cached
+        gethostbyname.side_effect = lambda name: {'vnode2': '10.0.0.1'}[name]
+        assert resolver.resolve(['vnode1', 'vnode2'], 5) == {'vnode2': '10.0.0.1'}
+        # The stale entry is resolved again
+        resolver.resolve(['vnode1', 'vnode2'], 5)
+        resolver.wait(5)
+        assert resolver.resolve(['vnode1', 'vnode2'], 5) == {'vnode2': '10.0.0.1'}
+        assert gethostbyname.call_args_list == [call('vnode1'), call('vnode2'), call('vnode1')]
+
+    @mock.patch('mesos.lrms._obtain_chronos_jobs_state')
     @mock.patch('mesos.lrms._obtain_chronos_job_state')
     @mock.patch('mesos.lrms._obtain_chronos_jobs')
     @mock.patch('mesos.lrms._obtain_mesos_jobs')
@@ -273,7 +574,8 @@ class TestMesosPlugin(unittest.TestCase):
     @mock.patch('mesos.lrms._obtain_mesos_nodes')
     @mock.patch('mesos.lrms._obtain_mesos_state')
     def test_get_jobinfolist(self, _obtain_mesos_state, _obtain_mesos_nodes, _obtain_marathon_jobs,
-                             _obtain_mesos_jobs, _obtain_chronos_jobs, _obtain_chronos_job_state):
+                             _obtain_mesos_jobs, _obtain_chronos_jobs, _obtain_chronos_job_state,
+                             _obtain_chronos_jobs_state):
         _obtain_mesos_state.return_value = read_file_as_json("test-files/mesos-state.json")
         _obtain_mesos_nodes.return_value = read_file_as_json("test-files/mesos-master-slaves.json")
         _obtain_marathon_jobs.return_value = read_file_as_json("test-files/marathon-jobs.json")
@@ -283,6 +585,256 @@ class TestMesosPlugin(unittest.TestCase):
         job_info_list = mesos.lrms(MagicMock(mesos.lrms)).get_jobinfolist()
 
         assert len(job_info_list) == 4
+        # The state of the Chronos jobs is prefetched
+        assert wait_for(lambda: _obtain_chronos_jobs_state.called)
+
+    @mock.patch('mesos.lrms._obtain_chronos_jobs_state')
+    @mock.patch('mesos.lrms._get_chronos_jobinfolist')
+    @mock.patch('mesos.lrms._obtain_marathon_jobs')
+    @mock.patch('mesos.lrms._obtain_mesos_nodes')
+    @mock.patch('mesos.lrms._obtain_mesos_state')
+    def test_get_jobinfolist_chronos_timeout(self, _obtain_mesos_state, _obtain_mesos_nodes, _obtain_marathon_jobs,
+                                             _get_chronos_jobinfolist, _obtain_chronos_jobs_state):
+        _obtain_mesos_state.return_value = read_file_as_json("test-files/mesos-state.json")
+        _obtain_mesos_nodes.return_value = read_file_as_json("test-files/mesos-master-slaves.json")
+        _obtain_marathon_jobs.return_value = read_file_as_json("test-files/marathon-jobs.json")
+        _get_chronos_jobinfolist.side_effect = lambda: time.sleep(2)
+        job_info_list = mesos.lrms(MagicMock(mesos.lrms), MESOS_FETCH_DEADLINE=0.5).get_jobinfolist()
+
+        assert len(job_info_list) == 3
+
+    @mock.patch('mesos.lrms._obtain_chronos_jobs_state')
+    @mock.patch('mesos.lrms._get_chronos_jobinfolist')
+    @mock.patch('mesos.lrms._get_marathon_jobinfolist')
+    @mock.patch('mesos.lrms._get_mesos_jobinfolist')
+    def test_get_jobinfolist_running_fetch(self, _get_mesos_jobinfolist, _get_marathon_jobinfolist,
+                                           _get_chronos_jobinfolist, _obtain_chronos_jobs_state):
+        _get_mesos_jobinfolist.return_value = []
+        _get_marathon_jobinfolist.return_value = []
+        _get_chronos_jobinfolist.side_effect = lambda: time.sleep(1)
+        lrms = mesos.lrms(MagicMock(mesos.lrms), MESOS_FETCH_DEADLINE=0.2)
+        lrms.get_jobinfolist()
+        lrms.get_jobinfolist()
+
+        # The Chronos fetch of the first pass is still running, so it is not submitted again
+        assert _get_chronos_jobinfolist.call_count == 1
+        assert _get_mesos_jobinfolist.call_count == 2
+
+    def get_event_stream(self):
+        event_stream = mesos.MesosEventStream("http://localhost/api/v1", 5, 0.1)
+        for event in mesos.read_recordio(read_file("test-files/mesos-operator-events.recordio")):
+            event_stream.apply_event(event)
+        return event_stream
+
+    def test_mesos_event_stream_model(self):
+        event_stream = self.get_event_stream()
+        assert event_stream.is_synchronized()
+
+        tasks = sorted(event_stream.get_tasks()['tasks'], key=lambda task: task['id'])
+        assert [(task['id'], task['state']) for task in tasks] == [('babbo.1', 'TASK_RUNNING'),
+                                                                   ('spark.1', 'TASK_RUNNING')]
+        assert tasks[1]['resources'] == {'cpus': 0.5, 'mem': 256.0}
+
+        slaves = sorted(event_stream.get_slaves()['slaves'], key=lambda slave: slave['hostname'])
+        assert [slave['hostname'] for slave in slaves] == ['10.0.0.84', '10.0.0.85']
+        assert slaves[0]['used_resources'] == {'cpus': 1.0, 'mem': 512.0}
+        assert slaves[1]['used_resources'] == {'cpus': 0.5, 'mem': 256.0}
+
+        frameworks = sorted(event_stream.get_state()['frameworks'], key=lambda framework: framework['name'])
+        assert [framework['name'] for framework in frameworks] == ['marathon', 'spark']
+        assert frameworks[1]['resources'] == {'cpus': 0.5, 'mem': 256.0}
+        assert frameworks[1]['tasks'][0]['slave_id'] == '20150925-075030-1063856798-5050-3482-S1'
+
+    def test_mesos_event_stream_task_finished(self):
+        event_stream = self.get_event_stream()
+        event_stream.apply_event({'type': 'TASK_UPDATED',
+                                  'task_updated': {'state': 'TASK_FINISHED',
+                                                   'status': {'task_id': {'value': 'spark.1'}}}})
+        assert [task['id'] for task in event_stream.get_tasks()['tasks']] == ['babbo.1']
+
+    def test_mesos_event_stream_reconnect(self):
+        FakeMesosMaster.subscriptions = 0
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), FakeMesosMaster)
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        event_stream = mesos.MesosEventStream("http://127.0.0.1:%d/api/v1" % server.server_port, 5, 0.1)
+        try:
+            event_stream.start()
+            # The fake master closes the stream after replaying it, so the plugin must resubscribe
+            assert wait_for(lambda: FakeMesosMaster.subscriptions >= 2)
+            assert wait_for(lambda: sorted(slave['hostname'] for slave in event_stream.get_slaves()['slaves']) ==
+                            ['10.0.0.84', '10.0.0.85'])
+        finally:
+            event_stream.stop()
+            server.shutdown()
+
+    @mock.patch('mesos.MesosEventStream.start')
+    def test_mesos_event_stream_authenticated(self, _start):
+        lrms = mesos.lrms(MagicMock(mesos.lrms), MESOS_STATE_SOURCE="events",
+                          MESOS_STATE_COMMAND='/usr/bin/curl -L -u user:pass -k http://mesosserverpublic:5050/state')
+        event_stream = lrms._get_event_stream()
+        # The stream shares the session of the queries
+        assert event_stream._session is lrms._session
+        event_stream._session = MagicMock()
+        event_stream._session.post.return_value.status_code = 200
+        event_stream._session.post.return_value.raw.read.return_value = ""
+        event_stream._subscribe()
+
+        args, kwargs = event_stream._session.post.call_args
+        assert args[0] == 'http://mesosserverpublic:5050/api/v1'
+        assert kwargs['auth'] == ('user', 'pass')
+        assert kwargs['verify'] is False
+        assert kwargs['headers'] == {'Content-Type': 'application/json', 'Accept': 'application/json'}
+
+    @mock.patch('mesos.http_command')
+    def test_obtain_mesos_nodes_from_events(self, mock_http_command):
+        lrms = mesos.lrms(MagicMock(mesos.lrms), MESOS_STATE_SOURCE="events")
+        lrms._event_stream = self.get_event_stream()
+        assert len(lrms._obtain_mesos_nodes()['slaves']) == 2
+        assert len(lrms._obtain_mesos_jobs()['tasks']) == 2
+        assert len(lrms._obtain_mesos_state()['frameworks']) == 2
+        assert not mock_http_command.called
+
+    def get_marathon_event_stream(self):
+        event_stream = mesos.MarathonEventStream("http://localhost/v2/events", 5, 0.1, 300)
+        event_stream.reconcile(read_file_as_json("test-files/marathon-jobs.json"))
+        for event_type, event in mesos.read_server_sent_events(read_file("test-files/marathon-events.txt")):
+            event_stream.apply_event(event_type, event)
+        return event_stream
+
+    def test_read_server_sent_events(self):
+        events = list(mesos.read_server_sent_events(read_file("test-files/marathon-events.txt")))
+        assert len(events) == 7
+        assert events[0][0] == 'event_stream_attached'
+        assert events[1][1]['appDefinition']['id'] == '/web'
+
+    def test_marathon_event_stream_model(self):
+        event_stream = self.get_marathon_event_stream()
+        apps = sorted(event_stream.get_apps()['apps'], key=lambda app: app['id'])
+        assert [app['id'] for app in apps] == ['/babbo', '/web']
+        assert [task['host'] for task in apps[0]['tasks']] == ['vnode4']
+        assert apps[0]['tasksRunning'] == 1
+        assert sorted(task['host'] for task in apps[1]['tasks']) == ['vnode2', 'vnode3']
+        assert (apps[1]['tasksRunning'], apps[1]['tasksStaged'], apps[1]['instances']) == (1, 1, 2)
+
+    def test_marathon_event_stream_synchronized(self):
+        event_stream = mesos.MarathonEventStream("http://localhost/v2/events", 5, 0.1, 300)
+        event_stream._synchronized = True
+        assert not event_stream.is_synchronized()
+        event_stream.reconcile(read_file_as_json("test-files/marathon-jobs.json"))
+        assert event_stream.is_synchronized()
+        event_stream._reconciled -= 300
+        assert not event_stream.is_synchronized()
+
+    @mock.patch('requests.get')
+    def test_marathon_event_stream_reconnect(self, requests_get):
+        requests_get.return_value.status_code = 200
+        requests_get.return_value.raw.readline.return_value = ""
+        event_stream = mesos.MarathonEventStream("http://localhost/v2/events", 5, 0.1, 300)
+        event_stream.reconcile(read_file_as_json("test-files/marathon-jobs.json"))
+        event_stream._subscribe()
+        # The model must be reconciled again after reconnecting
+        assert event_stream._synchronized
+        assert not event_stream.is_synchronized()
+
+    @mock.patch('mesos.MarathonEventStream.start')
+    def test_marathon_event_stream_authenticated(self, _start):
+        lrms = mesos.lrms(MagicMock(mesos.lrms), MESOS_MARATHON_SOURCE="events",
+                          MESOS_MARATHON_COMMAND='/usr/bin/curl -L -u user:pass --cacert ca.pem '
+                                                 'https://mesosserverpublic:8080/v2/apps?embed=apps.tasks')
+        event_stream = lrms._get_marathon_event_stream()
+        # The stream shares the session of the queries
+        assert event_stream._session is lrms._session
+        event_stream._session = MagicMock()
+        event_stream._session.get.return_value.status_code = 200
+        event_stream._session.get.return_value.raw.readline.return_value = ""
+        event_stream._subscribe()
+
+        args, kwargs = event_stream._session.get.call_args
+        assert args[0] == 'https://mesosserverpublic:8080/v2/events'
+        assert kwargs['auth'] == ('user', 'pass')
+        assert kwargs['verify'] == 'ca.pem'
+        assert kwargs['headers'] == {'Accept': 'text/event-stream'}
+
+    @mock.patch('mesos.http_command')
+    def test_get_marathon_jobinfolist_from_events(self, mock_http_command):
+        lrms = mesos.lrms(MagicMock(mesos.lrms), MESOS_MARATHON_SOURCE="events")
+        lrms._marathon_event_stream = self.get_marathon_event_stream()
+        lrms._marathon_event_stream._synchronized = True
+        jobs = sorted(lrms._get_marathon_jobinfolist(), key=lambda job: job.job_id)
+
+        assert [job.job_id for job in jobs] == ['/babbo', '/web']
+        assert jobs[0].job_nodes_ids == ['vnode4']
+        assert jobs[1].resources.taskcount == 2
+        assert not mock_http_command.called
+
+    @mock.patch('mesos.http_command')
+    def test_obtain_marathon_jobs_reconcile(self, mock_http_command):
+        mock_http_command.return_value = read_file_as_json("test-files/marathon-jobs.json")
+        lrms = mesos.lrms(MagicMock(mesos.lrms), MESOS_MARATHON_SOURCE="events")
+        lrms._marathon_event_stream = mesos.MarathonEventStream("http://localhost/v2/events", 5, 0.1, 300)
+        # The stream is not attached, so the apps are queried and the model is reconciled with them
+        assert lrms._obtain_marathon_jobs() == read_file_as_json("test-files/marathon-jobs.json")
+        assert [app['id'] for app in lrms._marathon_event_stream.get_apps()['apps']] == ['/babbo']
+
+    @mock.patch('mesos.lrms._obtain_marathon_launch_queue')
+    @mock.patch('mesos.lrms._obtain_marathon_jobs')
+    def test_get_marathon_jobinfolist_launch_queue(self, _obtain_marathon_jobs, _obtain_marathon_launch_queue):
+        _obtain_marathon_jobs.return_value = read_file_as_json("test-files/marathon-jobs.json")
+        _obtain_marathon_launch_queue.return_value = {'/babbo': 2}
+        job_created = mesos.lrms(MagicMock(mesos.lrms), MESOS_MARATHON_USE_QUEUE=True)._get_marathon_jobinfolist()[0]
+
+        # The app is partially scaled, so only its unmet instances are requested
+        assert job_created.state == Request.PENDING
+        assert job_created.job_id == '/babbo'
+        assert job_created.job_nodes_ids == [u'vnode1']
+        assert job_created.resources.taskcount == 2
+
+        _obtain_marathon_launch_queue.return_value = {}
+        job_created = mesos.lrms(MagicMock(mesos.lrms), MESOS_MARATHON_USE_QUEUE=True)._get_marathon_jobinfolist()[0]
+        assert job_created.state == Request.ATTENDED
+        assert job_created.resources.taskcount == 1
+
+    @mock.patch('mesos.http_command')
+    def test_obtain_marathon_launch_queue(self, mock_http_command):
+        mock_http_command.return_value = read_file_as_json("test-files/marathon-queue.json")
+        lrms = mesos.lrms(MagicMock(mesos.lrms), MESOS_MARATHON_USE_QUEUE=True)
+        assert lrms._obtain_marathon_launch_queue() == {'/babbo': 2}
+        assert mock_http_command.call_args[0][1] == '/usr/bin/curl -L -X GET http://mesosserverpublic:8080/v2/queue'
+
+    @mock.patch('mesos.lrms._obtain_marathon_launch_queue')
+    @mock.patch('mesos.lrms._obtain_marathon_jobs')
+    def test_get_marathon_jobinfolist_counts(self, _obtain_marathon_jobs, _obtain_marathon_launch_queue):
+        marathon_jobs = read_file_as_json("test-files/marathon-jobs.json")
+        del marathon_jobs['apps'][0]['tasks']
+        _obtain_marathon_jobs.return_value = marathon_jobs
+        _obtain_marathon_launch_queue.return_value = {}
+        job_created = mesos.lrms(MagicMock(mesos.lrms), MESOS_MARATHON_USE_QUEUE=True)._get_marathon_jobinfolist()[0]
+        assert job_created.state == Request.ATTENDED
+        assert job_created.job_nodes_ids == []
+
+    @mock.patch('mesos.lrms._obtain_marathon_launch_queue')
+    @mock.patch('mesos.lrms._obtain_marathon_jobs')
+    def test_get_marathon_jobinfolist_counts_without_queue(self, _obtain_marathon_jobs,
+                                                           _obtain_marathon_launch_queue):
+        marathon_jobs = read_file_as_json("test-files/marathon-jobs.json")
+        del marathon_jobs['apps'][0]['tasks']
+        marathon_jobs['apps'].append(dict(marathon_jobs['apps'][0], id='/babbo2'))
+        marathon_jobs['apps'][0].update({'instances': 3, 'tasksRunning': 1, 'tasksStaged': 0})
+        marathon_jobs['apps'][1].update({'instances': 2, 'tasksRunning': 1, 'tasksStaged': 1})
+        _obtain_marathon_jobs.return_value = marathon_jobs
+        # The launch queue cannot be obtained
+        _obtain_marathon_launch_queue.return_value = None
+        jobs = mesos.lrms(MagicMock(mesos.lrms), MESOS_MARATHON_USE_QUEUE=True)._get_marathon_jobinfolist()
+
+        assert [(job.state, job.resources.taskcount) for job in jobs] == [(Request.PENDING, 2), (Request.ATTENDED, 2)]
+
+    def test_init_lrms_marathon_use_queue(self):
+        lrms = mesos.lrms(MESOS_MARATHON_USE_QUEUE=True)
+        assert lrms._marathon == '/usr/bin/curl -L -X GET http://mesosserverpublic:8080/v2/apps?embed=apps.counts'
+        lrms = mesos.lrms(MESOS_MARATHON_COMMAND='marathon', MESOS_MARATHON_USE_QUEUE=True)
+        assert lrms._marathon == 'marathon'
 
 
 if __name__ == '__main__':